@@ -0,0 +1,209 @@
+import asyncio
+import os
+from typing import Any, Dict, List, Sequence
+
+import numpy as np
+
+import comment_store
+from cache import TTLCache
+
+# --- ★ 保存済みスナップショットの集計 (サーバー側) ---
+# 全コメントをブラウザに送って集計させる代わりに、列指向の NumPy 配列に変換して
+# いいね数の分布・時間帯別の件数・投稿者ランキング・返信数の分布をまとめて計算する。
+
+# いいね数のパーセンタイル
+LIKE_PERCENTILES = (50, 75, 90, 95, 99, 99.9)
+# スレッドあたりの返信数の区分 [下限, 次の下限) -> "0", "1", "2-5", ...
+REPLY_BUCKETS = (0, 1, 2, 6, 11, 51, 101)
+# 時間別ヒストグラムの最大ビン数（期間が長い動画はビン幅を1時間の倍数に広げる）
+MAX_HISTOGRAM_BINS = int(os.getenv("ANALYTICS_MAX_HISTOGRAM_BINS", "500"))
+MAX_TOP_AUTHORS = 100
+
+# 集計結果のキャッシュ (snapshot_id, revision, top_authors) -> dict
+analytics_cache = TTLCache(
+    max_entries=int(os.getenv("ANALYTICS_CACHE_MAX_ENTRIES", "64")),
+    ttl=float(os.getenv("ANALYTICS_CACHE_TTL", "3600")),
+    name="analytics",
+)
+
+_NAT = np.iinfo(np.int64).min
+
+
+def _parse_dates(dates: List[Any]) -> np.ndarray:
+    """
+    "YYYY/MM/DD HH:MM:SS" (UTC) の配列を epoch 秒 (int64) に変換します。
+    固定長の文字列を (件数, 19) の文字コード配列として見て、数字の位置から直接計算する。
+    形式が違うもの・日付として不正なものは NaT (int64 の最小値)。
+    """
+    text = np.array([d if isinstance(d, str) else "" for d in dates], dtype="U19")
+    codes = text.view(np.uint32).reshape(len(text), 19).astype(np.int64) - ord("0")
+
+    def number(start: int, width: int) -> np.ndarray:
+        value = np.zeros(len(text), dtype=np.int64)
+        for position in range(start, start + width):
+            value = value * 10 + codes[:, position]
+        return value
+
+    year, month, day = number(0, 4), number(5, 2), number(8, 2)
+    hour, minute, second = number(11, 2), number(14, 2), number(17, 2)
+    digits = codes[:, _DIGIT_POSITIONS]
+    valid = (
+        ((digits >= 0) & (digits <= 9)).all(axis=1)
+        & (codes[:, _SEPARATOR_POSITIONS] == _SEPARATORS).all(axis=1)
+        & (month >= 1) & (month <= 12) & (day >= 1)
+        & (hour <= 23) & (minute <= 59) & (second <= 59)
+    )
+    months = np.where(valid, (year - 1970) * 12 + month - 1, 0)
+    month_start = months.astype("datetime64[M]").astype("datetime64[D]").astype(np.int64)
+    next_month = (months + 1).astype("datetime64[M]").astype("datetime64[D]").astype(np.int64)
+    valid &= day <= next_month - month_start
+    seconds = (month_start + day - 1) * 86400 + hour * 3600 + minute * 60 + second
+    return np.where(valid, seconds, _NAT)
+
+
+_SEPARATOR_POSITIONS = [4, 7, 10, 13, 16]
+_SEPARATORS = np.array([ord(c) - ord("0") for c in "// ::"], dtype=np.int64)
+_DIGIT_POSITIONS = [i for i in range(19) if i not in _SEPARATOR_POSITIONS]
+
+
+class CommentColumns:
+    """
+    コメント（と取得済みの返信）を列ごとの NumPy 配列にしたもの。
+    投稿者は辞書エンコード（authors[author_codes[i]] が i 番目の投稿者名）。
+    """
+
+    def __init__(self, comments: Sequence[Dict[str, Any]]):
+        replies = [reply for comment in comments for reply in comment.get("replies") or ()]
+        # スレッド (トップレベルコメント) を先に、取得済みの返信を後ろに並べる
+        rows = list(comments) + replies
+        self.thread_count = len(comments)
+        self.is_reply = np.arange(len(rows)) >= self.thread_count
+
+        self.likes = np.fromiter(
+            (row.get("likes") or 0 for row in rows), dtype=np.int64, count=len(rows)
+        )
+        self.dates = _parse_dates([row.get("date") for row in rows])
+        # 投稿者名は出現順に番号を振って辞書エンコードする
+        codes: Dict[str, int] = {}
+        self.author_codes = np.fromiter(
+            (codes.setdefault(row.get("author") or "", len(codes)) for row in rows),
+            dtype=np.int64, count=len(rows),
+        )
+        self.authors = list(codes)
+        # スレッドのみの列
+        self.total_replies = np.fromiter(
+            (comment.get("totalReplies") or 0 for comment in comments),
+            dtype=np.int64, count=self.thread_count,
+        )
+        self.fetched_replies = np.fromiter(
+            (len(comment.get("replies") or ()) for comment in comments),
+            dtype=np.int64, count=self.thread_count,
+        )
+
+    def __len__(self) -> int:
+        return len(self.likes)
+
+    # --- 集計 ---
+
+    def like_stats(self) -> Dict[str, Any]:
+        likes = self.likes
+        if not len(likes):
+            return {"total": 0, "mean": 0.0, "max": 0, "zero_ratio": 0.0, "percentiles": {}}
+        values = np.percentile(likes, LIKE_PERCENTILES)
+        return {
+            "total": int(likes.sum()),
+            "mean": round(float(likes.mean()), 3),
+            "max": int(likes.max()),
+            "zero_ratio": round(float(np.count_nonzero(likes == 0) / len(likes)), 4),
+            "percentiles": {
+                f"p{p:g}": round(float(v), 2) for p, v in zip(LIKE_PERCENTILES, values)
+            },
+        }
+
+    def time_histogram(self, max_bins: int = MAX_HISTOGRAM_BINS) -> Dict[str, Any]:
+        """1時間ごとの投稿数（ビン数が max_bins を超える場合は幅を広げる）"""
+        valid = self.dates[self.dates != _NAT]
+        if not len(valid):
+            return {
+                "bin_seconds": 3600, "start": None, "counts": [],
+                "undated": len(self.dates), "peak": None,
+            }
+        hours = valid // 3600
+        first = int(hours.min())
+        span = int(hours.max()) - first + 1
+        width = -(-span // max_bins)  # 切り上げ
+        counts = np.bincount((hours - first) // width)
+        return {
+            "bin_seconds": 3600 * width,
+            "start": str(np.datetime64(first * 3600, "s")) + "Z",
+            "counts": counts.tolist(),
+            "undated": int(len(self.dates) - len(valid)),
+            "peak": {
+                "start": str(np.datetime64((first + int(counts.argmax()) * width) * 3600, "s")) + "Z",
+                "count": int(counts.max()),
+            },
+        }
+
+    def top_authors(self, limit: int) -> List[Dict[str, Any]]:
+        if not len(self.author_codes) or limit <= 0:
+            return []
+        counts = np.bincount(self.author_codes)
+        likes = np.bincount(self.author_codes, weights=self.likes)
+        replies = np.bincount(self.author_codes, weights=self.is_reply)
+        k = min(limit, len(counts))
+        top = np.argpartition(-counts, k - 1)[:k]
+        # 件数降順・同数はいいね数の多い順
+        top = top[np.lexsort((-likes[top], -counts[top]))]
+        return [
+            {
+                "author": self.authors[i],
+                "comments": int(counts[i]),
+                "replies": int(replies[i]),
+                "likes": int(likes[i]),
+            }
+            for i in top
+        ]
+
+    def reply_distribution(self) -> Dict[str, Any]:
+        """スレッドあたりの返信数 (totalReplies) の分布と、返信の取得率"""
+        edges = np.array(REPLY_BUCKETS)
+        counts = np.bincount(
+            np.searchsorted(edges, self.total_replies, side="right") - 1, minlength=len(edges)
+        )
+        labels = [
+            str(low) if high == low + 1 else f"{low}-{high - 1}"
+            for low, high in zip(REPLY_BUCKETS, REPLY_BUCKETS[1:])
+        ] + [f"{REPLY_BUCKETS[-1]}+"]
+        total = int(self.total_replies.sum())
+        return {
+            "buckets": [{"replies": label, "threads": int(n)} for label, n in zip(labels, counts)],
+            "threads_with_replies": int(np.count_nonzero(self.total_replies)),
+            "total_replies": total,
+            "fetched_replies": int(self.fetched_replies.sum()),
+            "max_replies": int(self.total_replies.max()) if self.thread_count else 0,
+        }
+
+
+def summarize(comments: Sequence[Dict[str, Any]], top_authors: int = 10) -> Dict[str, Any]:
+    """コメント配列の集計結果（数 KB）を返す"""
+    columns = CommentColumns(comments)
+    return {
+        "threads": columns.thread_count,
+        "comments": len(columns),
+        "unique_authors": len(columns.authors),
+        "likes": columns.like_stats(),
+        "time_histogram": columns.time_histogram(),
+        "top_authors": columns.top_authors(min(top_authors, MAX_TOP_AUTHORS)),
+        "reply_distribution": columns.reply_distribution(),
+    }
+
+
+async def get_summary(snapshot: Dict[str, Any], top_authors: int = 10) -> Dict[str, Any]:
+    """スナップショットの集計結果を返す（同じ版ならキャッシュを再利用）"""
+    key = (snapshot["id"], snapshot["revision"], top_authors)
+
+    async def load() -> Dict[str, Any]:
+        comments = await comment_store.get_comments(snapshot)
+        return await asyncio.to_thread(summarize, comments, top_authors)
+
+    return await analytics_cache.get_or_load(key, load)
@@ -7,26 +7,43 @@ from fastapi import (
     Header,
     status,
     Request,
-    BackgroundTasks,  # ★ 追加: バックグラウンド処理用
 )
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.middleware.sessions import SessionMiddleware
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
-from typing import Dict, Any, List, Optional
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel, Field
+from typing import Dict, Any, List, Literal, Optional
+from contextlib import asynccontextmanager
+import asyncio
 import os
 import json
-import google.generativeai as genai
+import re
+import orjson
 from jose import jwt, JWTError
-from google.cloud.firestore_v1.base_query import FieldFilter
-
-# Stripeライブラリ
-import stripe
 from dotenv import load_dotenv
 
-# ★ Firebase関連の追加
-import firebase_admin
-from firebase_admin import credentials, firestore
+# Firestore アクセス層 (専用スレッドプールで実行し、イベントループを止めない)
+import firestore_service
+
+# is_pro / usage_count のキャッシュ
+import entitlements
+
+# 利用回数の書き込みをまとめて行う (write-behind)
+from usage_counter import usage_counter
+
+# Stripe Webhook の非同期処理
+import webhook_queue
+
+# 全コメント取得のジョブキュー
+import harvest_jobs
+
+from responses import ORJSONResponse
+
+# レイテンシ計測 (Server-Timing / Prometheus)
+import metrics
+
+# レスポンス圧縮 (gzip / brotli)
+from compression import CompressionMiddleware
 
 # サービスロジックをインポート
 import youtube_service
@@ -34,15 +51,26 @@ import youtube_service
 # 認証ロジックをインポート
 import auth
 
+# ローカル検索エンジン
+import search_service
+
+# Gemini による意味検索
+import gemini_service
+
+# 取得済みコメントの保存先
+import comment_store
+
+# 保存済みコメントの集計
+import analytics_service
+
 # .envファイルから環境変数を読み込む
 load_dotenv()
 
 # --- Gemini API Setup ---
+# ★ SDK の読み込みと configure は gemini_service が初回の意味検索時に行う
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if not GEMINI_API_KEY:
     print("Warning: GEMINI_API_KEY is not set in .env file.")
-else:
-    genai.configure(api_key=GEMINI_API_KEY)
 
 # --- Stripe Setup ---
 STRIPE_SECRET_KEY = os.getenv("STRIPE_SECRET_KEY")
@@ -52,23 +80,71 @@ STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
 
 if not STRIPE_SECRET_KEY:
     print("Warning: STRIPE_SECRET_KEY is not set in .env file.")
-else:
-    stripe.api_key = STRIPE_SECRET_KEY
 
-# --- ★ Firebase (Firestore) Setup ---
-if not firebase_admin._apps:
-    try:
-        cred = credentials.Certificate("serviceAccountKey.json")
-        firebase_admin.initialize_app(cred)
-        print("Firebase Admin Initialized successfully.")
-    except Exception as e:
-        print(f"Firebase Init Error: {e}")
 
-# DBクライアントの取得
-db = firestore.client()
+def get_stripe():
+    """
+    Stripe ライブラリを返します。
+    ★ 読み込みが重いため、決済・Webhook のルートが初めて使われた時点で import する
+    """
+    import stripe
+
+    if STRIPE_SECRET_KEY:
+        stripe.api_key = STRIPE_SECRET_KEY
+    return stripe
+
+
+# --- ★ 起動時の初期化 ---
+# Scale-to-zero 環境ではコールドスタートが応答時間に直結するため、重い SDK
+# (Firebase / Gemini / Stripe / authlib) は import 時には読み込まず、初回使用時に読み込む。
+# STARTUP_WARMUP=1 の場合は、起動完了後にバックグラウンドで事前に読み込み・接続しておく
+# （起動＝最初の1バイトまでの時間は延ばさない）。
+STARTUP_WARMUP = os.getenv("STARTUP_WARMUP", "0") == "1"
+
+
+async def warmup() -> None:
+    async def step(name, coro_fn):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            await coro_fn()
+            print(f"Warmup {name}: {(loop.time() - start) * 1000:.0f}ms")
+        except Exception as e:
+            # 失敗しても初回使用時に改めて初期化されるだけなので起動は止めない
+            print(f"Warmup {name} failed: {e}")
+
+    await step("firestore", firestore_service.warmup)
+    await step("oauth", auth.warmup)
+    await step("gemini", gemini_service.warmup)
+    await step("stripe", lambda: asyncio.to_thread(get_stripe))
+
 
 # --- FastAPI App Setup ---
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # ★ YouTube API 用の共有コネクションプールを起動時に1度だけ作成
+    await youtube_service.startup_client()
+    firestore_service.init_executor()
+    usage_counter.start()
+    webhook_queue.start()
+    harvest_jobs.start()
+    warmup_task = asyncio.create_task(warmup()) if STARTUP_WARMUP else None
+    yield
+    if warmup_task is not None and not warmup_task.done():
+        warmup_task.cancel()
+    # ★ 終了時に先読みを止めてからプールを閉じる
+    await youtube_service.cancel_prefetches()
+    # 実行中のジョブは次回起動時にチェックポイントから再開される
+    await harvest_jobs.stop()
+    await youtube_service.shutdown_client()
+    comment_store.close()
+    await webhook_queue.stop()
+    # ★ バッファ中の利用回数を書き切ってから Firestore のプールを閉じる
+    await usage_counter.stop()
+    firestore_service.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # Auth設定の読み込み
 SECRET_KEY = os.getenv("SECRET_KEY", "your_secret_key_should_be_random")
@@ -94,8 +170,29 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ★ 一定サイズ以上のレスポンスを gzip / brotli で圧縮する
+app.add_middleware(CompressionMiddleware)
+
+# ★ ルート別レイテンシの集計と Server-Timing ヘッダー（最も外側で計測する）
+app.add_middleware(metrics.MetricsMiddleware)
+
 app.include_router(auth.router)
 
+# /metrics に出すキャッシュ・プールのゲージ
+metrics.register_gauges("youtube_pool", youtube_service.get_pool_stats)
+metrics.register_gauges("youtube_quota", youtube_service.get_quota_stats)
+metrics.register_gauges("firestore_pool", firestore_service.get_pool_stats)
+metrics.register_gauges("usage_counter", usage_counter.stats)
+for _cache in (
+    youtube_service.page_cache,
+    search_service.index_cache,
+    comment_store.loaded_cache,
+    entitlements.entitlement_cache,
+    gemini_service.result_cache,
+    analytics_service.analytics_cache,
+):
+    metrics.register_gauges("cache", _cache.stats, cache=_cache.name)
+
 # --- Application Constants ---
 VIDEO_ID = "fmFn2otWosE"
 # GOAL_MAX_RESULTS はページネーション導入により、必須ではなくなりましたが互換性のために残すか、削除してもOK
@@ -103,7 +200,48 @@ VIDEO_ID = "fmFn2otWosE"
 # --- Pydantic Models ---
 class SearchRequest(BaseModel):
     keyword: str
-    comments: List[Any]
+    # コメント配列を直接送るか、保存済みの video_id (+ snapshot_id) を指定する
+    comments: Optional[List[Any]] = None
+    video_id: Optional[str] = None
+    snapshot_id: Optional[int] = None
+    # "local": 完全一致→曖昧検索 / "exact" / "fuzzy" / "vector": 類似度順
+    # "semantic": Gemini で意味検索
+    mode: Literal["local", "exact", "fuzzy", "vector", "semantic"] = "local"
+    # ローカル検索が0件のときだけ Gemini に問い合わせる (opt-in)
+    semantic_fallback: bool = False
+    # mode="vector" で返す上位件数
+    top_k: int = Field(20, ge=1, le=1000)
+
+
+class UploadedReply(BaseModel):
+    # /api/comments が返す整形済みコメントと同じ形（未知の項目は捨てる）
+    id: Optional[str] = Field(None, max_length=128)
+    author: Optional[str] = Field(None, max_length=256)
+    date: Optional[str] = Field(None, max_length=32)
+    text: Optional[str] = Field(None, max_length=20000)
+    likes: int = Field(0, ge=0)
+
+
+class UploadedComment(UploadedReply):
+    totalReplies: int = Field(0, ge=0)
+    replies: List[UploadedReply] = []
+
+
+class SnapshotUploadRequest(BaseModel):
+    comments: List[UploadedComment]
+
+
+class HarvestJobRequest(BaseModel):
+    video_id: str = Field(..., pattern=r"^[A-Za-z0-9_-]{11}$")
+
+
+class BatchCommentsRequest(BaseModel):
+    video_ids: List[str] = Field(..., min_length=1, max_length=youtube_service.BATCH_MAX_VIDEOS)
+    expand_replies: bool = False
+
+
+# YouTube の動画 ID (11文字)
+VIDEO_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{11}")
 
 # --- ★ 認証依存関数 (Dependency) ---
 async def get_current_user(authorization: str = Header(None)):
@@ -114,7 +252,8 @@ async def get_current_user(authorization: str = Header(None)):
         )
     try:
         token = authorization.split(" ")[1]
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        with metrics.span("jwt"):
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         user_id: str = payload.get("sub")
         if user_id is None:
             raise HTTPException(
@@ -127,91 +266,456 @@ async def get_current_user(authorization: str = Header(None)):
             detail="認証情報の検証に失敗しました。",
         )
 
-# --- ★ Helper: バックグラウンドで実行するDB更新処理 ---
-def increment_usage_count_task(user_id: str):
+# --- ★ Helper: 利用回数制限チェック ---
+async def check_usage_limit(user_id: str, count: int = 1) -> Dict[str, Any]:
     """
-    レスポンスを返した後にバックグラウンドで実行される関数。
-    ユーザーの利用回数を+1する。
+    無料版の利用回数制限を確認し、問題なければ count 回分カウントアップする。
+    制限超過時は 402 を送出する。
+    確認に使ったユーザーの利用権限 {usage_count, is_pro} を返す。
     """
+    # 制限チェックはレスポンスを返す前にやる必要がある
+    # ★ キャッシュ済みならメモリ参照のみ、なければ Firestore を専用スレッドプールで読む
     try:
-        user_ref = db.collection("users").document(user_id)
-        user_doc = user_ref.get()
-        
-        if not user_doc.exists:
-            # 初回アクセスの場合はドキュメント作成
-            user_ref.set(
-                {
-                    "usage_count": 1,
-                    "is_pro": False,
-                    "email": "unknown", 
-                    "created_at": firestore.SERVER_TIMESTAMP,
-                }
-            )
-        else:
-            # 既存ユーザーの場合はカウントを+1 (Atomic Increment)
-            user_ref.update(
-                {
-                    "usage_count": firestore.Increment(1),
-                    "last_updated": firestore.SERVER_TIMESTAMP,
-                }
+        with metrics.span("usage_check"):
+            entitlement = await entitlements.get_entitlement(user_id)
+        current_count = entitlement["usage_count"]
+        is_pro = entitlement["is_pro"]
+
+        print(f"User stats - Count: {current_count}, Pro: {is_pro}")
+
+        # 制限チェック (今回の利用分を加えると上限を超え、かつ Proではない場合)
+        if entitlements.is_over_limit(entitlement, count):
+            raise HTTPException(
+                status_code=402, # Payment Required
+                detail="無料版の利用回数制限に達しました。",
             )
-        print(f"Background Task: Incremented usage for {user_id}")
+
+        # ★ キャッシュ上のカウントを先に加算し、DB へは一定間隔でまとめて書き込む
+        entitlements.record_usage(user_id, count)
+        usage_counter.add(user_id, count)
+        return entitlement
+
+    except HTTPException as he:
+        raise he
     except Exception as e:
-        print(f"Background Task Error: {e}")
+        print(f"Firestore Check Error: {e}")
+        # DB読込エラー時は、ユーザー体験優先で通すか、エラーにするか。ここでは安全側に倒してエラー
+        raise HTTPException(status_code=500, detail=f"Database Error: {str(e)}")
+
+def parse_fields_query(fields: Optional[str]):
+    """fields クエリを解釈する（未知の項目は 400）"""
+    try:
+        return youtube_service.parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 # --- Main API Endpoints ---
 
 @app.get("/api/comments")
 async def get_video_comments_api(
-    background_tasks: BackgroundTasks, # ★ 追加
     video_id: str = Query(VIDEO_ID, description="YouTube Video ID"),
     page_token: Optional[str] = Query(None, description="Next Page Token for pagination"), # ★ 追加
+    expand_replies: bool = Query(False, description="返信を全件取得する (追加のクォータを消費)"),
+    fields: Optional[str] = Query(None, description="返す項目 (例: author,text,likes)。省略時は全項目"),
     user_id: str = Depends(get_current_user),
-) -> Dict[str, Any]:
+) -> ORJSONResponse:
     """
     YouTube動画のコメントを取得します。
     ★ ページネーション対応により高速化
     ★ Firestoreの更新はバックグラウンドで行いレイテンシを削減
     """
     print(f"Request from User ID: {user_id}, Video ID: {video_id}, Page Token: {page_token}")
+    projection = parse_fields_query(fields)
 
-    # --- ★ Firestore: 制限チェック (Readのみ・同期実行) ---
-    # 制限チェックはレスポンスを返す前にやる必要があるため、ここは await せずに実行（Firestore SDKは基本同期）
-    # ※ FirestoreのReadは高速なのでここは許容
-    try:
-        user_ref = db.collection("users").document(user_id)
-        user_doc = user_ref.get()
-        
-        current_count = 0
-        is_pro = False
-
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
-            current_count = user_data.get("usage_count", 0)
-            is_pro = user_data.get("is_pro", False)
-        
-        print(f"User stats - Count: {current_count}, Pro: {is_pro}")
+    entitlement = await check_usage_limit(user_id)
+    # ★ YouTube API のクォータが逼迫したときは Pro ユーザーのリクエストを優先する
+    priority = youtube_service.priority_for(entitlement["is_pro"])
 
-        # 制限チェック (4回以上 かつ Proではない場合)
-        if current_count >= 4 and not is_pro:
-            raise HTTPException(
-                status_code=402, # Payment Required
-                detail="無料版の利用回数制限に達しました。",
+    # --- ★ YouTube取得ロジック (非同期・単一ページ取得) ---
+    # youtube_service.py に新しく実装した(はずの) async 関数を呼び出す
+    with metrics.span("comment_page"):
+        if expand_replies:
+            result = await youtube_service.fetch_comments_page_with_replies(
+                video_id, page_token, priority
             )
-            
-        # ★ カウントアップ処理をバックグラウンドタスクに追加 (ここでは実行待ちしない)
-        background_tasks.add_task(increment_usage_count_task, user_id)
+        else:
+            result = await youtube_service.fetch_comments_page(video_id, page_token, priority)
 
-    except HTTPException as he:
-        raise he
-    except Exception as e:
-        print(f"Firestore Check Error: {e}")
-        # DB読込エラー時は、ユーザー体験優先で通すか、エラーにするか。ここでは安全側に倒してエラー
-        raise HTTPException(status_code=500, detail=f"Database Error: {str(e)}")
+    # ★ 「もっと見る」に備えて次ページをバックグラウンドで先読み（クォータ残量が少ない時は自動停止）
+    if result.get("status") == "success":
+        youtube_service.schedule_prefetch(video_id, result.get("next_page_token"))
 
-    # --- ★ YouTube取得ロジック (非同期・単一ページ取得) ---
-    # youtube_service.py に新しく実装した(はずの) async 関数を呼び出す
-    return await youtube_service.fetch_comments_page(video_id, page_token)
+        # 指定された項目だけを返す（キャッシュ上の結果は書き換えない）
+        if projection is not None:
+            result = {
+                **result,
+                "comments": youtube_service.project_comments(result["comments"], projection),
+            }
+
+    # ★ orjson で直接シリアライズ (jsonable_encoder による走査を省略)
+    return ORJSONResponse(result)
+
+
+@app.post("/api/comments/batch")
+async def get_batch_comments_api(
+    request: BatchCommentsRequest,
+    user_id: str = Depends(get_current_user),
+) -> ORJSONResponse:
+    """
+    複数動画の動画情報（タイトル・コメント数）と最初のコメントページをまとめて返します。
+    利用回数はバッチ全体で一度に確認し、動画の本数分を消費します。動画ごとの失敗は
+    その動画の status="error" として返します（他の動画の結果には影響しない）。
+    """
+    # 重複を除き、指定順を保つ
+    video_ids = list(dict.fromkeys(request.video_ids))
+    print(f"Batch request from User ID: {user_id}, Videos: {len(video_ids)}")
+
+    entitlement = await check_usage_limit(user_id, len(video_ids))
+    priority = youtube_service.priority_for(entitlement["is_pro"])
+
+    valid_ids = [video_id for video_id in video_ids if VIDEO_ID_PATTERN.fullmatch(video_id)]
+    with metrics.span("comment_batch"):
+        results = await youtube_service.fetch_first_pages(
+            valid_ids, priority, with_replies=request.expand_replies
+        )
+    by_id = dict(zip(valid_ids, results))
+
+    videos = [
+        by_id.get(video_id)
+        or {"status": "error", "message": "Invalid video ID", "video_id": video_id}
+        for video_id in video_ids
+    ]
+    return ORJSONResponse(
+        {
+            "status": "success",
+            "count": len(videos),
+            "failed": sum(1 for video in videos if video.get("status") != "success"),
+            "videos": videos,
+        }
+    )
+
+
+@app.get("/api/comments/stream")
+async def stream_video_comments_api(
+    video_id: str = Query(VIDEO_ID, description="YouTube Video ID"),
+    max_results: Optional[int] = Query(None, ge=1, description="取得件数の上限 (省略時は全件)"),
+    expand_replies: bool = Query(False, description="返信を全件取得する (追加のクォータを消費)"),
+    fields: Optional[str] = Query(None, description="返す項目 (例: author,text,likes)。省略時は全項目"),
+    user_id: str = Depends(get_current_user),
+):
+    """
+    動画の全コメントを NDJSON (1行1コメント) でストリーミング返却します。
+    ページ単位で書き出すため、最初のページを取得した時点でレスポンスが始まります。
+    認証・利用回数チェックはストリーム全体で1回だけ行います。
+    取得したコメントはサーバー側にもスナップショットとして保存し、
+    その ID を X-Snapshot-Id ヘッダーで返します（検索・分析で再利用するため）。
+    max_results で打ち切った場合・途中で失敗した場合はスナップショットを残しません。
+    """
+    print(f"Stream request from User ID: {user_id}, Video ID: {video_id}")
+    projection = parse_fields_query(fields)
+
+    entitlement = await check_usage_limit(user_id)
+    priority = youtube_service.priority_for(entitlement["is_pro"])
+    snapshot_id = await asyncio.to_thread(comment_store.create_snapshot, video_id)
+
+    async def ndjson_chunks():
+        remaining = max_results
+        finished = False
+        pages = youtube_service.iter_comment_pages(video_id, priority=priority)
+        try:
+            async for page in pages:
+                comments = page["comments"]
+                if remaining is not None:
+                    comments = comments[:remaining]
+                    remaining -= len(comments)
+                if expand_replies:
+                    # 次ページの先行取得と並行して、このページの返信をまとめて取得する
+                    comments, _ = await youtube_service.expand_replies(comments, priority)
+                if comments:
+                    await asyncio.to_thread(
+                        comment_store.append_comments, snapshot_id, comments
+                    )
+                    # 保存は全項目、クライアントへは指定された項目のみ
+                    comments = youtube_service.project_comments(comments, projection)
+                    yield b"".join(orjson.dumps(comment) + b"\n" for comment in comments)
+                if remaining is not None and remaining <= 0:
+                    break
+            else:
+                # nextPageToken を最後まで辿れた場合のみ完成扱いにする
+                await asyncio.to_thread(comment_store.finish_snapshot, snapshot_id)
+                finished = True
+        except youtube_service.YouTubeAPIError as e:
+            # ステータスコードは送信済みのため、エラーは最終行として通知する
+            yield orjson.dumps(e.result) + b"\n"
+        finally:
+            await pages.aclose()
+            if not finished:
+                # 件数上限での打ち切り・失敗・切断時は途中までのスナップショットを捨てる
+                # （最新の完成済みとして検索に使われたり、完全な取得結果を押し出したりしないように）
+                # 切断でキャンセルされても削除は最後まで実行させる
+                await asyncio.shield(
+                    asyncio.to_thread(comment_store.discard_snapshot, snapshot_id)
+                )
+
+    return StreamingResponse(
+        ndjson_chunks(),
+        media_type="application/x-ndjson",
+        headers={"X-Snapshot-Id": str(snapshot_id)},
+    )
+
+
+@app.post("/api/harvest-jobs", status_code=202)
+async def submit_harvest_job(
+    request: HarvestJobRequest,
+    user_id: str = Depends(get_current_user),
+) -> Dict[str, Any]:
+    """
+    動画の全コメント取得をバックグラウンドのジョブとして投入し、ジョブ ID を返します。
+    同じ動画の未完了ジョブがあれば、そのジョブに合流します (attached=True)。
+    進捗は GET /api/harvest-jobs/{job_id}（または /events の SSE）、
+    完了後の結果は /result で取得します。
+    """
+    print(f"Harvest request from User ID: {user_id}, Video ID: {request.video_id}")
+    entitlement = await check_usage_limit(user_id)
+    job, created = await harvest_jobs.submit(
+        request.video_id, user_id, youtube_service.priority_for(entitlement["is_pro"])
+    )
+    return {"status": "success", "attached": not created, "job": harvest_jobs.public(job)}
+
+
+async def get_harvest_job_or_404(job_id: str) -> Dict[str, Any]:
+    job = await harvest_jobs.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="ジョブが見つかりません。")
+    return job
+
+
+@app.get("/api/harvest-jobs/{job_id}")
+async def get_harvest_job(
+    job_id: str, user_id: str = Depends(get_current_user)
+) -> Dict[str, Any]:
+    job = await get_harvest_job_or_404(job_id)
+    return {"status": "success", "job": harvest_jobs.public(job)}
+
+
+@app.get("/api/harvest-jobs/{job_id}/events")
+async def stream_harvest_job_events(
+    job_id: str, user_id: str = Depends(get_current_user)
+) -> StreamingResponse:
+    """
+    ジョブの進捗を SSE で返します。ページを保存するたびに progress イベントを送り、
+    完了・失敗時に complete / failed イベントを送って終わります。
+    """
+    await get_harvest_job_or_404(job_id)
+
+    async def events():
+        while True:
+            # 状態を読む前に待ち受けを登録する（読んでから待つまでの間の更新を取りこぼさないように）
+            updated = harvest_jobs.watch(job_id)
+            current = await harvest_jobs.get_job(job_id)
+            if current is None:
+                harvest_jobs.unwatch(job_id)
+                return
+            public = harvest_jobs.public(current)
+            if current["status"] in harvest_jobs.FINISHED_STATUSES:
+                harvest_jobs.unwatch(job_id)
+                yield sse(current["status"], public)
+                return
+            yield sse("progress", public)
+            # 更新がなくても接続を保つため、一定時間ごとにコメント行を送る
+            while not await harvest_jobs.wait_for_update(updated, 15):
+                yield b": keep-alive\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.get("/api/harvest-jobs/{job_id}/result")
+async def get_harvest_job_result(
+    job_id: str,
+    fields: Optional[str] = Query(None, description="返す項目 (例: author,text,likes)。省略時は全項目"),
+    user_id: str = Depends(get_current_user),
+) -> StreamingResponse:
+    """完了したジョブのコメントを NDJSON (1行1コメント) で返します。"""
+    projection = parse_fields_query(fields)
+    job = await get_harvest_job_or_404(job_id)
+    if job["status"] != "complete":
+        raise HTTPException(status_code=409, detail=f"ジョブは完了していません ({job['status']})。")
+    snapshot = await asyncio.to_thread(comment_store.get_snapshot, job["snapshot_id"])
+    if snapshot is None:
+        # 同じ動画の新しいスナップショットが保存され、古いものが削除された
+        raise HTTPException(status_code=410, detail="取得結果は保存期間を過ぎて削除されました。")
+    comments = await comment_store.get_comments(snapshot)
+
+    async def ndjson_chunks():
+        for start in range(0, len(comments), 1000):
+            batch = youtube_service.project_comments(comments[start:start + 1000], projection)
+            yield b"".join(orjson.dumps(comment) + b"\n" for comment in batch)
+
+    return StreamingResponse(
+        ndjson_chunks(),
+        media_type="application/x-ndjson",
+        headers={"X-Snapshot-Id": str(snapshot["id"])},
+    )
+
+
+@app.post("/api/videos/{video_id}/snapshots")
+async def upload_comment_snapshot(
+    video_id: str,
+    request: SnapshotUploadRequest,
+    user_id: str = Depends(get_current_user),
+) -> Dict[str, Any]:
+    """
+    クライアントが /api/comments で集めたコメントを一度だけアップロードして保存します。
+    以降の検索・分析は video_id + snapshot_id の指定だけで行えます。
+    アップロードはその利用者のスナップショットとして保存し、snapshot_id 省略時の
+    既定のスナップショット・差分取得の基準 (watermark) には使いません。
+    """
+    if not request.comments:
+        raise HTTPException(status_code=400, detail="Comments are required.")
+    total = sum(1 + len(comment.replies) for comment in request.comments)
+    if total > comment_store.UPLOAD_MAX_COMMENTS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"アップロードできるコメントは {comment_store.UPLOAD_MAX_COMMENTS} 件までです。",
+        )
+
+    comments = [comment.model_dump() for comment in request.comments]
+    snapshot_id = await asyncio.to_thread(
+        comment_store.save_upload, video_id, user_id, comments
+    )
+    return {
+        "status": "success",
+        "video_id": video_id,
+        "snapshot_id": snapshot_id,
+        "comment_count": len(comments),
+    }
+
+
+@app.post("/api/videos/{video_id}/sync")
+async def sync_comment_snapshot(
+    video_id: str,
+    user_id: str = Depends(get_current_user),
+) -> ORJSONResponse:
+    """
+    保存済みスナップショットに新着コメントだけを取り込みます（差分取得）。
+    前回把握した最新コメント (watermark) に到達するまでしかページを遡らないため、
+    新着が数十件なら YouTube へのリクエストは1回で済みます。
+    取り込み後は revision が上がり、検索インデックス等のキャッシュも作り直されます。
+    ※ 既存コメントのいいね数・返信の更新は反映しない（必要なら全件を取得し直す）
+    """
+    entitlement = await check_usage_limit(user_id)
+
+    snapshot = await asyncio.to_thread(comment_store.resolve_snapshot, video_id)
+    watermark = await asyncio.to_thread(comment_store.get_watermark, video_id)
+    if snapshot is None or watermark is None:
+        raise HTTPException(
+            status_code=404,
+            detail="差分の基準となる保存済みコメントがありません。先に全件を取得してください。",
+        )
+
+    result = await youtube_service.fetch_new_comments(
+        video_id, watermark, priority=youtube_service.priority_for(entitlement["is_pro"])
+    )
+    if result.get("status") != "success":
+        return ORJSONResponse(result, status_code=502)
+    if not result["complete"]:
+        # 新着が多すぎて既知のコメントまで遡れなかった（取り込むと欠落が生じる）
+        return ORJSONResponse(
+            {
+                "status": "too_many_new_comments",
+                "video_id": video_id,
+                "pages_fetched": result["pages"],
+                "detail": "新着コメントが多いため、全件を取得し直してください。",
+            },
+            status_code=409,
+        )
+
+    updated = await asyncio.to_thread(
+        comment_store.prepend_comments, snapshot["id"], result["comments"]
+    )
+    return ORJSONResponse(
+        {
+            "status": "success",
+            "video_id": video_id,
+            "snapshot_id": updated["id"],
+            "revision": updated["revision"],
+            "comment_count": updated["comment_count"],
+            "pages_fetched": result["pages"],
+            "new_count": len(updated["added"]),
+            "comments": updated["added"],
+        }
+    )
+
+
+@app.get("/api/videos/{video_id}/snapshots")
+async def list_comment_snapshots(
+    video_id: str, user_id: str = Depends(get_current_user)
+) -> Dict[str, Any]:
+    """保存済みスナップショットの一覧（新しい順）"""
+    snapshots = await asyncio.to_thread(comment_store.list_snapshots, video_id)
+    return {"status": "success", "video_id": video_id, "snapshots": snapshots}
+
+
+@app.get("/api/videos/{video_id}/analytics")
+async def get_comment_analytics(
+    video_id: str,
+    snapshot_id: Optional[int] = Query(None, description="省略時は最新の完成済みスナップショット"),
+    top_authors: int = Query(10, ge=0, le=analytics_service.MAX_TOP_AUTHORS),
+    user_id: str = Depends(get_current_user),
+) -> ORJSONResponse:
+    """
+    保存済みスナップショットの集計（いいね数の分布・時間別の投稿数・投稿者ランキング・返信数の分布）。
+    全コメントを返す代わりに数 KB の集計結果だけを返す。
+    """
+    snapshot = await asyncio.to_thread(
+        comment_store.resolve_snapshot, video_id, snapshot_id, user_id
+    )
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail="保存済みのコメントが見つかりません。")
+
+    with metrics.span("analytics"):
+        summary = await analytics_service.get_summary(snapshot, top_authors)
+    return ORJSONResponse(
+        {
+            "status": "success",
+            "video_id": video_id,
+            "snapshot_id": snapshot["id"],
+            "revision": snapshot["revision"],
+            **summary,
+        }
+    )
+
+
+@app.get("/api/stats")
+async def get_server_stats() -> Dict[str, Any]:
+    """
+    コネクションプール・キャッシュ等の内部統計を返す（サイズ調整・監視用）
+    """
+    return {
+        "youtube_pool": youtube_service.get_pool_stats(),
+        "comment_page_cache": youtube_service.page_cache.stats(),
+        "search_index_cache": search_service.index_cache.stats(),
+        "comment_store_cache": comment_store.loaded_cache.stats(),
+        "entitlement_cache": entitlements.entitlement_cache.stats(),
+        "gemini_result_cache": gemini_service.result_cache.stats(),
+        "analytics_cache": analytics_service.analytics_cache.stats(),
+        "usage_counter": usage_counter.stats(),
+        "webhook_queue": await asyncio.to_thread(webhook_queue.stats),
+        "harvest_jobs": await asyncio.to_thread(harvest_jobs.stats),
+        "youtube_quota": youtube_service.get_quota_stats(),
+    }
+
+
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics() -> PlainTextResponse:
+    """Prometheus 形式のメトリクス（ルート別・外部API別のヒストグラムとゲージ）"""
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
 
 
 @app.get("/api/hello")
@@ -220,16 +724,128 @@ async def read_hello_compatibility() -> Dict[str, Any]:
     return {"message": "Hello World. Please use /api/comments for features."}
 
 
+def semantic_search_too_large(error: gemini_service.TooManyChunksError) -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail=(
+            f"意味検索の対象が多すぎます（{error.chunks} チャンク、上限 {gemini_service.MAX_CHUNKS}）。"
+            "キーワード検索 (mode=local) を使うか、対象のコメントを絞ってください。"
+        ),
+    )
+
+
+def local_search_too_large(error: search_service.TooManyCommentsError) -> HTTPException:
+    return HTTPException(
+        status_code=413,
+        detail=(
+            f"検索対象のコメントが多すぎます（{error.count} 件、上限 {search_service.MAX_COMMENTS} 件）。"
+            "対象のコメントを絞ってください。"
+        ),
+    )
+
+
+async def resolve_search_comments(request: SearchRequest, user_id: str):
+    """
+    検索対象のコメントと、インデックスのキャッシュキーを返す。
+    video_id 指定時はサーバーに保存済みのスナップショットを使う（アップロード不要）。
+    アップロードされたスナップショットは本人のものだけを使える。
+    """
+    if request.comments:
+        return request.comments, None
+    if not request.video_id:
+        return [], None
+
+    snapshot = await asyncio.to_thread(
+        comment_store.resolve_snapshot, request.video_id, request.snapshot_id, user_id
+    )
+    if snapshot is None:
+        raise HTTPException(
+            status_code=404, detail="保存済みのコメントが見つかりません。"
+        )
+    comments = await comment_store.get_comments(snapshot)
+    return comments, ("snapshot", snapshot["id"], snapshot["revision"])
+
+
 @app.post("/api/search-comments")
-async def search_comments_with_gemini(request: SearchRequest) -> Dict[str, Any]:
+async def search_comments_with_gemini(
+    request: SearchRequest, user_id: str = Depends(get_current_user)
+) -> Dict[str, Any]:
+    """
+    コメント検索。まずローカルの n-gram インデックスで検索し（数ミリ秒）、
+    Gemini は mode="semantic" か semantic_fallback 指定時のみ呼び出す。
+    """
+    keyword = request.keyword
+    comments, index_key = await resolve_search_comments(request, user_id)
+
+    if not keyword or not comments:
+        print("Error: Keyword or comments missing")
+        raise HTTPException(
+            status_code=400, detail="Keyword and comments are required."
+        )
+
+    if request.mode != "semantic":
+        try:
+            result = await search_service.search_local(
+                comments, keyword, request.mode, top_k=request.top_k, cache_key=index_key
+            )
+        except search_service.TooManyCommentsError as e:
+            raise local_search_too_large(e)
+        if result["matches"] or not request.semantic_fallback:
+            response = {
+                "success": True,
+                "engine": "local",
+                "mode": result["mode"],
+                "count": len(result["matches"]),
+                "data": json.dumps(result["matches"], ensure_ascii=False),
+            }
+            if "scores" in result:
+                response["scores"] = result["scores"]
+            return response
+
     if not GEMINI_API_KEY:
         print("Error: API Key missing")
         raise HTTPException(
             status_code=500, detail="Server API Key configuration error."
         )
 
+    try:
+        # ★ 全コメントをチャンクに分けて並列に問い合わせる (500件の切り捨てを廃止)
+        result = await gemini_service.search_comments(keyword, comments)
+    except gemini_service.TooManyChunksError as e:
+        raise semantic_search_too_large(e)
+    except Exception as e:
+        print(f"Gemini API Error Detail: {e}")
+        raise HTTPException(status_code=500, detail=f"Gemini API Error: {str(e)}")
+
+    matches = [comments[i] for i in result["indices"]]
+    return {
+        "success": True,
+        "engine": "gemini",
+        "mode": "semantic",
+        "count": len(matches),
+        "chunks": result["chunks"],
+        "failed_chunks": result["failed_chunks"],
+        "data": json.dumps(matches, ensure_ascii=False),
+    }
+
+
+def sse(event: str, data: Any) -> bytes:
+    """Server-Sent Events の1イベント分 (event: / data: 行 + 空行)"""
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(data) + b"\n\n"
+
+
+@app.post("/api/search-comments/stream")
+async def stream_search_comments_with_gemini(
+    request: SearchRequest, user_id: str = Depends(get_current_user)
+) -> StreamingResponse:
+    """
+    /api/search-comments のストリーミング版 (text/event-stream)。
+    Gemini の逐次出力から該当コメントが確定するたびに match イベントを送るため、
+    最初の結果が全体の応答を待たずに届く。
+    イベント: meta -> match (0件以上) -> done、失敗時は error で終わる。
+    """
     keyword = request.keyword
-    comments = request.comments
+    comments, index_key = await resolve_search_comments(request, user_id)
 
     if not keyword or not comments:
         print("Error: Keyword or comments missing")
@@ -237,34 +853,71 @@ async def search_comments_with_gemini(request: SearchRequest) -> Dict[str, Any]:
             status_code=400, detail="Keyword and comments are required."
         )
 
-    try:
-        # Gemini API呼び出し (非同期)
-        model = genai.GenerativeModel("gemini-2.5-flash") # または gemini-1.5-flash
-        
-        # 解析対象の絞り込み
-        comments_to_analyze = comments[:500]
-        comments_string = json.dumps(comments_to_analyze, ensure_ascii=False, indent=2)
-
-        prompt = f"""
-        以下の【コメント配列】の中から、textプロパティの値に"{keyword}"に似た言葉を含むオブジェクトのみを抽出してください。
-        【制約事項】
-        1. 結果は抽出されたオブジェクトの配列を含むJSON文字列として、他の説明文やマークダウン( ```json 等)を付けずにそのまま出力してください。
-        2. 抽出対象は、必ずtextプロパティにキーワードが含まれているものに限定してください。
-        【コメント配列】
-        {comments_string}
-        """
-
-        response = await model.generate_content_async(prompt)
-        result_text = response.text
-        
-        # クリーニング
-        cleaned_text = result_text.replace("```json", "").replace("```", "").strip()
-        
-        return {"success": True, "data": cleaned_text}
+    local = None
+    if request.mode != "semantic":
+        try:
+            local = await search_service.search_local(
+                comments, keyword, request.mode, top_k=request.top_k, cache_key=index_key
+            )
+        except search_service.TooManyCommentsError as e:
+            raise local_search_too_large(e)
+        if not local["matches"] and request.semantic_fallback:
+            local = None
 
-    except Exception as e:
-        print(f"Gemini API Error Detail: {e}")
-        raise HTTPException(status_code=500, detail=f"Gemini API Error: {str(e)}")
+    if local is None and not GEMINI_API_KEY:
+        print("Error: API Key missing")
+        raise HTTPException(
+            status_code=500, detail="Server API Key configuration error."
+        )
+    if local is None:
+        # ストリーム開始後はステータスコードを返せないため、件数の上限は先に確認する
+        try:
+            plan = await gemini_service.plan_search(keyword, comments)
+        except gemini_service.TooManyChunksError as e:
+            raise semantic_search_too_large(e)
+
+    async def local_events():
+        # ローカル検索は一瞬で終わるので、同じ形式のイベントでまとめて返す
+        yield sse("meta", {"engine": "local", "mode": local["mode"]})
+        scores = local.get("scores") or []
+        for position, comment in enumerate(local["matches"]):
+            data = {"comment": comment}
+            if position < len(scores):
+                data["score"] = scores[position]
+            yield sse("match", data)
+        yield sse("done", {"count": len(local["matches"])})
+
+    async def gemini_events():
+        yield sse("meta", {"engine": "gemini", "mode": "semantic"})
+        count = 0
+        try:
+            async for event in gemini_service.stream_search_comments(keyword, plan):
+                if event["type"] == "match":
+                    count += 1
+                    yield sse(
+                        "match", {"index": event["index"], "comment": comments[event["index"]]}
+                    )
+                else:
+                    yield sse(
+                        "done",
+                        {
+                            "count": count,
+                            "chunks": event["chunks"],
+                            "failed_chunks": event["failed_chunks"],
+                            "cached": event["cached"],
+                        },
+                    )
+        except Exception as e:
+            # ステータスコードは送信済みのため、エラーはイベントとして通知する
+            print(f"Gemini API Error Detail: {e}")
+            yield sse("error", {"detail": f"Gemini API Error: {str(e)}"})
+
+    return StreamingResponse(
+        local_events() if local is not None else gemini_events(),
+        media_type="text/event-stream",
+        # プロキシ (nginx 等) にバッファリングさせず、イベントを即座に届ける
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 @app.post("/api/create-checkout-session")
@@ -275,17 +928,19 @@ async def create_checkout_session(
         raise HTTPException(status_code=500, detail="Stripe configuration error.")
 
     try:
-        checkout_session = stripe.checkout.Session.create(
-            payment_method_types=["card"],
-            line_items=[{"price": STRIPE_PRICE_ID, "quantity": 1}],
-            mode="subscription",
-            subscription_data={
-                "trial_period_days": 30,
-            },
-            success_url=f"{FRONTEND_URL}/success?session_id={{CHECKOUT_SESSION_ID}}",
-            cancel_url=f"{FRONTEND_URL}/",
-            metadata={"user_id": user_id},
-        )
+        stripe = get_stripe()
+        with metrics.upstream("stripe", "checkout.session.create"):
+            checkout_session = stripe.checkout.Session.create(
+                payment_method_types=["card"],
+                line_items=[{"price": STRIPE_PRICE_ID, "quantity": 1}],
+                mode="subscription",
+                subscription_data={
+                    "trial_period_days": 30,
+                },
+                success_url=f"{FRONTEND_URL}/success?session_id={{CHECKOUT_SESSION_ID}}",
+                cancel_url=f"{FRONTEND_URL}/",
+                metadata={"user_id": user_id},
+            )
         return {"url": checkout_session.url}
     except Exception as e:
         print(f"Stripe Error: {e}")
@@ -302,6 +957,7 @@ async def stripe_webhook(request: Request, stripe_signature: str = Header(None))
             status_code=500, detail="Webhook Secret configuration error"
         )
 
+    stripe = get_stripe()
     try:
         event = stripe.Webhook.construct_event(
             payload, stripe_signature, STRIPE_WEBHOOK_SECRET
@@ -314,62 +970,22 @@ async def stripe_webhook(request: Request, stripe_signature: str = Header(None))
         raise HTTPException(status_code=400, detail="Invalid signature")
 
     event_type = event["type"]
-    data_object = event["data"]["object"]
-
     print(f"Received Webhook Event: {event_type}")
 
-    # Case A: 決済完了 / トライアル開始
-    if event_type == "checkout.session.completed":
-        user_id = data_object.get("metadata", {}).get("user_id")
-        stripe_customer_id = data_object.get("customer")
-
-        if user_id:
-            print(f"✅ Subscription started for User: {user_id}")
-            try:
-                user_ref = db.collection("users").document(user_id)
-                user_ref.set(
-                    {
-                        "is_pro": True,
-                        "stripe_customer_id": stripe_customer_id,
-                        "updated_at": firestore.SERVER_TIMESTAMP,
-                    },
-                    merge=True,
-                )
-            except Exception as e:
-                print(f"❌ DB Update Error (Checkout): {e}")
-                return JSONResponse(status_code=500, content={"error": str(e)})
-        else:
-            print("⚠️ User ID not found in session metadata.")
-
-    # Case B: サブスクリプション解約 / 期限切れ
-    elif event_type == "customer.subscription.deleted":
-        stripe_customer_id = data_object.get("customer")
-        print(f"🚫 Subscription deleted for Customer: {stripe_customer_id}")
-
-        if stripe_customer_id:
-            try:
-                users_ref = db.collection("users")
-                query = users_ref.where(
-                    filter=FieldFilter("stripe_customer_id", "==", stripe_customer_id)
-                )
-                results = query.stream()
-                
-                found_user = False
-                for user_doc in results:
-                    found_user = True
-                    print(f"Found user to downgrade: {user_doc.id}")
-                    user_doc.reference.update(
-                        {"is_pro": False, "updated_at": firestore.SERVER_TIMESTAMP}
-                    )
-                
-                if not found_user:
-                    print(f"⚠️ No user found with Stripe Customer ID: {stripe_customer_id}")
-
-            except Exception as e:
-                print(f"❌ DB Update Error (Deletion): {e}")
+    # ★ 検証済みのイベントを永続キューに積んで即座に応答する
+    # 利用権限の更新はワーカー (webhook_queue) が行い、同じ event.id の再送は無視される
+    try:
+        created = await webhook_queue.enqueue(
+            event["id"], event_type, payload.decode("utf-8")
+        )
+    except Exception as e:
+        print(f"❌ Webhook Queue Error: {e}")
+        # 保存できなかった場合は Stripe に再送してもらう
+        return JSONResponse(status_code=500, content={"error": str(e)})
 
-    elif event_type == "invoice.payment_failed":
-        print(f"⚠️ Payment failed for Customer: {data_object.get('customer')}")
+    if not created:
+        print(f"Duplicate Webhook Event ignored: {event['id']}")
+        return {"status": "duplicate"}
 
     return {"status": "success"}
 
@@ -379,9 +995,5 @@ async def get_user_status(user_id: str = Depends(get_current_user)):
     """
     現在のユーザーがProプランかどうかを返すAPI
     """
-    user_ref = db.collection("users").document(user_id)
-    doc = user_ref.get()
-    is_pro = False
-    if doc.exists:
-        is_pro = doc.to_dict().get("is_pro", False)
-    return {"is_pro": is_pro}
\ No newline at end of file
+    entitlement = await entitlements.get_entitlement(user_id)
+    return {"is_pro": entitlement["is_pro"]}
\ No newline at end of file
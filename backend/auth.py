@@ -1,17 +1,17 @@
 # backend/auth.py
+import asyncio
 import os
+import threading
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Any, Optional
 
 from fastapi import APIRouter, Request, HTTPException
 from fastapi.responses import RedirectResponse
-from authlib.integrations.starlette_client import OAuth
 from jose import jwt
 from dotenv import load_dotenv
 
-# ★ Firebase関連
-import firebase_admin
-from firebase_admin import credentials, firestore
+# Firestore アクセス層 (api.py と共通)
+import firestore_service
 
 load_dotenv()
 
@@ -26,31 +26,41 @@ BACKEND_BASE_URL = os.getenv("BACKEND_BASE_URL", "http://localhost:8000")
 # JWTの有効期限（セッション継続時間）
 ACCESS_TOKEN_EXPIRE_DAYS = 30
 
-# --- Firebase (Firestore) Setup ---
-# api.py と同様に二重初期化を防ぐ
-if not firebase_admin._apps:
-    try:
-        # serviceAccountKey.json が backend ディレクトリにある前提
-        cred = credentials.Certificate("serviceAccountKey.json")
-        firebase_admin.initialize_app(cred)
-        print("Firebase Admin Initialized in auth.py")
-    except Exception as e:
-        print(f"Firebase Init Error in auth.py: {e}")
-
-# DBクライアントの取得
-db = firestore.client()
-
 router = APIRouter(prefix="/auth", tags=["auth"])
 
 # OAuth設定
-oauth = OAuth()
-oauth.register(
-    name="google",
-    client_id=GOOGLE_CLIENT_ID,
-    client_secret=GOOGLE_CLIENT_SECRET,
-    server_metadata_url="https://accounts.google.com/.well-known/openid-configuration",
-    client_kwargs={"scope": "openid email profile"},
-)
+# ★ authlib の読み込みは重いので、初回ログイン（または warmup）時に行う
+_oauth: Any = None
+_oauth_lock = threading.Lock()
+
+
+def get_oauth() -> Any:
+    """Google を登録済みの OAuth レジストリを返します（初回のみ生成）"""
+    global _oauth
+    if _oauth is None:
+        with _oauth_lock:
+            if _oauth is None:
+                from authlib.integrations.starlette_client import OAuth
+
+                oauth = OAuth()
+                oauth.register(
+                    name="google",
+                    client_id=GOOGLE_CLIENT_ID,
+                    client_secret=GOOGLE_CLIENT_SECRET,
+                    server_metadata_url="https://accounts.google.com/.well-known/openid-configuration",
+                    client_kwargs={"scope": "openid email profile"},
+                )
+                _oauth = oauth
+    return _oauth
+
+
+async def warmup() -> None:
+    """
+    authlib の読み込みと OpenID メタデータの取得を事前に済ませます（lifespan から任意で呼ぶ）。
+    取得したメタデータはクライアントに保持され、初回ログイン時の往復がなくなる。
+    """
+    oauth = await asyncio.to_thread(get_oauth)
+    await oauth.google.load_server_metadata()
 
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -74,7 +84,7 @@ async def login(request: Request):
     2. Googleの認証画面へリダイレクトURLを生成して飛ばす
     """
     redirect_uri = f"{BACKEND_BASE_URL}/auth/callback"
-    return await oauth.google.authorize_redirect(request, redirect_uri)
+    return await get_oauth().google.authorize_redirect(request, redirect_uri)
 
 
 @router.get("/callback")
@@ -85,7 +95,7 @@ async def auth_callback(request: Request):
     5. JWTを発行してフロントエンドに戻す
     """
     try:
-        token = await oauth.google.authorize_access_token(request)
+        token = await get_oauth().google.authorize_access_token(request)
         user_info = token.get("userinfo")
 
         if not user_info:
@@ -96,37 +106,21 @@ async def auth_callback(request: Request):
         
         # --- DBへの登録処理 (修正済み) ---
         try:
-            user_ref = db.collection("users").document(google_sub)
-            doc = user_ref.get()
-            
             # 常に更新したい基本プロフィール情報
             base_data = {
                 "email": user_info.get("email"),
                 "name": user_info.get("name"),
                 "picture": user_info.get("picture"),
-                "last_login": firestore.SERVER_TIMESTAMP,
+                "last_login": firestore_service.server_timestamp(),
             }
 
-            if not doc.exists:
-                # 【新規ユーザーの場合】
-                # is_pro や usage_count など、アプリ動作に必要な初期値を含めて作成する
+            # ★ 新規ユーザーは初期値込みで作成、既存ユーザーはプロフィールのみ更新
+            # (Firestore 呼び出しは専用スレッドプールで実行)
+            created = await firestore_service.save_login_user(google_sub, base_data)
+            if created:
                 print(f"Creating NEW user: {google_sub}")
-                
-                new_user_data = base_data.copy()
-                new_user_data.update({
-                    "is_pro": False,          # ★ 最初は無料会員
-                    "usage_count": 0,         # ★ 使用回数0
-                    "created_at": firestore.SERVER_TIMESTAMP,
-                    "updated_at": firestore.SERVER_TIMESTAMP,
-                    "stripe_customer_id": None
-                })
-                
-                user_ref.set(new_user_data)
             else:
-                # 【既存ユーザーの場合】
-                # is_pro などの重要なフラグは上書きせず、プロフィールとログイン日時だけ更新する
                 print(f"Updating EXISTING user: {google_sub}")
-                user_ref.set(base_data, merge=True)
 
         except Exception as db_e:
             print(f"Database Save Error: {db_e}")
@@ -0,0 +1,366 @@
+"""
+ベンチマーク・負荷テスト用のローカル代替実装。
+
+- YouTubeReplay: commentThreads のページを返す httpx.MockTransport 用ハンドラ
+  （録画済みページのディレクトリ、または合成ページを再生する。videos.list にも合成データで応答）
+- FakeFirestore: api.py / auth.py が使う範囲の Firestore クライアントのインメモリ実装
+- FakeGeminiModel: 遅延を設定できる Gemini モデルのスタブ（stream=True の逐次出力にも対応）
+
+install() でこれらを各サービスモジュールに差し込む。api を import する前に呼ぶこと
+（api は import 時に GEMINI_API_KEY を読むため、install() が設定するダミーのキーが先に必要）。
+"""
+import asyncio
+import glob
+import json
+import os
+import re
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from benchmarks.format_page import make_page
+
+
+# --- YouTube Data API (commentThreads) ---
+
+class YouTubeReplay:
+    """
+    commentThreads.list への応答を再生します。
+    recordings_dir に page_*.json（API の生レスポンス）があればファイル名順に再生し、
+    なければ pages ページ分の合成レスポンスを使います。
+    nextPageToken はページ番号に付け替えるため、録画時のトークンに依存しません。
+    """
+
+    def __init__(
+        self,
+        recordings_dir: Optional[str] = None,
+        pages: int = 5,
+        threads_per_page: int = 100,
+        replies_per_thread: int = 2,
+        latency: float = 0.05,
+    ):
+        self.latency = latency
+        self.calls = 0
+        self.bytes_sent = 0
+        if recordings_dir:
+            paths = sorted(glob.glob(os.path.join(recordings_dir, "page_*.json")))
+            if not paths:
+                raise FileNotFoundError(f"No page_*.json in {recordings_dir}")
+            resources = []
+            for path in paths:
+                with open(path, encoding="utf-8") as f:
+                    resources.append(json.load(f))
+        else:
+            resources = [
+                json.loads(make_page(
+                    threads_per_page, replies_per_thread,
+                    start=number * threads_per_page, full_resource=True,
+                ))
+                for number in range(pages)
+            ]
+
+        self._resources: List[Dict[str, Any]] = []
+        self._bodies: List[bytes] = []
+        for number, resource in enumerate(resources):
+            resource = dict(resource)
+            if number + 1 < len(resources):
+                resource["nextPageToken"] = f"page-{number + 1}"
+            else:
+                resource.pop("nextPageToken", None)
+            self._resources.append(resource)
+            self._bodies.append(json.dumps(resource, ensure_ascii=False).encode("utf-8"))
+
+    @property
+    def page_count(self) -> int:
+        return len(self._bodies)
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if request.url.path.endswith("/videos"):
+            return self._videos(request.url.params.get("id", ""))
+        if not request.url.path.endswith("/commentThreads"):
+            return httpx.Response(404, json={"error": {"message": "Not Found"}})
+
+        token = request.url.params.get("pageToken")
+        number = int(token.rsplit("-", 1)[1]) if token else 0
+        if number >= len(self._bodies):
+            return httpx.Response(400, json={"error": {"message": "invalid pageToken"}})
+        body = self._bodies[number]
+        fields = request.url.params.get("fields")
+        if fields:
+            # 部分レスポンス: 指定された項目だけを返す
+            selected = select_fields(self._resources[number], parse_fields_selector(fields))
+            body = json.dumps(selected, ensure_ascii=False).encode("utf-8")
+        self.bytes_sent += len(body)
+        return httpx.Response(
+            200,
+            content=body,
+            headers={"Content-Type": "application/json; charset=UTF-8"},
+        )
+
+    def _videos(self, ids: str) -> httpx.Response:
+        # "missing" を含む ID は存在しない動画、"nocomment" を含む ID はコメント無効として扱う
+        items = []
+        for video_id in filter(None, ids.split(",")):
+            if "missing" in video_id:
+                continue
+            statistics = {"viewCount": "1000", "likeCount": "100"}
+            if "nocomment" not in video_id:
+                statistics["commentCount"] = str(self.page_count * 100)
+            items.append({
+                "id": video_id,
+                "snippet": {
+                    "title": f"動画 {video_id}",
+                    "channelTitle": "ベンチマーク",
+                    "publishedAt": "2024-01-01T00:00:00Z",
+                },
+                "statistics": statistics,
+            })
+        return httpx.Response(200, json={"items": items})
+
+    def transport(self) -> httpx.MockTransport:
+        return httpx.MockTransport(self)
+
+
+def parse_fields_selector(selector: str) -> Dict[str, Any]:
+    """fields= の書式 (a,b(c,d)) を {"a": {}, "b": {"c": {}, "d": {}}} にする"""
+    def parse(position: int) -> Any:
+        tree: Dict[str, Any] = {}
+        name = ""
+        while position < len(selector):
+            ch = selector[position]
+            if ch == "(":
+                tree[name], position = parse(position + 1)
+                name = ""
+            elif ch == ")":
+                break
+            elif ch == ",":
+                if name:
+                    tree[name] = {}
+                name = ""
+            else:
+                name += ch
+            position += 1
+        if name:
+            tree[name] = {}
+        return tree, position
+
+    return parse(0)[0]
+
+
+def select_fields(value: Any, tree: Dict[str, Any]) -> Any:
+    if not tree:
+        return value
+    if isinstance(value, list):
+        return [select_fields(item, tree) for item in value]
+    if not isinstance(value, dict):
+        return value
+    return {key: select_fields(value[key], sub) for key, sub in tree.items() if key in value}
+
+
+# --- Firestore ---
+
+def _resolve_value(current: Any, value: Any) -> Any:
+    # firestore.Increment / SERVER_TIMESTAMP を SDK を通さずに解釈する
+    if type(value).__name__ == "Increment":
+        return (current or 0) + value.value
+    if value is _server_timestamp():
+        return time.time()
+    return value
+
+
+def _server_timestamp() -> Any:
+    from firebase_admin import firestore
+
+    return firestore.SERVER_TIMESTAMP
+
+
+class FakeSnapshot:
+    def __init__(self, doc_id: str, data: Optional[Dict[str, Any]]):
+        self.id = doc_id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self) -> Optional[Dict[str, Any]]:
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeDocument:
+    def __init__(self, db: "FakeFirestore", collection: str, doc_id: str):
+        self._db = db
+        self._collection = collection
+        self.id = doc_id
+
+    def get(self, timeout: Optional[float] = None) -> FakeSnapshot:
+        self._db._wait()
+        with self._db._lock:
+            data = self._db._docs(self._collection).get(self.id)
+            return FakeSnapshot(self.id, dict(data) if data is not None else None)
+
+    def set(self, data: Dict[str, Any], merge: bool = False, timeout: Optional[float] = None) -> None:
+        self._db._wait()
+        self._db._apply(self._collection, self.id, data, merge)
+
+    def update(self, data: Dict[str, Any], timeout: Optional[float] = None) -> None:
+        self._db._wait()
+        with self._db._lock:
+            if self.id not in self._db._docs(self._collection):
+                raise KeyError(f"No document to update: {self._collection}/{self.id}")
+        self._db._apply(self._collection, self.id, data, merge=True)
+
+
+class FakeQuery:
+    def __init__(self, db: "FakeFirestore", collection: str, filters: List[Any]):
+        self._db = db
+        self._collection = collection
+        self._filters = filters
+
+    def where(self, filter: Any = None) -> "FakeQuery":
+        return FakeQuery(self._db, self._collection, self._filters + [filter])
+
+    def stream(self, timeout: Optional[float] = None):
+        self._db._wait()
+        with self._db._lock:
+            items = list(self._db._docs(self._collection).items())
+        for doc_id, data in items:
+            if all(self._match(data, f) for f in self._filters):
+                yield FakeSnapshot(doc_id, dict(data))
+
+    @staticmethod
+    def _match(data: Dict[str, Any], field_filter: Any) -> bool:
+        if field_filter.op_string != "==":
+            raise NotImplementedError(field_filter.op_string)
+        return data.get(field_filter.field_path) == field_filter.value
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, db: "FakeFirestore", name: str):
+        super().__init__(db, name, [])
+
+    def document(self, doc_id: str) -> FakeDocument:
+        return FakeDocument(self._db, self._collection, doc_id)
+
+
+class FakeBatch:
+    def __init__(self, db: "FakeFirestore"):
+        self._db = db
+        self._ops: List[Any] = []
+
+    def set(self, ref: FakeDocument, data: Dict[str, Any], merge: bool = False) -> None:
+        self._ops.append((ref, data, merge))
+
+    def commit(self, timeout: Optional[float] = None) -> None:
+        self._db._wait()
+        for ref, data, merge in self._ops:
+            self._db._apply(ref._collection, ref.id, data, merge)
+        self._db.batch_commits += 1
+
+
+class FakeFirestore:
+    """
+    インメモリの Firestore クライアント。
+    実際の SDK と同じく同期 API で、各呼び出しは latency 秒ブロックする
+    （firestore_service のスレッドプール経由で呼ばれる前提）。
+    """
+
+    def __init__(self, latency: float = 0.02):
+        self.latency = latency
+        self.calls = 0
+        self.batch_commits = 0
+        self._collections: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+
+    def collection(self, name: str) -> FakeCollection:
+        return FakeCollection(self, name)
+
+    def batch(self) -> FakeBatch:
+        return FakeBatch(self)
+
+    def seed_user(self, user_id: str, **fields: Any) -> None:
+        data = {"is_pro": False, "usage_count": 0}
+        data.update(fields)
+        with self._lock:
+            self._docs("users")[user_id] = data
+
+    def _docs(self, collection: str) -> Dict[str, Dict[str, Any]]:
+        return self._collections.setdefault(collection, {})
+
+    def _wait(self) -> None:
+        with self._lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _apply(self, collection: str, doc_id: str, data: Dict[str, Any], merge: bool) -> None:
+        with self._lock:
+            docs = self._docs(collection)
+            current = dict(docs.get(doc_id) or {}) if merge else {}
+            for key, value in data.items():
+                current[key] = _resolve_value(current.get(key), value)
+            docs[doc_id] = current
+
+
+# --- Gemini ---
+
+class _FakeGeminiResponse:
+    def __init__(self, text: str):
+        self.text = text
+
+
+class FakeGeminiModel:
+    """
+    generate_content_async だけを持つ Gemini モデルのスタブ。
+    latency 秒待ってから、プロンプト内のコメント配列のうち
+    キーワードを含む要素の番号を JSON 配列で返す。
+    """
+
+    latency = 0.5
+    calls = 0
+
+    def __init__(self, model_name: str = "", **kwargs: Any):
+        self.model_name = model_name
+
+    async def generate_content_async(self, prompt: str, stream: bool = False) -> Any:
+        type(self).calls += 1
+        keyword_match = re.search(r'tの値に"(.*?)"に似た言葉', prompt)
+        keyword = keyword_match.group(1) if keyword_match else ""
+        records = json.loads(prompt.rsplit("【コメント配列】\n", 1)[1])
+        indices = [record["i"] for record in records if keyword and keyword in record["t"]]
+        text = json.dumps(indices)
+        if stream:
+            return self._stream(text)
+        await asyncio.sleep(self.latency)
+        return _FakeGeminiResponse(text)
+
+    async def _stream(self, text: str, pieces: int = 10):
+        # 出力を pieces 個の断片に分け、latency を均等に割り振って順に返す
+        size = max(1, -(-len(text) // pieces))
+        parts = [text[i:i + size] for i in range(0, len(text), size)]
+        for part in parts:
+            await asyncio.sleep(self.latency / len(parts))
+            yield _FakeGeminiResponse(part)
+
+
+# --- 差し込み ---
+
+def install(
+    youtube: YouTubeReplay,
+    firestore_db: FakeFirestore,
+    gemini_latency: float = 0.5,
+) -> None:
+    """代替実装を各サービスモジュールに差し込みます（api の import 前に呼ぶ）。"""
+    import firestore_service
+    import gemini_service
+    import youtube_service
+
+    firestore_service.set_client(firestore_db)
+    FakeGeminiModel.latency = gemini_latency
+    gemini_service.set_model_factory(FakeGeminiModel)
+    # lifespan の startup_client() は既存のクライアントを再利用する
+    youtube_service._client = youtube_service.create_client(youtube.transport())
+    os.environ.setdefault("YOUTUBE_API_KEY", "benchmark")
+    os.environ.setdefault("GEMINI_API_KEY", "benchmark")
@@ -0,0 +1,86 @@
+"""
+Firestore アクセス層の負荷テスト。
+
+Firestore の代わりに「1回あたり LATENCY 秒ブロックする」偽クライアントを差し込み、
+スレッドプールのサイズごとに同時リクエストのスループットとイベントループの遅延を測る。
+プールサイズに比例してスループットが伸び、ループの遅延が小さいままであることを確認する。
+
+実行方法 (backend ディレクトリで):
+    python -m benchmarks.firestore_pool
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import firestore_service
+
+
+class BlockingDocument:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.exists = True
+
+    def get(self, timeout=None):
+        time.sleep(self.latency)  # 同期SDKのネットワーク待ちを再現
+        return self
+
+    def to_dict(self):
+        return {"usage_count": 1, "is_pro": False}
+
+
+class BlockingClient:
+    def __init__(self, latency: float):
+        self.document_ref = BlockingDocument(latency)
+
+    def collection(self, name):
+        return self
+
+    def document(self, doc_id):
+        return self.document_ref
+
+
+async def _measure(pool_size: int, requests: int) -> dict:
+    firestore_service.init_executor(pool_size)
+
+    # イベントループの応答性（ハートビートの最大遅延）も同時に測る
+    lags = []
+    stop = asyncio.Event()
+
+    async def heartbeat():
+        while not stop.is_set():
+            start = time.perf_counter()
+            await asyncio.sleep(0.005)
+            lags.append(time.perf_counter() - start - 0.005)
+
+    beat = asyncio.create_task(heartbeat())
+    start = time.perf_counter()
+    await asyncio.gather(*(firestore_service.get_user(f"user-{i}") for i in range(requests)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await beat
+
+    return {
+        "pool_size": pool_size,
+        "requests": requests,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(requests / elapsed, 1),
+        "max_loop_lag_ms": round(max(lags) * 1000, 2) if lags else 0.0,
+    }
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0.05, help="1回の Firestore 呼び出しの遅延 (秒)")
+    parser.add_argument("--requests", type=int, default=128)
+    parser.add_argument("--pools", default="1,2,4,8,16,32")
+    args = parser.parse_args()
+
+    firestore_service.set_client(BlockingClient(args.latency))
+    for pool_size in (int(p) for p in args.pools.split(",")):
+        print(json.dumps(await _measure(pool_size, args.requests)))
+    firestore_service.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
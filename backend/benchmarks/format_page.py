@@ -0,0 +1,182 @@
+"""
+コメントページの デコード → 整形 → シリアライズ のマイクロベンチマーク。
+
+返信付きの合成 commentThreads レスポンス（1ページ = 100スレッド）を使い、
+従来の実装 (json + strptime/strftime + json.dumps) と現在の実装
+(orjson + 文字列切り出しの日付変換 + orjson) の1ページあたりの処理時間を比べる。
+両者の出力が同じであることも確認する。
+
+実行方法 (backend ディレクトリで):
+    python -m benchmarks.format_page
+"""
+import argparse
+import datetime
+import json
+import time
+
+import orjson
+
+import youtube_service
+
+
+def make_page(threads: int, replies: int, start: int = 0, full_resource: bool = False) -> bytes:
+    """
+    合成の commentThreads レスポンス。
+    full_resource=True なら、整形では使わない項目（etag・チャンネル情報・textOriginal など）も
+    実際の API と同じように含める（fields= による転送量削減の計測用）。
+    """
+    def snippet(n: int, parent: str = "") -> dict:
+        data = {
+            "authorDisplayName": f"@user{n}",
+            "publishedAt": f"2024-0{n % 9 + 1}-1{n % 10}T12:{n % 60:02d}:0{n % 10}Z",
+            "textDisplay": f"コメント本文 {n} です。とても面白い動画でした！ " * 3,
+            "likeCount": n % 50,
+        }
+        if full_resource:
+            data.update({
+                "channelId": "UCbenchmarkchannel0000001",
+                "videoId": "benchmark01",
+                "textOriginal": data["textDisplay"],
+                "authorProfileImageUrl": f"https://yt3.ggpht.com/ytc/profile-{n}=s48-c-k-c0x00ffffff-no-rj",
+                "authorChannelUrl": f"http://www.youtube.com/@user{n}",
+                "authorChannelId": {"value": f"UCuser{n:019d}"},
+                "canRate": True,
+                "viewerRating": "none",
+                "updatedAt": data["publishedAt"],
+            })
+            if parent:
+                data["parentId"] = parent
+        return data
+
+    def resource(kind: str, comment_id: str, body: dict) -> dict:
+        if not full_resource:
+            return {"id": comment_id, **body}
+        return {"kind": kind, "etag": f"etag-{comment_id}", "id": comment_id, **body}
+
+    items = []
+    for i in range(start, start + threads):
+        thread_snippet = {
+            "topLevelComment": resource("youtube#comment", f"comment-{i}", {"snippet": snippet(i)}),
+            "totalReplyCount": replies,
+        }
+        if full_resource:
+            thread_snippet.update(
+                {"channelId": "UCbenchmarkchannel0000001", "videoId": "benchmark01",
+                 "canReply": True, "isPublic": True}
+            )
+        item = resource("youtube#commentThread", f"comment-{i}", {"snippet": thread_snippet})
+        if replies:
+            item["replies"] = {
+                "comments": [
+                    resource(
+                        "youtube#comment", f"comment-{i}.{r}",
+                        {"snippet": snippet(i * 100 + r, parent=f"comment-{i}")},
+                    )
+                    for r in range(replies)
+                ]
+            }
+        items.append(item)
+    page = {"items": items, "nextPageToken": "NEXT"}
+    if full_resource:
+        page = {
+            "kind": "youtube#commentThreadListResponse",
+            "etag": "etag-page",
+            "nextPageToken": "NEXT",
+            "pageInfo": {"totalResults": threads, "resultsPerPage": threads},
+            "items": items,
+        }
+    return json.dumps(page, ensure_ascii=False).encode("utf-8")
+
+
+# --- 比較用: 変更前の実装 ---
+
+def legacy_format_comment_data(snippet_data: dict, is_reply: bool = False) -> dict:
+    if is_reply:
+        target_snippet = snippet_data.get("snippet", {})
+        reply_count = 0
+    else:
+        if "topLevelComment" in snippet_data:
+            target_snippet = snippet_data["topLevelComment"]["snippet"]
+        else:
+            target_snippet = snippet_data["snippet"]
+        reply_count = snippet_data.get("totalReplyCount", 0)
+
+    pubdate_str = target_snippet.get("publishedAt")
+    try:
+        pubdate = datetime.datetime.strptime(pubdate_str, "%Y-%m-%dT%H:%M:%SZ")
+        formatted_date = pubdate.strftime("%Y/%m/%d %H:%M:%S")
+    except (ValueError, TypeError):
+        formatted_date = pubdate_str
+
+    return {
+        "author": target_snippet.get("authorDisplayName"),
+        "date": formatted_date,
+        "text": target_snippet.get("textDisplay"),
+        "likes": target_snippet.get("likeCount", 0),
+        "totalReplies": reply_count,
+    }
+
+
+def legacy_pipeline(body: bytes) -> bytes:
+    resource = json.loads(body)
+    comments = []
+    for item in resource.get("items", []):
+        comment = legacy_format_comment_data(item["snippet"], is_reply=False)
+        replies = []
+        if "replies" in item and "comments" in item["replies"]:
+            for reply_info in item["replies"]["comments"]:
+                replies.append(legacy_format_comment_data(reply_info, is_reply=True))
+        comment["replies"] = replies
+        comments.append(comment)
+    return json.dumps(
+        {"status": "success", "comments": comments}, ensure_ascii=False
+    ).encode("utf-8")
+
+
+def current_pipeline(body: bytes) -> bytes:
+    resource = orjson.loads(body)
+    comments = [youtube_service.format_thread(item) for item in resource.get("items", [])]
+    return orjson.dumps({"status": "success", "comments": comments})
+
+
+def _bench(fn, body: bytes, rounds: int) -> float:
+    fn(body)  # ウォームアップ
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn(body)
+    return (time.perf_counter() - start) / rounds
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=100)
+    parser.add_argument("--replies", type=int, default=5)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    body = make_page(args.threads, args.replies)
+    # 現在の実装はコメント ID も返すので、それ以外の項目が一致することを確認する
+    current_output = orjson.loads(current_pipeline(body))
+    for comment in current_output["comments"]:
+        del comment["id"]
+        for reply in comment["replies"]:
+            del reply["id"]
+    assert json.loads(legacy_pipeline(body)) == current_output
+
+    legacy = _bench(legacy_pipeline, body, args.rounds)
+    current = _bench(current_pipeline, body, args.rounds)
+    print(json.dumps(
+        {
+            "page_bytes": len(body),
+            "threads": args.threads,
+            "replies_per_thread": args.replies,
+            "legacy_ms_per_page": round(legacy * 1000, 3),
+            "current_ms_per_page": round(current * 1000, 3),
+            "speedup": round(legacy / current, 2),
+        },
+        indent=2,
+    ))
+
+
+if __name__ == "__main__":
+    main()
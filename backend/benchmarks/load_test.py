@@ -0,0 +1,253 @@
+"""
+オフライン負荷テスト。
+
+api:app を ASGI でプロセス内に起動し、YouTube / Firestore / Gemini をローカルの代替実装
+(benchmarks/fakes.py) に差し替えた状態で、シナリオごとに同時リクエストを流す。
+スループットと p50/p95/p99 レイテンシを表示し、結果を JSON に保存する（実行間の比較用）。
+
+シナリオ:
+    comments     各仮想ユーザーが /api/comments を最終ページまでページングする
+    search       保存済みスナップショットに /api/search-comments (--search-mode) を投げる
+    user_status  /api/user/status
+
+実行方法 (backend ディレクトリで):
+    python -m benchmarks.load_test
+    python -m benchmarks.load_test --scenarios search --search-mode semantic --gemini-latency 1.0
+    python -m benchmarks.load_test --recordings path/to/pages  # 録画済み page_*.json を再生
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Tuple
+
+import httpx
+
+from benchmarks import fakes
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """線形補間なしの最近傍順位法 (nearest-rank) によるパーセンタイル"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, int(-(-q * len(sorted_values) // 100)))
+    return sorted_values[rank - 1]
+
+
+def summarize(name: str, samples: List[Tuple[float, int]], elapsed: float) -> Dict[str, Any]:
+    latencies = sorted(latency for latency, _ in samples)
+    statuses: Dict[str, int] = {}
+    for _, status_code in samples:
+        statuses[str(status_code)] = statuses.get(str(status_code), 0) + 1
+    errors = sum(count for code, count in statuses.items() if not code.startswith("2"))
+    return {
+        "scenario": name,
+        "requests": len(samples),
+        "errors": errors,
+        "status_codes": statuses,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(samples) / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {
+            "min": round(latencies[0] * 1000, 2) if latencies else 0.0,
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p95": round(percentile(latencies, 95) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2),
+            "max": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        },
+    }
+
+
+def _client(app: Any) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=60
+    )
+
+
+async def run_scenario(
+    name: str,
+    concurrency: int,
+    iterations: int,
+    session: Callable[[int, Callable[..., Awaitable[httpx.Response]]], Awaitable[None]],
+) -> Dict[str, Any]:
+    """
+    concurrency 人の仮想ユーザーが、それぞれ iterations 回 session を実行する。
+    session に渡す request() が1リクエストごとのレイテンシとステータスを記録する。
+    """
+    samples: List[Tuple[float, int]] = []
+
+    async def worker(user_number: int, client: httpx.AsyncClient) -> None:
+        async def request(method: str, url: str, **kwargs: Any) -> httpx.Response:
+            start = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            await response.aread()
+            samples.append((time.perf_counter() - start, response.status_code))
+            return response
+
+        for _ in range(iterations):
+            await session(user_number, request)
+
+    import api
+
+    async with _client(api.app) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(n, client) for n in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    return summarize(name, samples, elapsed)
+
+
+def auth_header(user_id: str) -> Dict[str, str]:
+    import api
+    from jose import jwt
+
+    token = jwt.encode({"sub": user_id}, api.SECRET_KEY, algorithm=api.ALGORITHM)
+    return {"Authorization": f"Bearer {token}"}
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+async def main(args: argparse.Namespace) -> Dict[str, Any]:
+    youtube = fakes.YouTubeReplay(
+        recordings_dir=args.recordings,
+        pages=args.pages,
+        threads_per_page=args.threads_per_page,
+        latency=args.youtube_latency,
+    )
+    firestore_db = fakes.FakeFirestore(latency=args.firestore_latency)
+    fakes.install(youtube, firestore_db, gemini_latency=args.gemini_latency)
+
+    import api
+    import youtube_service
+
+    users = [f"bench-user-{n}" for n in range(args.concurrency)]
+    for user_id in users:
+        # 無料枠の上限 (402) で止まらないよう Pro 会員として登録する
+        firestore_db.seed_user(user_id, is_pro=True)
+    headers = {user_id: auth_header(user_id) for user_id in users}
+
+    async def comments_session(n: int, request) -> None:
+        # 動画を分散させ、ページキャッシュのヒット率を --videos で調整できるようにする
+        video_id = f"video{n % args.videos:06d}"
+        page_token = None
+        while True:
+            params = {"video_id": video_id}
+            if page_token:
+                params["page_token"] = page_token
+            response = await request("GET", "/api/comments", params=params, headers=headers[users[n]])
+            if response.status_code != 200:
+                return
+            page_token = response.json().get("next_page_token")
+            if not page_token:
+                return
+
+    search_keywords = ["面白い", "動画", "コメント", "本文 4"]
+
+    async def search_session(n: int, request) -> None:
+        await request(
+            "POST",
+            "/api/search-comments",
+            json={
+                "keyword": search_keywords[n % len(search_keywords)],
+                "video_id": "search-video",
+                "mode": args.search_mode,
+            },
+            headers=headers[users[n]],
+        )
+
+    async def user_status_session(n: int, request) -> None:
+        await request("GET", "/api/user/status", headers=headers[users[n]])
+
+    scenarios = {
+        "comments": comments_session,
+        "search": search_session,
+        "user_status": user_status_session,
+    }
+
+    results = []
+    async with api.app.router.lifespan_context(api.app):
+        if "search" in args.scenarios:
+            # 検索対象のスナップショットを用意する（サーバー側で YouTube の全ページを取得）
+            async with _client(api.app) as client:
+                response = await client.get(
+                    "/api/comments/stream",
+                    params={"video_id": "search-video"},
+                    headers=headers[users[0]],
+                )
+                response.raise_for_status()
+
+        for name in args.scenarios:
+            youtube_service.page_cache.clear()
+            result = await run_scenario(name, args.concurrency, args.iterations, scenarios[name])
+            results.append(result)
+            print(json.dumps(result, ensure_ascii=False))
+
+        async with _client(api.app) as client:
+            stats = (await client.get("/api/stats")).json()
+
+    return {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "git_revision": _git_revision(),
+        "python": platform.python_version(),
+        "config": {
+            key: value for key, value in vars(args).items() if key != "output"
+        },
+        "stand_in_calls": {
+            "youtube": youtube.calls,
+            "firestore": firestore_db.calls,
+            "firestore_batch_commits": firestore_db.batch_commits,
+            "gemini": fakes.FakeGeminiModel.calls,
+        },
+        "results": results,
+        "server_stats": stats,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", default=["comments", "search", "user_status"],
+                        choices=["comments", "search", "user_status"])
+    parser.add_argument("--concurrency", type=int, default=20, help="仮想ユーザー数")
+    parser.add_argument("--iterations", type=int, default=10, help="仮想ユーザーごとのセッション回数")
+    parser.add_argument("--videos", type=int, default=4, help="comments シナリオで使う動画数")
+    parser.add_argument("--search-mode", default="local",
+                        choices=["local", "exact", "fuzzy", "vector", "semantic"])
+    parser.add_argument("--recordings", help="録画済み commentThreads レスポンス (page_*.json) のディレクトリ")
+    parser.add_argument("--pages", type=int, default=5, help="合成ページ数（録画を使わない場合）")
+    parser.add_argument("--threads-per-page", type=int, default=100)
+    parser.add_argument("--youtube-latency", type=float, default=0.05, help="YouTube 1リクエストの遅延 (秒)")
+    parser.add_argument("--firestore-latency", type=float, default=0.02, help="Firestore 1呼び出しの遅延 (秒)")
+    parser.add_argument("--gemini-latency", type=float, default=0.5, help="Gemini 1チャンクの遅延 (秒)")
+    parser.add_argument("--output", help="結果 JSON の保存先（省略時は benchmarks/results/ に日時付きで保存）")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    # 本番の保存先を汚さないよう、SQLite は一時ディレクトリに作る
+    data_dir = tempfile.mkdtemp(prefix="load_test_")
+    os.environ.setdefault("COMMENT_STORE_PATH", os.path.join(data_dir, "comments.db"))
+    os.environ.setdefault("WEBHOOK_QUEUE_PATH", os.path.join(data_dir, "webhooks.db"))
+    os.environ.setdefault("HARVEST_JOBS_PATH", os.path.join(data_dir, "harvest.db"))
+
+    report = asyncio.run(main(args))
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, time.strftime("load_%Y%m%d_%H%M%S.json")
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"saved: {output}")
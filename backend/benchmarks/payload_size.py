@@ -0,0 +1,135 @@
+"""
+1ページあたりの転送量の計測。
+
+上り (YouTube -> サーバー): fields= による部分レスポンスの有無で、commentThreads の応答サイズを比べる。
+下り (サーバー -> ブラウザ): /api/comments の応答サイズを、項目の絞り込み (fields=) と
+圧縮方式 (identity / gzip / br) の組み合わせごとに比べる。
+
+YouTube は benchmarks/fakes.py の代替実装（実際の API と同じ項目を含む合成ページ）を使う。
+部分レスポンスの有無で整形結果が変わらないことも確認する。
+
+実行方法 (backend ディレクトリで):
+    python -m benchmarks.payload_size
+    python -m benchmarks.payload_size --recordings path/to/pages  # 録画済み page_*.json を使う
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+from benchmarks import fakes
+from benchmarks.load_test import _client, auth_header
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+
+
+async def fetch_page(client: Any, headers: Dict[str, str], params: Dict[str, str],
+                     encoding: str) -> Dict[str, Any]:
+    response = await client.get(
+        "/api/comments", params=params, headers={**headers, "Accept-Encoding": encoding}
+    )
+    response.raise_for_status()
+    return {
+        # num_bytes_downloaded は圧縮後（転送時）のバイト数
+        "bytes": response.num_bytes_downloaded,
+        "content_encoding": response.headers.get("content-encoding", "identity"),
+        "body": response.json(),
+    }
+
+
+async def main(args: argparse.Namespace) -> Dict[str, Any]:
+    youtube = fakes.YouTubeReplay(
+        recordings_dir=args.recordings, pages=1,
+        threads_per_page=args.threads_per_page, latency=0,
+    )
+    firestore_db = fakes.FakeFirestore(latency=0)
+    fakes.install(youtube, firestore_db)
+
+    import api
+    import compression
+    import youtube_service
+
+    firestore_db.seed_user("bench-user", is_pro=True)
+    headers = auth_header("bench-user")
+
+    upstream: Dict[str, Any] = {}
+    formatted: Dict[str, Any] = {}
+    async with api.app.router.lifespan_context(api.app):
+        # --- 上り ---
+        for partial in (False, True):
+            youtube_service.PARTIAL_RESPONSE = partial
+            youtube_service.page_cache.clear()
+            before = youtube.bytes_sent
+            page = await youtube_service.fetch_comments_page("payload-video")
+            label = "partial" if partial else "full"
+            upstream[label] = youtube.bytes_sent - before
+            formatted[label] = page["comments"]
+        if formatted["full"] != formatted["partial"]:
+            raise AssertionError("partial response changed the formatted comments")
+
+        # --- 下り ---
+        encodings = ["identity", "gzip"] + (["br"] if compression.brotli is not None else [])
+        projections: List[Optional[str]] = [None] + args.fields
+        downstream = []
+        async with _client(api.app) as client:
+            for fields in projections:
+                params = {"video_id": "payload-video"}
+                if fields:
+                    params["fields"] = fields
+                for encoding in encodings:
+                    result = await fetch_page(client, headers, params, encoding)
+                    downstream.append({
+                        "fields": fields or "(all)",
+                        "accept_encoding": encoding,
+                        "content_encoding": result["content_encoding"],
+                        "bytes": result["bytes"],
+                    })
+
+    baseline = downstream[0]["bytes"]
+    for row in downstream:
+        row["ratio"] = round(row["bytes"] / baseline, 3)
+
+    return {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "threads_per_page": len(formatted["full"]),
+        "upstream_bytes_per_page": {
+            **upstream,
+            "ratio": round(upstream["partial"] / upstream["full"], 3),
+            "fields": youtube_service.COMMENT_THREADS_FIELDS,
+        },
+        "downstream_bytes_per_page": downstream,
+        "brotli_available": compression.brotli is not None,
+        "compression_min_size": compression.MIN_SIZE,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--recordings", help="録画済み commentThreads レスポンス (page_*.json) のディレクトリ")
+    parser.add_argument("--threads-per-page", type=int, default=100)
+    parser.add_argument("--fields", nargs="*", default=["author,text,likes", "text"],
+                        help="比較する /api/comments の fields= 指定")
+    parser.add_argument("--output", help="結果 JSON の保存先（省略時は benchmarks/results/ に日時付きで保存）")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    data_dir = tempfile.mkdtemp(prefix="payload_size_")
+    os.environ.setdefault("COMMENT_STORE_PATH", os.path.join(data_dir, "comments.db"))
+    os.environ.setdefault("WEBHOOK_QUEUE_PATH", os.path.join(data_dir, "webhooks.db"))
+    os.environ.setdefault("HARVEST_JOBS_PATH", os.path.join(data_dir, "harvest.db"))
+
+    report = asyncio.run(main(args))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, time.strftime("payload_%Y%m%d_%H%M%S.json")
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"saved: {output}")
@@ -0,0 +1,142 @@
+"""
+コールドスタートの計測。
+
+1. import 時間: 新しいプロセスで `import api` にかかる時間と、その時点で読み込まれている重い SDK
+2. 最初の1バイトまでの時間 (TTFB): uvicorn を起動してから GET /api/hello が最初に応答するまで
+
+それぞれ --runs 回計測して中央値などを表示し、結果を JSON に保存する（実行間の比較用）。
+外部サービスには接続しない（STARTUP_WARMUP=1 の場合のみ、起動後にバックグラウンドで接続を試みる）。
+
+実行方法 (backend ディレクトリで):
+    python -m benchmarks.startup
+    python -m benchmarks.startup --warmup   # STARTUP_WARMUP=1 で起動した場合
+"""
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+import httpx
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# import 時に読み込まれていないことを確認したいモジュール
+HEAVY_MODULES = (
+    "google.generativeai",
+    "stripe",
+    "firebase_admin",
+    "google.cloud.firestore",
+    "authlib.integrations.starlette_client",
+)
+
+_IMPORT_PROBE = f"""
+import json, sys, time
+start = time.perf_counter()
+import api
+elapsed = time.perf_counter() - start
+print(json.dumps({{
+    "import_s": elapsed,
+    "heavy_modules_loaded": [m for m in {HEAVY_MODULES!r} if m in sys.modules],
+}}))
+"""
+
+
+def _env(warmup: bool) -> Dict[str, str]:
+    env = dict(os.environ)
+    data_dir = tempfile.mkdtemp(prefix="startup_")
+    env["COMMENT_STORE_PATH"] = os.path.join(data_dir, "comments.db")
+    env["WEBHOOK_QUEUE_PATH"] = os.path.join(data_dir, "webhooks.db")
+    env["HARVEST_JOBS_PATH"] = os.path.join(data_dir, "harvest.db")
+    env["STARTUP_WARMUP"] = "1" if warmup else "0"
+    env["PYTHONWARNINGS"] = "ignore"
+    return env
+
+
+def measure_import(warmup: bool) -> Dict[str, Any]:
+    output = subprocess.run(
+        [sys.executable, "-c", _IMPORT_PROBE],
+        cwd=BACKEND_DIR, env=_env(warmup), capture_output=True, text=True, check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def measure_first_byte(warmup: bool, timeout: float = 60.0) -> float:
+    """プロセス起動から /api/hello の最初の応答までの秒数"""
+    port = _free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "api:app", "--host", "127.0.0.1", "--port", str(port)],
+        cwd=BACKEND_DIR, env=_env(warmup),
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    try:
+        with httpx.Client(timeout=1.0) as client:
+            while time.perf_counter() - start < timeout:
+                if process.poll() is not None:
+                    raise RuntimeError(f"uvicorn exited with {process.returncode}")
+                try:
+                    response = client.get(f"http://127.0.0.1:{port}/api/hello")
+                    if response.status_code == 200:
+                        return time.perf_counter() - start
+                except httpx.TransportError:
+                    pass
+                time.sleep(0.005)
+        raise TimeoutError("server did not respond")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def _summary(values: List[float]) -> Dict[str, float]:
+    return {
+        "median_ms": round(statistics.median(values) * 1000, 1),
+        "min_ms": round(min(values) * 1000, 1),
+        "max_ms": round(max(values) * 1000, 1),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--warmup", action="store_true", help="STARTUP_WARMUP=1 で起動する")
+    parser.add_argument("--output", help="結果 JSON の保存先（省略時は benchmarks/results/ に日時付きで保存）")
+    args = parser.parse_args()
+
+    imports = [measure_import(args.warmup) for _ in range(args.runs)]
+    first_bytes = [measure_first_byte(args.warmup) for _ in range(args.runs)]
+
+    report = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "runs": args.runs,
+        "startup_warmup": args.warmup,
+        "import_api": _summary([r["import_s"] for r in imports]),
+        "heavy_modules_loaded_at_import": imports[-1]["heavy_modules_loaded"],
+        "time_to_first_byte": _summary(first_bytes),
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+    output = args.output or os.path.join(
+        RESULTS_DIR, time.strftime("startup_%Y%m%d_%H%M%S.json")
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"saved: {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+# 未登録を表す番兵（None をキャッシュ値として扱えるようにするため）
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    サイズ上限付き LRU + エントリごとの TTL を持つインメモリキャッシュ。
+    get_or_load() では同一キーへの同時リクエストを1回の読み込みにまとめる (single-flight)。
+    ※ イベントループ上でのみ使う前提なのでロックは持たない
+    """
+
+    def __init__(self, max_entries: int = 1024, ttl: float = 300.0, name: str = "cache"):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.name = name
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.coalesced = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        value = self._lookup(key)
+        if value is _MISSING:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """統計（ヒット/ミス）を更新せずに値を参照します。"""
+        value = self._lookup(key)
+        return default if value is _MISSING else value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        """
+        エントリを削除します。進行中の読み込みがあればその結果も保存させない
+        （無効化より前に読んだ古い値が後から書き戻されるのを防ぐ）。
+        """
+        self._data.pop(key, None)
+        self._in_flight.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def _lookup(self, key: Hashable) -> Any:
+        entry = self._data.get(key)
+        if entry is None:
+            return _MISSING
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._data[key]
+            self.expirations += 1
+            return _MISSING
+        self._data.move_to_end(key)
+        return value
+
+    async def get_or_load(
+        self,
+        key: Hashable,
+        loader: Callable[[], Awaitable[Any]],
+        should_cache: Optional[Callable[[Any], bool]] = None,
+    ) -> Any:
+        """
+        キャッシュにあればそれを返し、なければ loader() を実行して保存します。
+        同じキーの読み込みが進行中なら、新たに呼ばずにその結果を待ちます。
+        should_cache が False を返した結果（エラー応答など）は保存しません。
+        """
+        value = self._lookup(key)
+        if value is not _MISSING:
+            self.hits += 1
+            return value
+
+        future = self._in_flight.get(key)
+        if future is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            future = asyncio.ensure_future(self._load(key, loader, should_cache))
+            self._in_flight[key] = future
+
+        # 待機側がキャンセルされても、読み込み自体は他の待機者のために継続させる
+        return await asyncio.shield(future)
+
+    async def _load(
+        self,
+        key: Hashable,
+        loader: Callable[[], Awaitable[Any]],
+        should_cache: Optional[Callable[[Any], bool]],
+    ) -> Any:
+        task = asyncio.current_task()
+        try:
+            value = await loader()
+            # 読み込み中に invalidate() された場合は保存しない
+            current = self._in_flight.get(key) is task
+            if current and (should_cache is None or should_cache(value)):
+                self.set(key, value)
+            return value
+        finally:
+            if self._in_flight.get(key) is task:
+                del self._in_flight[key]
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "entries": len(self._data),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "in_flight": len(self._in_flight),
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,375 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from cache import TTLCache
+
+# --- ★ サーバー側のコメント保存先 (SQLite) ---
+# 検索のたびにクライアントから全コメントを再送させないよう、動画ごとにスナップショットとして保持する
+STORE_PATH = os.getenv("COMMENT_STORE_PATH", "data/comments.db")
+# 動画ごとに保持するスナップショット数（古いものから削除）
+KEEP_SNAPSHOTS = int(os.getenv("COMMENT_STORE_KEEP_SNAPSHOTS", "3"))
+# クライアントがアップロードできるコメント数の上限（返信を含む）
+UPLOAD_MAX_COMMENTS = int(os.getenv("COMMENT_STORE_UPLOAD_MAX_COMMENTS", "50000"))
+
+# 読み込んだコメント配列のキャッシュ (snapshot_id, revision) -> List[dict]
+loaded_cache = TTLCache(
+    max_entries=int(os.getenv("COMMENT_STORE_CACHE_MAX_ENTRIES", "8")),
+    ttl=float(os.getenv("COMMENT_STORE_CACHE_TTL", "600")),
+    name="comment_store",
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    video_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    comment_count INTEGER NOT NULL DEFAULT 0,
+    revision INTEGER NOT NULL DEFAULT 0,
+    -- 'harvest': サーバーが YouTube から取得したもの / 'upload': クライアントがアップロードしたもの
+    source TEXT NOT NULL DEFAULT 'harvest',
+    owner_id TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_snapshots_video ON snapshots (video_id, id);
+CREATE TABLE IF NOT EXISTS comments (
+    snapshot_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    author TEXT,
+    date TEXT,
+    text TEXT,
+    likes INTEGER,
+    total_replies INTEGER,
+    replies TEXT,
+    comment_id TEXT,
+    PRIMARY KEY (snapshot_id, seq)
+) WITHOUT ROWID;
+-- 動画ごとの既知の最新コメント（差分取得でここまで遡ったら打ち切る）
+CREATE TABLE IF NOT EXISTS watermarks (
+    video_id TEXT PRIMARY KEY,
+    comment_id TEXT,
+    published_at TEXT,
+    updated_at REAL NOT NULL
+);
+"""
+
+_COMMENT_COLUMNS = "snapshot_id, seq, author, date, text, likes, total_replies, replies, comment_id"
+
+_conn: Optional[sqlite3.Connection] = None
+_lock = threading.Lock()
+
+
+def _connect() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        directory = os.path.dirname(STORE_PATH)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(STORE_PATH, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        # 旧バージョンで作成した DB には comment_id 列がないので追加する
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(comments)")}
+        if "comment_id" not in columns:
+            conn.execute("ALTER TABLE comments ADD COLUMN comment_id TEXT")
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(snapshots)")}
+        if "source" not in columns:
+            conn.execute("ALTER TABLE snapshots ADD COLUMN source TEXT NOT NULL DEFAULT 'harvest'")
+            conn.execute("ALTER TABLE snapshots ADD COLUMN owner_id TEXT")
+        _conn = conn
+    return _conn
+
+
+def close() -> None:
+    global _conn
+    with _lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
+
+
+def _snapshot_dict(row: Optional[sqlite3.Row]) -> Optional[Dict[str, Any]]:
+    return dict(row) if row is not None else None
+
+
+def _comment_row(snapshot_id: int, seq: int, comment: Dict[str, Any]) -> Tuple:
+    replies = comment.get("replies") or []
+    return (
+        snapshot_id,
+        seq,
+        comment.get("author"),
+        comment.get("date"),
+        comment.get("text"),
+        comment.get("likes", 0),
+        comment.get("totalReplies", 0),
+        json.dumps(replies, ensure_ascii=False, separators=(",", ":")) if replies else None,
+        comment.get("id"),
+    )
+
+
+def _insert_comments(conn: sqlite3.Connection, rows: List[Tuple]) -> None:
+    conn.executemany(
+        f"INSERT INTO comments ({_COMMENT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+    )
+
+
+def _update_watermark(conn: sqlite3.Connection, video_id: str, snapshot_id: int) -> None:
+    """スナップショットの先頭（最新）の ID 付きコメントを、その動画の watermark にする"""
+    row = conn.execute(
+        "SELECT comment_id, date FROM comments WHERE snapshot_id = ? AND comment_id IS NOT NULL ORDER BY seq LIMIT 1",
+        (snapshot_id,),
+    ).fetchone()
+    if row is None:
+        return
+    conn.execute(
+        "INSERT INTO watermarks (video_id, comment_id, published_at, updated_at) VALUES (?, ?, ?, ?) "
+        "ON CONFLICT(video_id) DO UPDATE SET comment_id = excluded.comment_id, "
+        "published_at = excluded.published_at, updated_at = excluded.updated_at",
+        (video_id, row["comment_id"], row["date"], time.time()),
+    )
+
+
+# --- 同期 API（スレッドから呼ぶ） ---
+
+def create_snapshot(video_id: str, source: str = "harvest", owner_id: Optional[str] = None) -> int:
+    now = time.time()
+    with _lock:
+        conn = _connect()
+        cur = conn.execute(
+            "INSERT INTO snapshots (video_id, status, source, owner_id, created_at, updated_at) "
+            "VALUES (?, 'building', ?, ?, ?, ?)",
+            (video_id, source, owner_id, now, now),
+        )
+        conn.commit()
+        return cur.lastrowid
+
+
+def append_comments(snapshot_id: int, comments: Iterable[Dict[str, Any]]) -> int:
+    """スナップショットの末尾にコメントを追加し、追加後の件数を返す"""
+    with _lock:
+        conn = _connect()
+        (count,) = conn.execute(
+            "SELECT comment_count FROM snapshots WHERE id = ?", (snapshot_id,)
+        ).fetchone()
+        # 差分で先頭に追加された行は負の seq を持つため、件数ではなく最大値の次から振る
+        (next_seq,) = conn.execute(
+            "SELECT COALESCE(MAX(seq) + 1, 0) FROM comments WHERE snapshot_id = ?", (snapshot_id,)
+        ).fetchone()
+        rows = [
+            _comment_row(snapshot_id, next_seq + offset, comment)
+            for offset, comment in enumerate(comments)
+            if isinstance(comment, dict)
+        ]
+        _insert_comments(conn, rows)
+        conn.execute(
+            "UPDATE snapshots SET comment_count = ?, updated_at = ? WHERE id = ?",
+            (count + len(rows), time.time(), snapshot_id),
+        )
+        conn.commit()
+        return count + len(rows)
+
+
+def truncate_comments(snapshot_id: int, count: int) -> int:
+    """
+    作成途中のスナップショットを先頭 count 件に戻し、削除した件数を返す。
+    チェックポイント後に追加された（記録が間に合わなかった）コメントを捨てて再開するために使う。
+    ※ append_comments だけで作ったスナップショット (seq が 0 から連番) が対象
+    """
+    with _lock:
+        conn = _connect()
+        cur = conn.execute(
+            "DELETE FROM comments WHERE snapshot_id = ? AND seq >= ?", (snapshot_id, count)
+        )
+        conn.execute(
+            "UPDATE snapshots SET comment_count = ?, updated_at = ? WHERE id = ?",
+            (count, time.time(), snapshot_id),
+        )
+        conn.commit()
+        return cur.rowcount
+
+
+def finish_snapshot(snapshot_id: int) -> None:
+    """
+    スナップショットを完成扱いにし、同じ動画の古いスナップショットを削除する。
+    サーバーが取得したものは watermark を更新し、古い取得結果を削除する。
+    アップロードされたものは watermark に触れず、同じ利用者の古いアップロードだけを削除する。
+    """
+    with _lock:
+        conn = _connect()
+        conn.execute(
+            "UPDATE snapshots SET status = 'complete', updated_at = ? WHERE id = ?",
+            (time.time(), snapshot_id),
+        )
+        video_id, source, owner_id = conn.execute(
+            "SELECT video_id, source, owner_id FROM snapshots WHERE id = ?", (snapshot_id,)
+        ).fetchone()
+        if source == "harvest":
+            _update_watermark(conn, video_id, snapshot_id)
+        stale = [
+            row["id"]
+            for row in conn.execute(
+                "SELECT id FROM snapshots WHERE video_id = ? AND status = 'complete' AND source = ? "
+                "AND owner_id IS ? ORDER BY id DESC LIMIT -1 OFFSET ?",
+                (video_id, source, owner_id, KEEP_SNAPSHOTS),
+            )
+        ]
+        for stale_id in stale:
+            conn.execute("DELETE FROM comments WHERE snapshot_id = ?", (stale_id,))
+            conn.execute("DELETE FROM snapshots WHERE id = ?", (stale_id,))
+        conn.commit()
+
+
+def discard_snapshot(snapshot_id: int) -> None:
+    """作成途中のスナップショットを削除する（完成済みのものは消さない）"""
+    with _lock:
+        conn = _connect()
+        cur = conn.execute(
+            "DELETE FROM snapshots WHERE id = ? AND status = 'building'", (snapshot_id,)
+        )
+        if cur.rowcount:
+            conn.execute("DELETE FROM comments WHERE snapshot_id = ?", (snapshot_id,))
+        conn.commit()
+
+
+def save_upload(video_id: str, owner_id: str, comments: List[Dict[str, Any]]) -> int:
+    """クライアントがアップロードしたコメントを、その利用者のスナップショットとして保存する"""
+    snapshot_id = create_snapshot(video_id, source="upload", owner_id=owner_id)
+    append_comments(snapshot_id, comments)
+    finish_snapshot(snapshot_id)
+    return snapshot_id
+
+
+def prepend_comments(snapshot_id: int, comments: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    差分取得した新着コメント（新しい順）を完成済みスナップショットの先頭に追加し、
+    revision を上げて watermark を更新します。既に保存済みの ID は追加しません。
+    更新後のスナップショットに、実際に追加したコメントの一覧 ("added") を付けて返します。
+    """
+    with _lock:
+        conn = _connect()
+        snapshot = conn.execute(
+            "SELECT * FROM snapshots WHERE id = ?", (snapshot_id,)
+        ).fetchone()
+        ids = [c.get("id") for c in comments if isinstance(c, dict) and c.get("id")]
+        known = set()
+        # SQLite のパラメータ数上限を超えないよう分割して照会する
+        for start in range(0, len(ids), 500):
+            chunk = ids[start : start + 500]
+            known.update(
+                row["comment_id"]
+                for row in conn.execute(
+                    f"SELECT comment_id FROM comments WHERE snapshot_id = ? AND comment_id IN ({','.join('?' * len(chunk))})",
+                    (snapshot_id, *chunk),
+                )
+            )
+        new_comments = [
+            c for c in comments if isinstance(c, dict) and c.get("id") not in known
+        ]
+        if new_comments:
+            (min_seq,) = conn.execute(
+                "SELECT COALESCE(MIN(seq), 0) FROM comments WHERE snapshot_id = ?", (snapshot_id,)
+            ).fetchone()
+            first_seq = min_seq - len(new_comments)
+            _insert_comments(
+                conn,
+                [
+                    _comment_row(snapshot_id, first_seq + offset, comment)
+                    for offset, comment in enumerate(new_comments)
+                ],
+            )
+            conn.execute(
+                "UPDATE snapshots SET comment_count = comment_count + ?, revision = revision + 1, updated_at = ? WHERE id = ?",
+                (len(new_comments), time.time(), snapshot_id),
+            )
+        _update_watermark(conn, snapshot["video_id"], snapshot_id)
+        conn.commit()
+        row = conn.execute("SELECT * FROM snapshots WHERE id = ?", (snapshot_id,)).fetchone()
+    result = dict(row)
+    result["added"] = new_comments
+    return result
+
+
+def get_watermark(video_id: str) -> Optional[Dict[str, Any]]:
+    """動画の既知の最新コメント {comment_id, published_at, updated_at}（未取得なら None）"""
+    with _lock:
+        row = _connect().execute(
+            "SELECT comment_id, published_at, updated_at FROM watermarks WHERE video_id = ?",
+            (video_id,),
+        ).fetchone()
+    return _snapshot_dict(row)
+
+
+def get_snapshot(snapshot_id: int) -> Optional[Dict[str, Any]]:
+    with _lock:
+        row = _connect().execute(
+            "SELECT * FROM snapshots WHERE id = ?", (snapshot_id,)
+        ).fetchone()
+    return _snapshot_dict(row)
+
+
+def list_snapshots(video_id: str) -> List[Dict[str, Any]]:
+    """サーバーが取得した完成済みスナップショット（新しい順）。アップロードは含めない"""
+    with _lock:
+        rows = _connect().execute(
+            "SELECT * FROM snapshots WHERE video_id = ? AND status = 'complete' AND source = 'harvest' "
+            "ORDER BY id DESC",
+            (video_id,),
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def resolve_snapshot(
+    video_id: str, snapshot_id: Optional[int] = None, user_id: Optional[str] = None
+) -> Optional[Dict[str, Any]]:
+    """
+    指定スナップショット（省略時はサーバーが取得した最新の完成済みスナップショット）を返す。
+    別の動画のものや作成途中のものは None。アップロードされたものは ID を指定したときだけ使い、
+    アップロードした本人 (user_id) 以外には存在しないものとして None を返す。
+    """
+    if snapshot_id is None:
+        snapshots = list_snapshots(video_id)
+        return snapshots[0] if snapshots else None
+    snapshot = get_snapshot(snapshot_id)
+    if snapshot is None or snapshot["video_id"] != video_id or snapshot["status"] != "complete":
+        return None
+    if snapshot["source"] == "upload" and (user_id is None or snapshot["owner_id"] != user_id):
+        return None
+    return snapshot
+
+
+def load_comments(snapshot_id: int) -> List[Dict[str, Any]]:
+    """スナップショットのコメントを format_comment_data と同じ形の辞書で返す"""
+    with _lock:
+        rows = _connect().execute(
+            "SELECT comment_id, author, date, text, likes, total_replies, replies FROM comments WHERE snapshot_id = ? ORDER BY seq",
+            (snapshot_id,),
+        ).fetchall()
+    return [
+        {
+            "id": comment_id,
+            "author": author,
+            "date": date,
+            "text": text,
+            "likes": likes,
+            "totalReplies": total_replies,
+            "replies": json.loads(replies) if replies else [],
+        }
+        for comment_id, author, date, text, likes, total_replies, replies in rows
+    ]
+
+
+# --- 非同期 API（イベントループをブロックしないようスレッドで実行） ---
+
+async def get_comments(snapshot: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """スナップショットのコメントを返す（同じ版ならメモリ上のキャッシュを再利用）"""
+    key = (snapshot["id"], snapshot["revision"])
+    return await loaded_cache.get_or_load(
+        key, lambda: asyncio.to_thread(load_comments, snapshot["id"])
+    )
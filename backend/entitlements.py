@@ -0,0 +1,63 @@
+import os
+from typing import Any, Dict
+
+import firestore_service
+from cache import TTLCache
+from usage_counter import usage_counter
+
+# --- ★ 利用権限 (is_pro / usage_count) のインメモリキャッシュ ---
+# /api/comments と /api/user/status のたびに Firestore を読まないよう、短い TTL で保持する。
+# Stripe Webhook で Pro 状態が変わった時は明示的に無効化する。
+ENTITLEMENT_CACHE_TTL = float(os.getenv("ENTITLEMENT_CACHE_TTL", "30"))
+ENTITLEMENT_CACHE_MAX_ENTRIES = int(os.getenv("ENTITLEMENT_CACHE_MAX_ENTRIES", "10000"))
+
+# 無料版で利用できる回数
+FREE_USAGE_LIMIT = int(os.getenv("FREE_USAGE_LIMIT", "4"))
+
+entitlement_cache = TTLCache(
+    max_entries=ENTITLEMENT_CACHE_MAX_ENTRIES,
+    ttl=ENTITLEMENT_CACHE_TTL,
+    name="entitlements",
+)
+
+
+async def _load_entitlement(user_id: str) -> Dict[str, Any]:
+    user_data = await firestore_service.get_user(user_id) or {}
+    return {
+        # まだ書き込まれていないバッファ分も含めて制限を判定する
+        "usage_count": user_data.get("usage_count", 0)
+        + usage_counter.pending_count(user_id),
+        "is_pro": user_data.get("is_pro", False),
+    }
+
+
+async def get_entitlement(user_id: str) -> Dict[str, Any]:
+    """
+    ユーザーの {usage_count, is_pro} を返します。
+    キャッシュになければ Firestore から読み込みます（同時リクエストは1回の読み込みにまとめる）。
+    """
+    return await entitlement_cache.get_or_load(
+        user_id, lambda: _load_entitlement(user_id)
+    )
+
+
+def is_over_limit(entitlement: Dict[str, Any], count: int = 1) -> bool:
+    """さらに count 回利用すると無料版の利用回数制限を超えるかどうか（Pro は常に False）"""
+    if entitlement["is_pro"]:
+        return False
+    return entitlement["usage_count"] + count > FREE_USAGE_LIMIT
+
+
+def record_usage(user_id: str, count: int = 1) -> None:
+    """
+    利用回数をキャッシュ上で先に加算します (楽観的更新)。
+    Firestore への書き込みはバックグラウンドで別途行われます。
+    """
+    entitlement = entitlement_cache.peek(user_id)
+    if entitlement is not None:
+        entitlement["usage_count"] += count
+
+
+def invalidate(user_id: str) -> None:
+    """Pro 状態の変更時などに、次回アクセスで Firestore から読み直させます。"""
+    entitlement_cache.invalidate(user_id)
@@ -0,0 +1,266 @@
+import asyncio
+import functools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import metrics
+
+# --- ★ Firestore アクセス層 ---
+# Firestore SDK は同期APIのため、async ハンドラ内で直接呼ぶとイベントループ全体が止まる。
+# すべての呼び出しを専用のスレッドプールで実行し、タイムアウトを設ける。
+MAX_WORKERS = int(os.getenv("FIRESTORE_MAX_WORKERS", "16"))
+TIMEOUT = float(os.getenv("FIRESTORE_TIMEOUT", "10"))
+CREDENTIALS_PATH = os.getenv("FIREBASE_CREDENTIALS", "serviceAccountKey.json")
+
+_executor: Optional[ThreadPoolExecutor] = None
+_db: Any = None
+_db_lock = threading.Lock()
+
+
+def _firestore() -> Any:
+    # ★ firebase_admin / google-cloud-firestore は重い (数百ms) ので初回使用時に読み込む
+    from firebase_admin import firestore
+
+    return firestore
+
+
+class _ServerTimestamp:
+    """firestore.SERVER_TIMESTAMP の代わり。SDK を読み込まずに作れ、書き込み時（プール内）に置き換える"""
+
+    def __repr__(self) -> str:
+        return "SERVER_TIMESTAMP"
+
+
+_SERVER_TIMESTAMP = _ServerTimestamp()
+
+
+def server_timestamp() -> Any:
+    """サーバー時刻の値を返します（書き込み時に firestore.SERVER_TIMESTAMP に置き換わる）"""
+    return _SERVER_TIMESTAMP
+
+
+def _resolve(data: Dict[str, Any]) -> Dict[str, Any]:
+    # プールのスレッド内で呼ぶ（SDK の読み込みがイベントループで起きないように）
+    if not any(value is _SERVER_TIMESTAMP for value in data.values()):
+        return data
+    timestamp = _firestore().SERVER_TIMESTAMP
+    return {
+        key: timestamp if value is _SERVER_TIMESTAMP else value for key, value in data.items()
+    }
+
+
+def init_executor(max_workers: int = MAX_WORKERS) -> ThreadPoolExecutor:
+    """スレッドプールを（再）作成します。プールサイズ = Firestore への最大同時リクエスト数"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+    _executor = ThreadPoolExecutor(
+        max_workers=max_workers, thread_name_prefix="firestore"
+    )
+    return _executor
+
+
+def get_pool_stats() -> Dict[str, Any]:
+    """スレッドプールの状況（待ち行列が伸びていればプール不足）"""
+    if _executor is None:
+        return {"started": False, "max_workers": 0, "threads": 0, "queued": 0}
+    return {
+        "started": True,
+        "max_workers": _executor._max_workers,
+        "threads": len(_executor._threads),
+        "queued": _executor._work_queue.qsize(),
+    }
+
+
+def shutdown() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+
+def get_db() -> Any:
+    """
+    Firestore クライアントを返します（初回のみ Firebase Admin を初期化）。
+    プールの複数スレッドから同時に呼ばれても初期化は1回だけ行う。
+    """
+    global _db
+    if _db is not None:
+        return _db
+    with _db_lock:
+        if _db is None:
+            import firebase_admin
+            from firebase_admin import credentials
+
+            if not firebase_admin._apps:
+                try:
+                    cred = credentials.Certificate(CREDENTIALS_PATH)
+                    firebase_admin.initialize_app(cred)
+                    print("Firebase Admin Initialized successfully.")
+                except Exception as e:
+                    print(f"Firebase Init Error: {e}")
+            _db = _firestore().client()
+    return _db
+
+
+async def warmup() -> None:
+    """SDK の読み込みとクライアント生成を事前に済ませます（lifespan から任意で呼ぶ）"""
+    await run(get_db)
+
+
+def set_client(db: Any) -> None:
+    """テスト・ベンチマーク用に Firestore クライアントを差し替えます。"""
+    global _db
+    _db = db
+
+
+async def run(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """同期関数を Firestore 専用プールで実行し、TIMEOUT 秒で打ち切ります。"""
+    executor = _executor or init_executor()
+    loop = asyncio.get_running_loop()
+    # ★ プールの待ち時間も含めて計測する（"_get_user_sync" -> "get_user"）
+    operation = getattr(fn, "__name__", "call").strip("_").removesuffix("_sync")
+    with metrics.upstream("firestore", operation):
+        future = loop.run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+        return await asyncio.wait_for(future, TIMEOUT)
+
+
+def _user_ref(user_id: str) -> Any:
+    return get_db().collection("users").document(user_id)
+
+
+# --- users コレクションの操作 ---
+
+def _get_user_sync(user_id: str) -> Optional[Dict[str, Any]]:
+    doc = _user_ref(user_id).get(timeout=TIMEOUT)
+    return doc.to_dict() if doc.exists else None
+
+
+async def get_user(user_id: str) -> Optional[Dict[str, Any]]:
+    """ユーザードキュメントを辞書で返します（存在しなければ None）"""
+    return await run(_get_user_sync, user_id)
+
+
+def _set_user_sync(user_id: str, data: Dict[str, Any], merge: bool) -> None:
+    _user_ref(user_id).set(_resolve(data), merge=merge, timeout=TIMEOUT)
+
+
+async def set_user(user_id: str, data: Dict[str, Any], merge: bool = False) -> None:
+    await run(_set_user_sync, user_id, data, merge)
+
+
+def _update_user_sync(user_id: str, data: Dict[str, Any]) -> None:
+    _user_ref(user_id).update(_resolve(data), timeout=TIMEOUT)
+
+
+async def update_user(user_id: str, data: Dict[str, Any]) -> None:
+    await run(_update_user_sync, user_id, data)
+
+
+# Firestore の WriteBatch は1回あたり最大500件
+BATCH_LIMIT = 500
+
+
+def _increment_usage_batch_sync(counts: Dict[str, int]) -> None:
+    db = get_db()
+    firestore = _firestore()
+    items = list(counts.items())
+    for start in range(0, len(items), BATCH_LIMIT):
+        batch = db.batch()
+        for user_id, count in items[start : start + BATCH_LIMIT]:
+            # merge=True の set なので、ドキュメントがなければ作成される (upsert)
+            # ※ is_pro は上書きしない（未設定は無料会員として扱われる）
+            batch.set(
+                _user_ref(user_id),
+                {
+                    "usage_count": firestore.Increment(count),
+                    "last_updated": firestore.SERVER_TIMESTAMP,
+                },
+                merge=True,
+            )
+        batch.commit(timeout=TIMEOUT)
+
+
+async def increment_usage_batch(counts: Dict[str, int]) -> None:
+    """複数ユーザーの利用回数をまとめて加算します ({user_id: 加算数})"""
+    await run(_increment_usage_batch_sync, counts)
+
+
+def _save_login_user_sync(user_id: str, profile: Dict[str, Any]) -> bool:
+    user_ref = _user_ref(user_id)
+    doc = user_ref.get(timeout=TIMEOUT)
+
+    if not doc.exists:
+        # 【新規ユーザーの場合】
+        # is_pro や usage_count など、アプリ動作に必要な初期値を含めて作成する
+        new_user_data = profile.copy()
+        new_user_data.update({
+            "is_pro": False,          # ★ 最初は無料会員
+            "usage_count": 0,         # ★ 使用回数0
+            "created_at": server_timestamp(),
+            "updated_at": server_timestamp(),
+            "stripe_customer_id": None
+        })
+        user_ref.set(_resolve(new_user_data), timeout=TIMEOUT)
+        return True
+
+    # 【既存ユーザーの場合】
+    # is_pro などの重要なフラグは上書きせず、プロフィールとログイン日時だけ更新する
+    user_ref.set(_resolve(profile), merge=True, timeout=TIMEOUT)
+    return False
+
+
+async def save_login_user(user_id: str, profile: Dict[str, Any]) -> bool:
+    """ログイン時のユーザー登録・更新。新規作成した場合 True を返します。"""
+    return await run(_save_login_user_sync, user_id, profile)
+
+
+def _find_user_ids_sync(field: str, value: Any) -> List[str]:
+    from google.cloud.firestore_v1.base_query import FieldFilter
+
+    query = get_db().collection("users").where(filter=FieldFilter(field, "==", value))
+    return [doc.id for doc in query.stream(timeout=TIMEOUT)]
+
+
+async def find_user_ids(field: str, value: Any) -> List[str]:
+    """field == value のユーザーID一覧を返します。"""
+    return await run(_find_user_ids_sync, field, value)
+
+
+# --- stripe_customers コレクション (Stripe 顧客ID → ユーザーID の逆引き) ---
+
+def _customer_ref(stripe_customer_id: str) -> Any:
+    return get_db().collection("stripe_customers").document(stripe_customer_id)
+
+
+def _set_stripe_customer_sync(stripe_customer_id: str, user_id: str) -> None:
+    _customer_ref(stripe_customer_id).set(
+        {"user_id": user_id, "updated_at": _firestore().SERVER_TIMESTAMP}, timeout=TIMEOUT
+    )
+
+
+async def set_stripe_customer(stripe_customer_id: str, user_id: str) -> None:
+    await run(_set_stripe_customer_sync, stripe_customer_id, user_id)
+
+
+def _get_stripe_customer_user_sync(stripe_customer_id: str) -> Optional[str]:
+    doc = _customer_ref(stripe_customer_id).get(timeout=TIMEOUT)
+    return (doc.to_dict() or {}).get("user_id") if doc.exists else None
+
+
+async def find_user_ids_by_stripe_customer(stripe_customer_id: str) -> List[str]:
+    """
+    Stripe 顧客IDに対応するユーザーIDを返します。
+    逆引きドキュメントを1件読むだけで済み、未登録（逆引き導入前の顧客）の場合のみ
+    users をクエリして逆引きを補完します。
+    """
+    user_id = await run(_get_stripe_customer_user_sync, stripe_customer_id)
+    if user_id:
+        return [user_id]
+
+    user_ids = await find_user_ids("stripe_customer_id", stripe_customer_id)
+    if len(user_ids) == 1:
+        await set_stripe_customer(stripe_customer_id, user_ids[0])
+    return user_ids
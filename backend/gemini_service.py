@@ -0,0 +1,370 @@
+import asyncio
+import json
+import os
+import threading
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Sequence, Tuple
+
+import metrics
+from cache import TTLCache
+from search_service import comments_digest, normalize
+
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+
+# --- ★ Map-Reduce 検索の設定 ---
+# 全コメントをトークン予算ごとのチャンクに分け、チャンク単位で並列に問い合わせる
+CHUNK_TOKEN_BUDGET = int(os.getenv("GEMINI_CHUNK_TOKEN_BUDGET", "30000"))
+MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))
+# 1回の検索で問い合わせるチャンク数の上限（保存済みスナップショット全体への検索でも
+# Gemini の呼び出し回数が際限なく増えないようにする）
+MAX_CHUNKS = int(os.getenv("GEMINI_MAX_CHUNKS", "8"))
+# 1レコードあたりの JSON の括弧・キー等のオーバーヘッド（トークン概算）
+RECORD_OVERHEAD_TOKENS = 8
+
+_semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+
+# --- ★ 検索結果のキャッシュ ---
+# (モデル, 正規化したキーワード, コメント集合の内容ハッシュ) -> 解析済みの結果
+# 同じ動画で同じ（表記ゆれ程度の）キーワードを繰り返し検索しても Gemini は1回だけ呼ぶ
+result_cache = TTLCache(
+    max_entries=int(os.getenv("GEMINI_RESULT_CACHE_MAX_ENTRIES", "256")),
+    ttl=float(os.getenv("GEMINI_RESULT_CACHE_TTL", "3600")),
+    name="gemini_results",
+)
+
+# ★ google.generativeai は読み込みに1秒近くかかるため、初回の意味検索（または warmup）まで遅らせる
+_genai: Any = None
+_genai_lock = threading.Lock()
+# テスト・ベンチマーク用にモデルの生成関数を差し替える場合に設定する
+_model_factory: Optional[Callable[[str], Any]] = None
+
+
+def get_genai() -> Any:
+    """google.generativeai を読み込み、API キーを設定して返します（初回のみ）"""
+    global _genai
+    if _genai is None:
+        with _genai_lock:
+            if _genai is None:
+                import google.generativeai as genai
+
+                api_key = os.getenv("GEMINI_API_KEY")
+                if api_key:
+                    genai.configure(api_key=api_key)
+                _genai = genai
+    return _genai
+
+
+def set_model_factory(factory: Optional[Callable[[str], Any]]) -> None:
+    """テスト・ベンチマーク用に GenerativeModel を差し替えます。"""
+    global _model_factory
+    _model_factory = factory
+
+
+async def warmup() -> None:
+    """SDK の読み込みを事前に済ませます（lifespan から任意で呼ぶ）"""
+    await asyncio.to_thread(get_genai)
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    トークン数の概算。日本語はほぼ1文字1トークンなので文字数をそのまま使う
+    （英語では過大評価になるが、予算超過を防ぐ安全側の見積もり）。
+    """
+    return len(text)
+
+
+def build_chunks(
+    comments: Sequence[Any], token_budget: Optional[int] = None
+) -> List[List[Tuple[int, str]]]:
+    """
+    コメントを (元の番号, text) のチャンクに分割します。
+    各チャンクは token_budget を超えないように詰め込みます（1件で超える場合は単独チャンク）。
+    """
+    token_budget = token_budget or CHUNK_TOKEN_BUDGET
+    chunks: List[List[Tuple[int, str]]] = []
+    current: List[Tuple[int, str]] = []
+    used = 0
+    for index, comment in enumerate(comments):
+        text = comment.get("text") if isinstance(comment, dict) else None
+        if not text:
+            continue
+        cost = estimate_tokens(text) + RECORD_OVERHEAD_TOKENS
+        if current and used + cost > token_budget:
+            chunks.append(current)
+            current, used = [], 0
+        current.append((index, text))
+        used += cost
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class TooManyChunksError(Exception):
+    """コメントが多すぎて、チャンク数が MAX_CHUNKS を超える"""
+
+    def __init__(self, chunks: int):
+        super().__init__(f"{chunks} chunks exceeds the limit of {MAX_CHUNKS}")
+        self.chunks = chunks
+
+
+def build_prompt(keyword: str, chunk: List[Tuple[int, str]]) -> str:
+    # インデント・空白を入れない最小限の {i, t} レコードだけを送る
+    records = json.dumps(
+        [{"i": index, "t": text} for index, text in chunk],
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return f"""以下の【コメント配列】の各要素は i(番号) と t(本文) を持ちます。
+tの値に"{keyword}"に似た言葉を含む要素の i だけを抽出してください。
+【制約事項】
+1. 結果は番号の JSON 配列 (例: [3,17,42]) のみを、説明文やマークダウン( ```json 等)を付けずに出力してください。
+2. 該当がなければ [] を出力してください。
+【コメント配列】
+{records}"""
+
+
+def parse_indices(result_text: str, chunk: List[Tuple[int, str]]) -> List[int]:
+    """モデル出力から番号の配列を取り出す（チャンク外の番号は捨てる）"""
+    cleaned = result_text.replace("```json", "").replace("```", "").strip()
+    parsed = json.loads(cleaned)
+    allowed = {index for index, _ in chunk}
+    indices = []
+    for value in (parsed if isinstance(parsed, list) else []):
+        # 念のためオブジェクト形式 ({"i": 3, ...}) で返ってきた場合も受け付ける
+        if isinstance(value, dict):
+            value = value.get("i")
+        if isinstance(value, int) and value in allowed:
+            indices.append(value)
+    return indices
+
+
+class IndexStreamParser:
+    """
+    モデル出力 ([3,17,42] 形式) を断片ごとに受け取り、確定した番号から順に返す逐次パーサー。
+    先頭の ```json などは "[" が現れるまで読み飛ばし、"]" 以降は無視する。
+    オブジェクト形式 ({"i": 3, ...}) の要素は閉じ括弧が来た時点で確定する。
+    """
+
+    def __init__(self) -> None:
+        self._state = "before"  # before -> array -> done
+        self._number = ""
+        self._object: Optional[List[str]] = None
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, text: str) -> List[int]:
+        found: List[int] = []
+        for ch in text:
+            if self._state == "done":
+                break
+            if self._object is not None:
+                self._feed_object(ch, found)
+            elif self._state == "before":
+                if ch == "[":
+                    self._state = "array"
+            elif ch.isdigit():
+                self._number += ch
+            else:
+                if self._number:
+                    found.append(int(self._number))
+                    self._number = ""
+                if ch == "{":
+                    self._object, self._depth = ["{"], 1
+                elif ch == "]":
+                    self._state = "done"
+        return found
+
+    def _feed_object(self, ch: str, found: List[int]) -> None:
+        self._object.append(ch)
+        if self._in_string:
+            if self._escaped:
+                self._escaped = False
+            elif ch == "\\":
+                self._escaped = True
+            elif ch == '"':
+                self._in_string = False
+            return
+        if ch == '"':
+            self._in_string = True
+        elif ch == "{":
+            self._depth += 1
+        elif ch == "}":
+            self._depth -= 1
+            if self._depth == 0:
+                try:
+                    value = json.loads("".join(self._object)).get("i")
+                except (ValueError, AttributeError):
+                    value = None
+                if isinstance(value, int):
+                    found.append(value)
+                self._object = None
+
+
+async def _search_chunk(
+    model: Any, keyword: str, chunk: List[Tuple[int, str]]
+) -> List[int]:
+    async with _semaphore:
+        with metrics.upstream("gemini", "generate_content"):
+            response = await model.generate_content_async(build_prompt(keyword, chunk))
+    return parse_indices(response.text, chunk)
+
+
+def result_cache_key(keyword: str, comments: Sequence[Any]) -> Tuple[str, str, str]:
+    # 全角/半角・大文字小文字・カタカナ/ひらがなの違いは同じ検索とみなす
+    return (GEMINI_MODEL, normalize(keyword), comments_digest(comments))
+
+
+SearchPlan = Tuple[Tuple[str, str, str], List[List[Tuple[int, str]]]]
+
+
+def _plan_search_sync(keyword: str, comments: Sequence[Any]) -> SearchPlan:
+    chunks = build_chunks(comments)
+    if len(chunks) > MAX_CHUNKS:
+        raise TooManyChunksError(len(chunks))
+    return result_cache_key(keyword, comments), chunks
+
+
+async def plan_search(keyword: str, comments: Sequence[Any]) -> SearchPlan:
+    """
+    結果キャッシュのキーとチャンク分割を (key, chunks) で返します。
+    10万件規模では内容ハッシュと分割に百数十ミリ秒かかるため、スレッドで行う。
+    チャンク数が MAX_CHUNKS を超える場合は TooManyChunksError（Gemini は呼ばない）。
+    """
+    return await asyncio.to_thread(_plan_search_sync, keyword, comments)
+
+
+async def search_comments(keyword: str, comments: Sequence[Any]) -> Dict[str, Any]:
+    """
+    全コメントを対象に Gemini で意味検索します (Map-Reduce)。
+    結果は正規化したキーワードとコメント集合の内容ハッシュでキャッシュし、
+    同じ検索が同時に来た場合は1回の問い合わせにまとめます。
+    一部のチャンクが失敗した結果はキャッシュしません。
+    """
+    key, chunks = await plan_search(keyword, comments)
+    return await result_cache.get_or_load(
+        key,
+        lambda: _search_chunks(keyword, chunks),
+        should_cache=lambda result: result["failed_chunks"] == 0,
+    )
+
+
+async def _search_chunks(keyword: str, chunks: List[List[Tuple[int, str]]]) -> Dict[str, Any]:
+    """
+    各チャンクを並列に問い合わせ、該当番号を元の順序でマージして返します。
+    一部のチャンクが失敗した場合は残りの結果を返し、全滅した場合は例外を送出します。
+    """
+    if not chunks:
+        return {"indices": [], "chunks": 0, "failed_chunks": 0}
+
+    factory = _model_factory or (await asyncio.to_thread(get_genai)).GenerativeModel
+    model = factory(GEMINI_MODEL)
+    results = await asyncio.gather(
+        *(_search_chunk(model, keyword, chunk) for chunk in chunks),
+        return_exceptions=True,
+    )
+
+    indices = set()
+    errors = []
+    for result in results:
+        if isinstance(result, BaseException):
+            errors.append(result)
+        else:
+            indices.update(result)
+
+    if errors:
+        print(f"Gemini chunk errors: {len(errors)}/{len(chunks)} ({errors[0]})")
+        if len(errors) == len(chunks):
+            raise errors[0]
+
+    return {
+        "indices": sorted(indices),
+        "chunks": len(chunks),
+        "failed_chunks": len(errors),
+    }
+
+
+async def _stream_chunk(
+    model: Any, keyword: str, chunk: List[Tuple[int, str]], queue: asyncio.Queue
+) -> None:
+    """ストリーミング生成の断片を逐次パースし、確定した番号をすぐに queue へ送る"""
+    allowed = {index for index, _ in chunk}
+    parser = IndexStreamParser()
+    async with _semaphore:
+        with metrics.upstream("gemini", "stream_generate_content"):
+            response = await model.generate_content_async(
+                build_prompt(keyword, chunk), stream=True
+            )
+            async for part in response:
+                try:
+                    text = part.text
+                except ValueError:
+                    # 安全性フィルタ等でテキストを含まない断片
+                    continue
+                for index in parser.feed(text):
+                    if index in allowed:
+                        queue.put_nowait(index)
+
+
+async def stream_search_comments(keyword: str, plan: SearchPlan) -> AsyncIterator[Dict[str, Any]]:
+    """
+    search_comments のストリーミング版。plan は plan_search の結果
+    （ストリーム開始前に件数の上限を確認できるよう、呼び出し側で先に求める）。
+    該当コメントの番号が確定するたびに
+    {"type": "match", "index": i} を yield し（チャンクをまたいで到着順）、
+    最後に {"type": "done", "chunks", "failed_chunks", "cached"} を yield します。
+    キャッシュ済みならそれを即座に流し、全チャンク成功時は結果をキャッシュに保存します。
+    ※ ストリームは共有できないため、同時の同一検索は1回にまとめない
+    """
+    key, chunks = plan
+    cached = result_cache.get(key)
+    if cached is not None:
+        for index in cached["indices"]:
+            yield {"type": "match", "index": index}
+        yield {"type": "done", "chunks": cached["chunks"], "failed_chunks": 0, "cached": True}
+        return
+
+    if not chunks:
+        yield {"type": "done", "chunks": 0, "failed_chunks": 0, "cached": False}
+        return
+
+    factory = _model_factory or (await asyncio.to_thread(get_genai)).GenerativeModel
+    model = factory(GEMINI_MODEL)
+    queue: asyncio.Queue = asyncio.Queue()
+    tasks = [
+        asyncio.create_task(_stream_chunk(model, keyword, chunk, queue)) for chunk in chunks
+    ]
+    finished = asyncio.ensure_future(asyncio.wait(tasks))
+    seen = set()
+    try:
+        while True:
+            getter = asyncio.ensure_future(queue.get())
+            await asyncio.wait({getter, finished}, return_when=asyncio.FIRST_COMPLETED)
+            if not getter.done():
+                getter.cancel()
+                # 全チャンク終了。キューに残っている番号を流して終わる
+                while not queue.empty():
+                    index = queue.get_nowait()
+                    if index not in seen:
+                        seen.add(index)
+                        yield {"type": "match", "index": index}
+                break
+            index = getter.result()
+            if index not in seen:
+                seen.add(index)
+                yield {"type": "match", "index": index}
+
+        errors = [task.exception() for task in tasks if task.exception() is not None]
+        if errors:
+            print(f"Gemini chunk errors: {len(errors)}/{len(chunks)} ({errors[0]})")
+            if len(errors) == len(chunks):
+                raise errors[0]
+        else:
+            result_cache.set(
+                key, {"indices": sorted(seen), "chunks": len(chunks), "failed_chunks": 0}
+            )
+        yield {"type": "done", "chunks": len(chunks), "failed_chunks": len(errors), "cached": False}
+    finally:
+        # クライアントの切断などで途中終了した場合は残りの生成を止める
+        for task in tasks:
+            task.cancel()
+        finished.cancel()
@@ -0,0 +1,363 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Dict, List, Optional, Tuple
+
+import comment_store
+import youtube_service
+
+# --- ★ 全コメント取得 (harvest) のジョブキュー ---
+# 10万件規模の動画でもブラウザから /api/comments を繰り返させず、サーバー側のワーカーが
+# 最後までページングする（ページキャッシュは経由しない）。1ページごとにコメントを comment_store の
+# スナップショットへ追記し、次のページトークンをチェックポイントとして SQLite に記録するため、
+# 失敗・再起動後もそのページから再開できる。同じ動画の実行中ジョブは1つにまとめる。
+# ジョブの priority (Pro / 無料) はキュー内の順番にだけ使い、YouTube への取得は常に
+# バックグラウンドのレーンで行う（対話的なリクエストとクォータの予備を奪わないように）。
+JOBS_PATH = os.getenv("HARVEST_JOBS_PATH", "data/harvest.db")
+# 同時に処理するジョブ数（ワーカー数）
+WORKERS = int(os.getenv("HARVEST_WORKERS", "2"))
+POLL_INTERVAL = float(os.getenv("HARVEST_POLL_INTERVAL", "5"))
+# ワーカー自体のエラー（SQLite の障害など）の後、次のポーリングまで待つ秒数
+ERROR_BACKOFF = float(os.getenv("HARVEST_ERROR_BACKOFF", "5"))
+# 連続して失敗できる回数（クォータ切れ・混雑は数えずに待つ）
+MAX_ATTEMPTS = int(os.getenv("HARVEST_MAX_ATTEMPTS", "5"))
+UNAVAILABLE_RETRY = float(os.getenv("HARVEST_UNAVAILABLE_RETRY", "60"))
+MAX_BACKOFF = 600.0
+
+FINISHED_STATUSES = ("complete", "failed")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS harvest_jobs (
+    id TEXT PRIMARY KEY,
+    video_id TEXT NOT NULL,
+    user_id TEXT,
+    priority INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    snapshot_id INTEGER,
+    -- チェックポイント: 次に取得するページと、そこまでに保存した件数
+    next_page_token TEXT,
+    pages INTEGER NOT NULL DEFAULT 0,
+    comment_count INTEGER NOT NULL DEFAULT 0,
+    expected_comments INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    last_error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    finished_at REAL
+);
+CREATE INDEX IF NOT EXISTS idx_harvest_jobs_due ON harvest_jobs (status, priority, next_attempt_at);
+-- 同じ動画の未完了ジョブは1つだけ（重複した投入は既存のジョブに合流させる）
+CREATE UNIQUE INDEX IF NOT EXISTS idx_harvest_jobs_active
+    ON harvest_jobs (video_id) WHERE status IN ('queued', 'running');
+"""
+
+# API で返す項目（ページトークンや投入したユーザーは返さない）
+_PUBLIC_FIELDS = (
+    "id", "video_id", "status", "snapshot_id", "pages", "comment_count",
+    "expected_comments", "attempts", "last_error", "created_at", "updated_at", "finished_at",
+)
+
+_conn: Optional[sqlite3.Connection] = None
+_lock = threading.Lock()
+_wakeup: Optional[asyncio.Event] = None
+_workers: List[asyncio.Task] = []
+# ジョブの進捗が更新されたときに待機中のストリームを起こす
+_updates: Dict[str, asyncio.Event] = {}
+
+
+def _connect() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        directory = os.path.dirname(JOBS_PATH)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(JOBS_PATH, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        _conn = conn
+    return _conn
+
+
+def public(job: Dict[str, Any]) -> Dict[str, Any]:
+    return {name: job.get(name) for name in _PUBLIC_FIELDS}
+
+
+# --- 同期 API（スレッドから呼ぶ） ---
+
+def _submit_sync(video_id: str, user_id: str, priority: int) -> Tuple[Dict[str, Any], bool]:
+    now = time.time()
+    with _lock:
+        conn = _connect()
+        row = conn.execute(
+            "SELECT * FROM harvest_jobs WHERE video_id = ? AND status IN ('queued', 'running')",
+            (video_id,),
+        ).fetchone()
+        if row is not None:
+            # Pro ユーザーが合流したら、そのジョブの優先度を引き上げる
+            if priority < row["priority"]:
+                conn.execute(
+                    "UPDATE harvest_jobs SET priority = ? WHERE id = ?", (priority, row["id"])
+                )
+                conn.commit()
+            return dict(row), False
+
+        job_id = uuid.uuid4().hex
+        conn.execute(
+            "INSERT INTO harvest_jobs (id, video_id, user_id, priority, status, next_attempt_at, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)",
+            (job_id, video_id, user_id, priority, now, now, now),
+        )
+        conn.commit()
+        row = conn.execute("SELECT * FROM harvest_jobs WHERE id = ?", (job_id,)).fetchone()
+    return dict(row), True
+
+
+def get_job_sync(job_id: str) -> Optional[Dict[str, Any]]:
+    with _lock:
+        row = _connect().execute("SELECT * FROM harvest_jobs WHERE id = ?", (job_id,)).fetchone()
+    return dict(row) if row is not None else None
+
+
+def _claim_next_sync() -> Optional[Dict[str, Any]]:
+    """実行可能なジョブを1つ running にして返す（優先度順・投入順）"""
+    now = time.time()
+    with _lock:
+        conn = _connect()
+        row = conn.execute(
+            "SELECT * FROM harvest_jobs WHERE status = 'queued' AND next_attempt_at <= ? "
+            "ORDER BY priority, created_at LIMIT 1",
+            (now,),
+        ).fetchone()
+        if row is None:
+            return None
+        conn.execute(
+            "UPDATE harvest_jobs SET status = 'running', updated_at = ? WHERE id = ?",
+            (now, row["id"]),
+        )
+        conn.commit()
+    job = dict(row)
+    job["status"] = "running"
+    return job
+
+
+def _update_sync(job_id: str, **fields: Any) -> None:
+    fields["updated_at"] = time.time()
+    assignments = ", ".join(f"{name} = ?" for name in fields)
+    with _lock:
+        conn = _connect()
+        conn.execute(
+            f"UPDATE harvest_jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id)
+        )
+        conn.commit()
+
+
+def _recover_sync() -> int:
+    """前回のプロセスで running のまま終わったジョブを、チェックポイントから再開できるよう戻す"""
+    with _lock:
+        conn = _connect()
+        cur = conn.execute(
+            "UPDATE harvest_jobs SET status = 'queued', next_attempt_at = ? WHERE status = 'running'",
+            (time.time(),),
+        )
+        conn.commit()
+        return cur.rowcount
+
+
+def stats() -> Dict[str, int]:
+    with _lock:
+        rows = _connect().execute(
+            "SELECT status, COUNT(*) FROM harvest_jobs GROUP BY status"
+        ).fetchall()
+    return {status: count for status, count in rows}
+
+
+# --- 非同期 API ---
+
+async def submit(video_id: str, user_id: str, priority: int) -> Tuple[Dict[str, Any], bool]:
+    """
+    動画の全コメント取得ジョブを投入し、(ジョブ, 新規作成したか) を返します。
+    同じ動画の未完了ジョブがあれば、新しく作らずにそのジョブを返します。
+    """
+    job, created = await asyncio.to_thread(_submit_sync, video_id, user_id, priority)
+    if created and _wakeup is not None:
+        _wakeup.set()
+    return job, created
+
+
+async def get_job(job_id: str) -> Optional[Dict[str, Any]]:
+    return await asyncio.to_thread(get_job_sync, job_id)
+
+
+def watch(job_id: str) -> asyncio.Event:
+    """
+    ジョブの次の更新で set される Event を返します。
+    状態を読む前に呼んでおくこと（読んだ直後の更新を取りこぼさないように）。
+    """
+    return _updates.setdefault(job_id, asyncio.Event())
+
+
+def unwatch(job_id: str) -> None:
+    """完了・削除済みのジョブの Event を捨てる（以降は更新されないため）"""
+    _updates.pop(job_id, None)
+
+
+async def wait_for_update(event: asyncio.Event, timeout: float) -> bool:
+    """watch で得た Event が set されるまで最大 timeout 秒待ち、更新があれば True を返します。"""
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+        return True
+    except asyncio.TimeoutError:
+        return False
+
+
+async def _update(job_id: str, **fields: Any) -> None:
+    await asyncio.to_thread(_update_sync, job_id, **fields)
+    event = _updates.pop(job_id, None)
+    if event is not None:
+        event.set()
+
+
+# --- ワーカー ---
+
+async def _expected_comments(video_id: str, priority: int) -> Optional[int]:
+    # 進捗表示の目安（commentCount は返信を含む概数）。取れなくてもジョブは続ける
+    try:
+        videos = await youtube_service.fetch_videos([video_id], priority)
+    except Exception as e:
+        print(f"Harvest videos.list error ({video_id}): {e}")
+        return None
+    video = videos.get(video_id)
+    return video["comment_count"] if video else None
+
+
+async def _process(job: Dict[str, Any]) -> None:
+    job_id, video_id = job["id"], job["video_id"]
+    priority = youtube_service.PRIORITY_BACKGROUND
+    snapshot_id = job["snapshot_id"]
+    if snapshot_id is None:
+        snapshot_id = await asyncio.to_thread(comment_store.create_snapshot, video_id)
+        expected = await _expected_comments(video_id, priority)
+        await _update(job_id, snapshot_id=snapshot_id, expected_comments=expected)
+    else:
+        # チェックポイントの記録より後に保存された分は、そのページを取り直すので捨てる
+        removed = await asyncio.to_thread(
+            comment_store.truncate_comments, snapshot_id, job["comment_count"]
+        )
+        print(f"Harvest resumed ({job_id}): page {job['pages'] + 1}, discarded {removed}")
+
+    page_token = job["next_page_token"]
+    pages = job["pages"]
+    attempts = job["attempts"]
+    while True:
+        # 一括取得は /api/comments のページキャッシュを押し出さないよう、キャッシュを経由しない
+        page = await youtube_service._fetch_comments_page_uncached(video_id, page_token, priority)
+        if page.get("status") != "success":
+            await _retry_later(job_id, page, attempts)
+            return
+
+        count = await asyncio.to_thread(
+            comment_store.append_comments, snapshot_id, page["comments"]
+        )
+        pages += 1
+        page_token = page.get("next_page_token")
+        if not page_token:
+            # 最後まで取得できたらスナップショットを完成扱いにする（検索・分析の対象になる）
+            await asyncio.to_thread(comment_store.finish_snapshot, snapshot_id)
+            await _update(
+                job_id, status="complete", next_page_token=None, pages=pages,
+                comment_count=count, attempts=0, last_error=None, finished_at=time.time(),
+            )
+            print(f"Harvest complete ({job_id}): {video_id}, {count} comments, {pages} pages")
+            return
+
+        # ★ チェックポイント: ここまでの件数と次のページを記録
+        attempts = 0
+        await _update(
+            job_id, next_page_token=page_token, pages=pages,
+            comment_count=count, attempts=0, last_error=None,
+        )
+
+
+async def _retry_later(job_id: str, page: Dict[str, Any], attempts: int) -> None:
+    # httpx のエラー文には API キー入りの URL が含まれるため、ジョブには残さない
+    detail = str(page.get("detail") or "").split(" for url ", 1)[0]
+    error = f"{page.get('message')}: {detail}"
+    if page.get("message") == "YouTube API Unavailable":
+        # クォータ切れ・混雑はジョブの失敗として数えず、時間をおいて再開する
+        status, delay = "queued", UNAVAILABLE_RETRY
+    else:
+        attempts += 1
+        status = "failed" if attempts >= MAX_ATTEMPTS else "queued"
+        delay = min(5 * 2 ** attempts, MAX_BACKOFF)
+    print(f"Harvest page error ({job_id}, attempt {attempts}): {error}")
+    fields: Dict[str, Any] = {
+        "status": status, "attempts": attempts, "last_error": error,
+        "next_attempt_at": time.time() + delay,
+    }
+    if status == "failed":
+        fields["finished_at"] = time.time()
+        # 再開しないので、途中まで保存したスナップショットは捨てる（comments.db に溜めない）
+        job = await get_job(job_id)
+        if job is not None and job["snapshot_id"] is not None:
+            await asyncio.to_thread(comment_store.discard_snapshot, job["snapshot_id"])
+            fields["snapshot_id"] = None
+    await _update(job_id, **fields)
+
+
+async def _run() -> None:
+    while True:
+        # ポーリングの前に clear する（照会・処理の最中に投入されたジョブの通知を消さないように）
+        _wakeup.clear()
+        try:
+            job = await asyncio.to_thread(_claim_next_sync)
+            if job is not None:
+                try:
+                    await _process(job)
+                except asyncio.CancelledError:
+                    # 終了時はそのまま抜ける（running のまま残り、次回起動時に再開される）
+                    raise
+                except Exception as e:
+                    print(f"❌ Harvest Error ({job['id']}): {e}")
+                    await _retry_later(
+                        job["id"], {"message": "Server Error", "detail": str(e)}, job["attempts"]
+                    )
+                continue
+        except Exception as e:
+            # 想定外のエラーでワーカーが終了すると処理が止まるため、記録して間を置いて続ける
+            print(f"❌ Harvest Worker Error: {e}")
+            await asyncio.sleep(ERROR_BACKOFF)
+            continue
+        # 新しいジョブが投入されるか、再試行時刻になるまで待つ
+        try:
+            await asyncio.wait_for(_wakeup.wait(), POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+def start() -> None:
+    """ワーカーを起動します。前回終了時に実行中だったジョブはチェックポイントから再開されます。"""
+    global _wakeup
+    if _workers:
+        return
+    recovered = _recover_sync()
+    if recovered:
+        print(f"Harvest jobs to resume: {recovered}")
+    _wakeup = asyncio.Event()
+    _workers.extend(asyncio.create_task(_run()) for _ in range(max(WORKERS, 1)))
+
+
+async def stop() -> None:
+    global _conn
+    for worker in _workers:
+        worker.cancel()
+    await asyncio.gather(*_workers, return_exceptions=True)
+    _workers.clear()
+    with _lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
@@ -0,0 +1,218 @@
+import bisect
+import contextvars
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+# --- ★ レイテンシ計測 (Server-Timing ヘッダー + Prometheus 形式の /metrics) ---
+# リクエストごとの処理段階 (jwt / usage_check / youtube / format / serialize ...) を span で計測し、
+# ルート別・外部API別のヒストグラムに集計する。METRICS_ENABLED=0 で計測自体を止められる。
+ENABLED = os.getenv("METRICS_ENABLED", "1") != "0"
+# Server-Timing ヘッダーを付けるか（計測は続けたまま、ヘッダーだけ止めたい場合用）
+SERVER_TIMING_ENABLED = os.getenv("METRICS_SERVER_TIMING", "1") != "0"
+
+# ヒストグラムのバケット境界（秒）
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# 処理中リクエストの span 一覧 [(名前, 秒)]。リクエスト外 (バックグラウンド処理) では None
+_spans: contextvars.ContextVar[Optional[List[Tuple[str, float]]]] = contextvars.ContextVar(
+    "metrics_spans", default=None
+)
+
+
+class Histogram:
+    """ラベルの組み合わせごとにバケット数・合計・件数を持つ累積ヒストグラム"""
+
+    def __init__(self, name: str, help_text: str, label_names: Tuple[str, ...],
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        # ラベル値のタプル -> [バケットごとの件数..., +Inf の件数], 合計
+        self._series: Dict[Tuple[str, ...], List[Any]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in sorted(self._series.items()):
+            base = _format_labels(zip(self.label_names, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_with_label(base, 'le', le)} {cumulative}")
+            lines.append(f"{self.name}_sum{base} {total:.6f}")
+            lines.append(f"{self.name}_count{base} {cumulative}")
+        return lines
+
+
+route_latency = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by route (until the response body is sent).",
+    ("method", "route", "status"),
+)
+upstream_latency = Histogram(
+    "upstream_request_duration_seconds",
+    "Latency of calls to external services.",
+    ("upstream", "operation", "outcome"),
+)
+stage_latency = Histogram(
+    "request_stage_duration_seconds",
+    "Latency of in-process request stages.",
+    ("stage",),
+)
+
+
+def _escape(value: Any) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(pairs: Any) -> str:
+    body = ",".join(f'{name}="{_escape(value)}"' for name, value in pairs)
+    return "{" + body + "}" if body else ""
+
+
+def _with_label(base: str, name: str, value: str) -> str:
+    extra = f'{name}="{value}"'
+    return "{" + extra + "}" if not base else base[:-1] + "," + extra + "}"
+
+
+def _record_span(name: str, elapsed: float) -> None:
+    spans = _spans.get()
+    if spans is not None:
+        spans.append((name, elapsed))
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """リクエスト内の処理段階を計測します（Server-Timing とステージ別ヒストグラムに記録）"""
+    if not ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_latency.observe(elapsed, name)
+        _record_span(name, elapsed)
+
+
+@contextmanager
+def upstream(name: str, operation: str) -> Iterator[None]:
+    """外部API (youtube / firestore / gemini / stripe) の呼び出しを計測します"""
+    if not ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        elapsed = time.perf_counter() - start
+        upstream_latency.observe(elapsed, name, operation, outcome)
+        _record_span(name, elapsed)
+
+
+def server_timing(spans: List[Tuple[str, float]]) -> str:
+    """span 一覧を Server-Timing ヘッダーの値にします（同名の span は合算）"""
+    totals: Dict[str, List[float]] = {}
+    for name, elapsed in spans:
+        entry = totals.setdefault(name, [0.0, 0])
+        entry[0] += elapsed
+        entry[1] += 1
+    return ", ".join(
+        f"{name};dur={total * 1000:.2f}" + (f';desc="x{count}"' if count > 1 else "")
+        for name, (total, count) in totals.items()
+    )
+
+
+class MetricsMiddleware:
+    """
+    リクエスト全体の時間をルート別に集計し、レスポンスに Server-Timing ヘッダーを付ける
+    ASGI ミドルウェア（BaseHTTPMiddleware を使わないのでストリーミングもそのまま流れる）。
+    ※ ヘッダーはレスポンス開始時点までの span のみを含む
+    """
+
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope["type"] != "http" or not ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        spans: List[Tuple[str, float]] = []
+        token = _spans.set(spans)
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_with_timing(message: Dict[str, Any]) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if SERVER_TIMING_ENABLED:
+                    spans.append(("app", time.perf_counter() - start))
+                    headers = list(message.get("headers", []))
+                    headers.append((b"server-timing", server_timing(spans).encode("latin-1")))
+                    message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _spans.reset(token)
+            route = scope.get("route")
+            # パスパラメータで系列が増えないよう、ルートのテンプレート (/api/videos/{video_id}/...) を使う
+            route_path = getattr(route, "path", None) or "unmatched"
+            route_latency.observe(
+                time.perf_counter() - start, scope["method"], route_path, str(status_code)
+            )
+
+
+# --- ゲージ (スクレイプ時に各モジュールの stats() から集める) ---
+
+_gauge_sources: List[Tuple[str, Callable[[], Dict[str, Any]], Dict[str, str]]] = []
+
+
+def register_gauges(prefix: str, source: Callable[[], Dict[str, Any]], **labels: str) -> None:
+    """
+    stats() 形式の辞書を返す関数を登録します。
+    数値・真偽値の項目が `<prefix>_<key>` というゲージとして出力されます。
+    """
+    _gauge_sources.append((prefix, source, labels))
+
+
+def render() -> str:
+    """Prometheus のテキスト形式 (version 0.0.4) で全メトリクスを出力します"""
+    lines: List[str] = []
+    for histogram in (route_latency, upstream_latency, stage_latency):
+        lines.extend(histogram.render())
+
+    gauges: Dict[str, List[str]] = {}
+    for prefix, source, labels in _gauge_sources:
+        try:
+            values = source()
+        except Exception as e:
+            print(f"Metrics source error ({prefix}): {e}")
+            continue
+        label_text = _format_labels(sorted(labels.items()))
+        for key, value in values.items():
+            if isinstance(value, bool):
+                value = int(value)
+            if not isinstance(value, (int, float)):
+                continue
+            gauges.setdefault(f"{prefix}_{key}", []).append(f"{prefix}_{key}{label_text} {value}")
+    for name, samples in gauges.items():
+        lines.append(f"# TYPE {name} gauge")
+        lines.extend(samples)
+    return "\n".join(lines) + "\n"
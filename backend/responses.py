@@ -0,0 +1,18 @@
+from typing import Any
+
+import orjson
+from starlette.responses import JSONResponse
+
+import metrics
+
+
+class ORJSONResponse(JSONResponse):
+    """
+    orjson でシリアライズする JSONResponse。
+    エンドポイントからこのインスタンスを直接返すと、FastAPI の jsonable_encoder による
+    入れ子の辞書の走査も省略されるため、大きなコメント一覧を返す場合に速い。
+    """
+
+    def render(self, content: Any) -> bytes:
+        with metrics.span("serialize"):
+            return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
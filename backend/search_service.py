@@ -0,0 +1,338 @@
+import asyncio
+import hashlib
+import os
+import re
+import unicodedata
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from cache import TTLCache
+
+# 日本語は単語の区切りがないため、文字 n-gram (bigram) で転置インデックスを作る
+NGRAM_SIZE = 2
+FUZZY_THRESHOLD = float(os.getenv("SEARCH_FUZZY_THRESHOLD", "0.6"))
+
+# 同じコメント集合への連続検索ではインデックスを使い回す
+index_cache = TTLCache(
+    max_entries=int(os.getenv("SEARCH_INDEX_CACHE_MAX_ENTRIES", "32")),
+    ttl=float(os.getenv("SEARCH_INDEX_CACHE_TTL", "1800")),
+    name="search_index",
+)
+
+# カタカナ → ひらがな の変換テーブル (ァ..ヶ)
+_KATAKANA_TO_HIRAGANA = {code: code - 0x60 for code in range(0x30A1, 0x30F7)}
+_WHITESPACE = re.compile(r"\s+")
+_INNER_WHITESPACE = re.compile(r"[^\S\x00]+")
+
+# bigram を (コードポイント 21bit x 2) の整数に、さらに文書番号 21bit を連結して扱う
+_CODE_BITS = np.uint64(21)
+_DOC_BITS = np.uint64(21)
+_DOC_MASK = (1 << 21) - 1
+# 文書番号が 21bit に収まる件数まで（超えると別の文書と取り違えるため、構築前に断る）
+MAX_COMMENTS = _DOC_MASK + 1
+
+# ベクトル検索で使うハッシュ空間の次元数 (2^18)
+VECTOR_DIM_BITS = int(os.getenv("SEARCH_VECTOR_DIM_BITS", "18"))
+VECTOR_DIM = 1 << VECTOR_DIM_BITS
+_HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)  # フィボナッチハッシュ
+
+
+def normalize(text: Any) -> str:
+    """
+    検索用の正規化: 全角/半角の統一 (NFKC)、大文字小文字、カタカナ/ひらがなを同一視する。
+    """
+    if not isinstance(text, str):
+        return ""
+    text = unicodedata.normalize("NFKC", text).lower()
+    text = text.translate(_KATAKANA_TO_HIRAGANA)
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def normalize_many(texts: Sequence[Any]) -> List[str]:
+    """
+    normalize() の一括版。全件を連結して1回で変換するため、件数が多いときに速い。
+    """
+    joined = "\x00".join(t.replace("\x00", "") if isinstance(t, str) else "" for t in texts)
+    joined = unicodedata.normalize("NFKC", joined).lower()
+    codes = np.frombuffer(joined.encode("utf-32-le"), dtype=np.uint32).copy()
+    katakana = (codes >= 0x30A1) & (codes <= 0x30F6)
+    codes[katakana] -= 0x60
+    joined = codes.tobytes().decode("utf-32-le")
+    joined = _INNER_WHITESPACE.sub(" ", joined)
+    return [t.strip() for t in joined.split("\x00")] if texts else []
+
+
+def _ngrams(text: str, n: int = NGRAM_SIZE) -> List[str]:
+    if len(text) < n:
+        return [text] if text else []
+    return [text[i : i + n] for i in range(len(text) - n + 1)]
+
+
+def _bigram_key(gram: str) -> int:
+    # Unicode のコードポイントは 21bit に収まるので2文字を1つの整数にまとめる
+    return (ord(gram[0]) << 21) | ord(gram[1])
+
+
+def _code_arrays(texts: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    全テキストを NUL 区切りで連結し、(コードポイント配列, 各文字の文書番号) を返す。
+    n-gram の抽出を Python のループなしで一括処理するための下準備。
+    """
+    joined = "\x00".join(texts)
+    codes = np.frombuffer(joined.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    lengths = np.fromiter((len(t) + 1 for t in texts), dtype=np.int64, count=len(texts))
+    doc_ids = np.repeat(np.arange(len(texts), dtype=np.uint64), lengths)[: len(codes)]
+    return codes, doc_ids
+
+
+def _hashed_features(codes: np.ndarray, doc_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    文字 bigram / trigram を VECTOR_DIM 次元にハッシュし、(文書番号, 特徴番号) の配列を返す。
+    """
+    docs_parts, feature_parts = [], []
+    for n in (2, 3):
+        if len(codes) < n:
+            continue
+        width = len(codes) - n + 1
+        key = codes[:width].copy()
+        valid = key != 0
+        for offset in range(1, n):
+            nxt = codes[offset : offset + width]
+            key = (key << _CODE_BITS) | nxt
+            valid &= nxt != 0
+        # bigram (42bit) と trigram (63bit) はキーの範囲が重ならないので同じ空間でハッシュしてよい
+        hashed = (key[valid] * _HASH_MULTIPLIER) >> np.uint64(64 - VECTOR_DIM_BITS)
+        docs_parts.append(doc_ids[:width][valid])
+        feature_parts.append(hashed)
+    if not docs_parts:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.uint64)
+    return np.concatenate(docs_parts), np.concatenate(feature_parts)
+
+
+class VectorIndex:
+    """
+    文字 n-gram のハッシュ特徴による TF-IDF 疎行列（列方向 = CSC 形式で保持）。
+    キーワードとのコサイン類似度を全コメント分まとめて1回の演算で求める。
+    """
+
+    def __init__(self, texts: Sequence[str]):
+        self.size = len(texts)
+        docs, features = _hashed_features(*_code_arrays(texts))
+
+        # (特徴, 文書) で並べ替えて同じ組を数えると TF になる
+        pairs = np.sort((features << _DOC_BITS) | docs)
+        if len(pairs):
+            starts = np.flatnonzero(np.append(True, pairs[1:] != pairs[:-1]))
+            tf = np.diff(np.append(starts, len(pairs))).astype(np.float32)
+            pairs = pairs[starts]
+        else:
+            tf = np.zeros(0, dtype=np.float32)
+        self._cols = (pairs >> _DOC_BITS).astype(np.int64)
+        self._rows = (pairs & np.uint64(_DOC_MASK)).astype(np.int64)
+
+        df = np.bincount(self._cols, minlength=VECTOR_DIM)
+        self._idf = (np.log((self.size + 1) / (df + 1)) + 1).astype(np.float32)
+
+        values = (1 + np.log(tf)) * self._idf[self._cols]
+        norms = np.sqrt(np.bincount(self._rows, weights=values * values, minlength=self.size))
+        norms[norms == 0] = 1
+        self._values = (values / norms[self._rows]).astype(np.float32)
+        # 列ごとの開始位置（CSC の indptr 相当）
+        self._col_ptr = np.searchsorted(self._cols, np.arange(VECTOR_DIM + 1))
+
+    def query(self, keyword: str, top_k: int = 20) -> List[Tuple[int, float]]:
+        """キーワードとのコサイン類似度が高い順に (番号, スコア) を最大 top_k 件返す"""
+        q_docs, q_features = _hashed_features(*_code_arrays([normalize(keyword)]))
+        if not len(q_features) or not self.size:
+            return []
+
+        features, counts = np.unique(q_features.astype(np.int64), return_counts=True)
+        weights = (1 + np.log(counts)) * self._idf[features]
+        weights /= np.linalg.norm(weights)
+
+        # クエリが持つ特徴の列だけを取り出し、疎行列 × ベクトルを bincount で一括計算
+        spans = [slice(self._col_ptr[f], self._col_ptr[f + 1]) for f in features]
+        rows = np.concatenate([self._rows[span] for span in spans])
+        contrib = np.concatenate(
+            [self._values[span] * w for span, w in zip(spans, weights)]
+        )
+        scores = np.bincount(rows, weights=contrib, minlength=self.size)
+
+        k = min(top_k, int(np.count_nonzero(scores)))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.lexsort((top, -scores[top]))]
+        return [(int(i), float(scores[i])) for i in top]
+
+
+def comments_digest(comments: Sequence[Any]) -> str:
+    """コメント集合の内容ハッシュ（インデックスのキャッシュキーに使う）"""
+    joined = "\x00".join(
+        (c.get("text") or "") if isinstance(c, dict) else "" for c in comments
+    )
+    return hashlib.blake2b(joined.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class TooManyCommentsError(Exception):
+    """コメントが多すぎて、インデックスの文書番号 (21bit) に収まらない"""
+
+    def __init__(self, count: int):
+        super().__init__(f"{count} comments exceeds the limit of {MAX_COMMENTS}")
+        self.count = count
+
+
+class CommentIndex:
+    """
+    コメントの text に対する文字 bigram 転置インデックス。
+    ポスティングリストは NumPy 配列で持ち、構築・検索ともにベクトル演算で行う。
+    """
+
+    def __init__(self, comments: Sequence[Any]):
+        if len(comments) > MAX_COMMENTS:
+            raise TooManyCommentsError(len(comments))
+        self.texts = normalize_many(
+            [c.get("text") if isinstance(c, dict) else None for c in comments]
+        )
+        self._build_postings()
+        self._vectors: Optional[VectorIndex] = None
+
+    @property
+    def vectors(self) -> "VectorIndex":
+        # ベクトル行列は初回のベクトル検索時に作り、以降はインデックスと一緒にキャッシュされる
+        if self._vectors is None:
+            self._vectors = VectorIndex(self.texts)
+        return self._vectors
+
+    def _build_postings(self) -> None:
+        codes, doc_ids = _code_arrays(self.texts)
+        keys = (codes[:-1] << _CODE_BITS) | codes[1:]
+        valid = (codes[:-1] != 0) & (codes[1:] != 0)  # 区切りをまたぐ bigram は除外
+
+        # (bigram, doc) を1つの整数にまとめてソートすると、重複除去と
+        # bigram→doc 順の並べ替えが1回で済む (bigram 42bit + doc 21bit)
+        pairs = np.sort((keys[valid] << _DOC_BITS) | doc_ids[:-1][valid])
+        pairs = pairs[np.append(True, pairs[1:] != pairs[:-1])] if len(pairs) else pairs
+        keys = pairs >> _DOC_BITS
+        self._docs = (pairs & np.uint64(_DOC_MASK)).astype(np.int32)
+
+        starts = np.flatnonzero(np.append(True, keys[1:] != keys[:-1])) if len(keys) else keys[:0]
+        self._gram_keys = keys[starts]
+        self._offsets = np.append(starts, len(keys))
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def _postings(self, gram: str) -> np.ndarray:
+        key = _bigram_key(gram)
+        pos = np.searchsorted(self._gram_keys, key)
+        if pos >= len(self._gram_keys) or self._gram_keys[pos] != key:
+            return self._docs[:0]
+        return self._docs[self._offsets[pos] : self._offsets[pos + 1]]
+
+    def search_exact(self, keyword: str) -> List[int]:
+        """正規化後のキーワードを部分文字列として含むコメントの番号を返す"""
+        query = normalize(keyword)
+        if not query:
+            return []
+        if len(query) < NGRAM_SIZE:
+            # 1文字の検索は bigram で絞り込めないので全件走査（十分高速）
+            return [i for i, text in enumerate(self.texts) if query in text]
+
+        # 出現数の少ない bigram から順に積集合を取り、候補を絞り込む
+        postings = sorted((self._postings(g) for g in set(_ngrams(query))), key=len)
+        candidates = postings[0]
+        for posting in postings[1:]:
+            if not len(candidates):
+                break
+            candidates = np.intersect1d(candidates, posting, assume_unique=True)
+
+        return [int(i) for i in candidates if query in self.texts[i]]
+
+    def search_fuzzy(
+        self, keyword: str, threshold: float = FUZZY_THRESHOLD
+    ) -> List[Tuple[int, float]]:
+        """
+        キーワードの bigram のうち threshold 以上の割合を含むコメントを、
+        一致率の高い順に (番号, スコア) で返す。表記ゆれ・部分的な一致を拾うため。
+        """
+        query = normalize(keyword)
+        if len(query) < NGRAM_SIZE:
+            return [(i, 1.0) for i in self.search_exact(query)]
+
+        grams = set(_ngrams(query))
+        counts = np.bincount(
+            np.concatenate([self._postings(g) for g in grams]),
+            minlength=len(self.texts),
+        )
+        scores = counts / len(grams)
+        hits = np.flatnonzero(scores >= threshold)
+        # スコア降順・同点はコメント順
+        hits = hits[np.lexsort((hits, -scores[hits]))]
+        return [(int(i), float(scores[i])) for i in hits]
+
+
+async def get_index(comments: Sequence[Any], cache_key: Any = None) -> CommentIndex:
+    """
+    コメント集合のインデックスを返す（同一内容ならキャッシュ済みのものを再利用）。
+    キャッシュ済みならその場で返し、内容ハッシュの計算と
+    インデックスの構築（10万件で1秒以上）はスレッドで行う（イベントループを止めない）。
+    同じインデックスの構築が同時に来た場合は1回にまとめる。
+    件数が MAX_COMMENTS を超える場合は TooManyCommentsError。
+    """
+    if len(comments) > MAX_COMMENTS:
+        raise TooManyCommentsError(len(comments))
+    key = cache_key
+    if key is None:
+        key = await asyncio.to_thread(comments_digest, comments)
+    return await index_cache.get_or_load(key, lambda: asyncio.to_thread(CommentIndex, comments))
+
+
+async def search_local(
+    comments: Sequence[Any],
+    keyword: str,
+    mode: str = "local",
+    top_k: int = 20,
+    cache_key: Any = None,
+) -> Dict[str, Any]:
+    """
+    ローカル検索を実行し、マッチしたコメントと使用したモードを返す。
+    mode:
+      - "exact": 正規化済みの部分一致のみ
+      - "fuzzy": n-gram の一致率による曖昧検索
+      - "local": まず exact、0件なら fuzzy にフォールバック
+      - "vector": n-gram TF-IDF のコサイン類似度で上位 top_k 件（スコア付き）
+    cache_key を渡すと内容ハッシュの計算を省略してインデックスを引く。
+    """
+    index = await get_index(comments, cache_key)
+    if mode == "vector" and index._vectors is None:
+        # ベクトル行列も初回だけ構築に時間がかかるのでスレッドで作る
+        await asyncio.to_thread(lambda: index.vectors)
+    return _search_index(index, comments, keyword, mode, top_k)
+
+
+def _search_index(
+    index: CommentIndex, comments: Sequence[Any], keyword: str, mode: str, top_k: int
+) -> Dict[str, Any]:
+    if mode == "vector":
+        ranked = index.vectors.query(keyword, top_k)
+        return {
+            "mode": "vector",
+            "matches": [comments[i] for i, _ in ranked],
+            "scores": [round(score, 4) for _, score in ranked],
+        }
+
+    if mode in ("exact", "local"):
+        hits = index.search_exact(keyword)
+        if hits or mode == "exact":
+            return {
+                "mode": "exact",
+                "matches": [comments[i] for i in hits],
+            }
+
+    scored = index.search_fuzzy(keyword)
+    return {
+        "mode": "fuzzy",
+        "matches": [comments[i] for i, _ in scored],
+    }
@@ -0,0 +1,293 @@
+import asyncio
+import datetime
+import heapq
+import itertools
+import random
+import time
+from typing import Any, Callable, Dict, List, Optional, Union
+
+# --- ★ 外部API (YouTube Data API) 呼び出しのスケジューラ ---
+# - トークンバケットで秒間リクエスト数を制限
+# - API キーごとに当日のクォータ消費を記録し、残量の多いキーから順に使う (キーのローテーション)
+# - 優先レーン: Pro ユーザー > 無料ユーザー > バックグラウンド (先読み)
+#   クォータが残り少なくなると低い優先度のレーンから止め、Pro のリクエストに残す
+# - 429 / レート制限の 403 はキーごとに指数バックオフ、quotaExceeded はそのキーを当日停止
+
+PRIORITY_PRO = 0
+PRIORITY_FREE = 1
+PRIORITY_BACKGROUND = 2
+
+_LANE_NAMES = {PRIORITY_PRO: "pro", PRIORITY_FREE: "free", PRIORITY_BACKGROUND: "background"}
+
+# YouTube のクォータは太平洋時間の0時にリセットされる（夏時間は考慮しない）
+QUOTA_TZ = datetime.timezone(datetime.timedelta(hours=-8))
+
+# レスポンスの判定結果
+DONE = "done"
+RETRY = "retry"
+
+
+class UpstreamUnavailableError(Exception):
+    """クォータ切れ・待ち時間超過などで、このレーンのリクエストを送れない"""
+
+
+class RequestPriority:
+    """
+    送信待ちの途中で引き上げられる優先度。複数の呼び出し元で共有する読み込み (single-flight) 用で、
+    acquire() に int の代わりに渡すと、後から来た待機者が raise_to() で自分のレーンまで引き上げられる
+    （先読みの読み込みに合流した Pro のリクエストが、バックグラウンドのレーンで待たされないように）。
+    """
+
+    def __init__(self, value: int):
+        self.value = value
+        self._scheduler: Optional["UpstreamScheduler"] = None
+        self._entry: Optional[list] = None
+
+    def raise_to(self, priority: int) -> None:
+        if priority >= self.value:
+            return
+        self.value = priority
+        if self._entry is not None:
+            self._scheduler._reprioritize(self._entry, priority)
+
+
+class _KeyState:
+    def __init__(self, index: int, key: Optional[str]):
+        self.index = index
+        self.key = key
+        self.day: Optional[datetime.date] = None
+        self.used = 0
+        self.exhausted = False
+        self.backoff_until = 0.0
+        self.failures = 0
+
+    def roll(self) -> None:
+        today = datetime.datetime.now(QUOTA_TZ).date()
+        if self.day != today:
+            self.day, self.used, self.exhausted = today, 0, False
+
+    def label(self) -> str:
+        # 統計・ログにはキーの一部も出さず、設定順の番号だけを表示する
+        return f"key#{self.index}" if self.key else "(none)"
+
+
+class UpstreamScheduler:
+    """
+    acquire() でレーンの優先度順に送信権（と使う API キー）を受け取り、
+    応答を report() に渡してクォータ切れ・レート制限を記録する。
+    ※ イベントループ上でのみ使う前提なのでロックは持たない
+    """
+
+    def __init__(
+        self,
+        keys_loader: Callable[[], List[Optional[str]]],
+        daily_quota: int,
+        rate_per_second: float,
+        burst: int,
+        pro_reserve_ratio: float,
+        background_min_ratio: float,
+        max_wait: float,
+        backoff_base: float = 1.0,
+        backoff_max: float = 60.0,
+    ):
+        # 環境変数 (.env) の読み込みより先に import されるため、キーは初回使用時に読む
+        self._keys_loader = keys_loader
+        self._keys: Optional[List[_KeyState]] = None
+        self.daily_quota = daily_quota
+        self.rate = rate_per_second
+        self.burst = max(burst, 1)
+        self.pro_reserve_ratio = pro_reserve_ratio
+        self.background_min_ratio = background_min_ratio
+        self.max_wait = max_wait
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._tokens = float(self.burst)
+        self._refilled_at = time.monotonic()
+        self._waiters: List[list] = []
+        self._seq = itertools.count()
+        self.granted = {name: 0 for name in _LANE_NAMES.values()}
+        self.rejected = {name: 0 for name in _LANE_NAMES.values()}
+        self.retries = 0
+
+    # --- クォータ台帳 ---
+
+    @property
+    def keys(self) -> List[_KeyState]:
+        if self._keys is None:
+            self._keys = [
+                _KeyState(index, key) for index, key in enumerate(self._keys_loader() or [None])
+            ]
+        return self._keys
+
+    def _usable(self, state: _KeyState, cost: int) -> bool:
+        state.roll()
+        return not state.exhausted and self.daily_quota - state.used >= cost
+
+    def total_quota(self) -> int:
+        return self.daily_quota * len(self.keys)
+
+    def remaining(self) -> int:
+        total = 0
+        for state in self.keys:
+            state.roll()
+            if not state.exhausted:
+                total += max(self.daily_quota - state.used, 0)
+        return total
+
+    def lane_allowed(self, priority: int) -> bool:
+        """残りクォータに対して、このレーンのリクエストを受け付けるか"""
+        remaining = self.remaining()
+        if priority >= PRIORITY_BACKGROUND:
+            return remaining > self.total_quota() * self.background_min_ratio
+        if priority >= PRIORITY_FREE:
+            return remaining > self.total_quota() * self.pro_reserve_ratio
+        return remaining > 0
+
+    # --- 送信権の取得 ---
+
+    def _refill(self, now: float) -> None:
+        if self.rate <= 0:
+            self._tokens = float(self.burst)
+        else:
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+    def _try_take(self, priority: int, cost: int):
+        """(API キーの状態, 待つべき秒数) を返す。どちらも None なら送信不可"""
+        if not self.lane_allowed(priority):
+            return None, None
+        candidates = [state for state in self.keys if self._usable(state, cost)]
+        if not candidates:
+            return None, None
+
+        now = time.monotonic()
+        ready = [state for state in candidates if state.backoff_until <= now]
+        if not ready:
+            return None, min(state.backoff_until for state in candidates) - now
+        self._refill(now)
+        if self._tokens < 1:
+            return None, (1 - self._tokens) / self.rate
+
+        # 残量の多いキーから使う（複数キーに均等に負荷が分散する）
+        state = max(ready, key=lambda s: self.daily_quota - s.used)
+        self._tokens -= 1
+        state.used += cost
+        return state, 0.0
+
+    def _wake_head(self) -> None:
+        if self._waiters:
+            future = self._waiters[0][2]
+            if not future.done():
+                future.set_result(None)
+
+    def _reprioritize(self, entry: list, priority: int) -> None:
+        # 待機中のエントリの優先度を上げ、先頭が入れ替わった場合に備えて先頭を起こす
+        entry[0] = priority
+        heapq.heapify(self._waiters)
+        self._wake_head()
+
+    async def acquire(self, priority: Union[int, RequestPriority], cost: int = 1) -> Optional[str]:
+        """
+        送信権を待って、使う API キーを返します。
+        優先度の高いレーンの待機者が常に先に送信権を得ます。
+        RequestPriority を渡した場合は、待機中に引き上げられた優先度が反映されます。
+        クォータ切れ、または max_wait 秒以内に送れない場合は UpstreamUnavailableError。
+        """
+        request = priority if isinstance(priority, RequestPriority) else None
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        entry = [request.value if request else priority, next(self._seq), loop.create_future()]
+        heapq.heappush(self._waiters, entry)
+        if request is not None:
+            request._scheduler, request._entry = self, entry
+        try:
+            while True:
+                lane = _LANE_NAMES.get(entry[0], "background")
+                if self._waiters[0] is not entry:
+                    # 先頭になるまで待つ
+                    entry[2] = loop.create_future()
+                    await asyncio.wait_for(entry[2], max(deadline - loop.time(), 0))
+                    continue
+
+                state, delay = self._try_take(entry[0], cost)
+                if state is not None:
+                    self.granted[lane] += 1
+                    return state.key
+                if delay is None:
+                    self.rejected[lane] += 1
+                    raise UpstreamUnavailableError("YouTube API quota exhausted")
+                if loop.time() + delay > deadline:
+                    self.rejected[lane] += 1
+                    raise UpstreamUnavailableError("YouTube API is busy (rate limited)")
+                await asyncio.sleep(delay)
+        except asyncio.TimeoutError:
+            self.rejected[lane] += 1
+            raise UpstreamUnavailableError("YouTube API is busy (queue timeout)")
+        finally:
+            if request is not None:
+                request._entry = None
+            was_head = self._waiters and self._waiters[0] is entry
+            self._waiters.remove(entry)
+            heapq.heapify(self._waiters)
+            if was_head:
+                self._wake_head()
+
+    # --- 応答の記録 ---
+
+    def report(self, key: Optional[str], status_code: int, body: str = "") -> str:
+        """
+        応答を記録し、別のキー・時間をおいて再送すべきなら RETRY を返します。
+        - 403 quotaExceeded / dailyLimitExceeded: そのキーは当日使わない
+        - 429, 403 rateLimitExceeded / userRateLimitExceeded: そのキーを指数バックオフ
+        """
+        state = next((s for s in self.keys if s.key == key), None)
+        if state is None:
+            return DONE
+        if status_code == 403 and ("quotaExceeded" in body or "dailyLimitExceeded" in body):
+            state.exhausted = True
+            print(f"YouTube API key {state.label()} quota exhausted")
+            self.retries += 1
+            return RETRY
+        if status_code == 429 or (
+            status_code == 403
+            and any(reason in body for reason in ("rateLimitExceeded", "userRateLimitExceeded"))
+        ):
+            state.failures += 1
+            delay = min(self.backoff_base * 2 ** (state.failures - 1), self.backoff_max)
+            # 同時に再送が集中しないようジッターを入れる
+            state.backoff_until = time.monotonic() + delay * random.uniform(0.5, 1.0)
+            self.retries += 1
+            return RETRY
+        state.failures = 0
+        return DONE
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        self._refill(now)
+        keys = [
+            {
+                "key": state.label(),
+                "used": state.used,
+                "remaining": 0 if state.exhausted else max(self.daily_quota - state.used, 0),
+                "exhausted": state.exhausted,
+                "backoff_seconds": round(max(state.backoff_until - now, 0), 2),
+            }
+            for state in self.keys
+        ]
+        return {
+            "keys": len(keys),
+            "daily_quota_per_key": self.daily_quota,
+            "used": sum(k["used"] for k in keys),
+            "remaining": self.remaining(),
+            "exhausted_keys": sum(1 for k in keys if k["exhausted"]),
+            "tokens": round(self._tokens, 2),
+            "waiting": len(self._waiters),
+            "retries": self.retries,
+            "granted": dict(self.granted),
+            "rejected": dict(self.rejected),
+            "lanes_open": {
+                name: self.lane_allowed(priority) for priority, name in _LANE_NAMES.items()
+            },
+            "key_states": keys,
+        }
@@ -0,0 +1,103 @@
+import asyncio
+import os
+from typing import Dict, Optional
+
+import firestore_service
+
+# --- ★ 利用回数の書き込みをまとめる (write-behind) ---
+# リクエストごとに get + update を行う代わりに、メモリ上で加算しておき
+# 一定間隔 or 一定量たまった時点で Firestore にまとめて Increment を書き込む
+FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "5"))
+FLUSH_THRESHOLD = int(os.getenv("USAGE_FLUSH_THRESHOLD", "200"))
+# シャットダウン時の最終書き込みのリトライ回数
+SHUTDOWN_FLUSH_ATTEMPTS = 3
+
+
+class UsageCounter:
+    """ユーザーごとの利用回数をバッファし、バッチ書き込みで反映する"""
+
+    def __init__(
+        self, flush_interval: float = FLUSH_INTERVAL, flush_threshold: int = FLUSH_THRESHOLD
+    ):
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._pending: Dict[str, int] = {}
+        self._pending_total = 0
+        self._writing: Dict[str, int] = {}
+        self._lock = asyncio.Lock()
+        self._loop_task: Optional[asyncio.Task] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self.flushes = 0
+        self.written_users = 0
+        self.written_increments = 0
+        self.failed_flushes = 0
+
+    def add(self, user_id: str, count: int = 1) -> None:
+        """利用回数を加算します（書き込みは待たない）"""
+        self._pending[user_id] = self._pending.get(user_id, 0) + count
+        self._pending_total += count
+        if self._pending_total >= self.flush_threshold and (
+            self._flush_task is None or self._flush_task.done()
+        ):
+            self._flush_task = asyncio.create_task(self.flush())
+
+    def pending_count(self, user_id: str) -> int:
+        """まだ Firestore に反映されていない加算数（書き込み中の分を含む）"""
+        return self._pending.get(user_id, 0) + self._writing.get(user_id, 0)
+
+    async def flush(self) -> bool:
+        """バッファの内容を Firestore に書き込みます。失敗した分はバッファに戻します。"""
+        async with self._lock:
+            if not self._pending:
+                return True
+            batch, self._pending = self._pending, {}
+            self._pending_total = 0
+            self._writing = batch
+            try:
+                await firestore_service.increment_usage_batch(batch)
+            except Exception as e:
+                print(f"Usage Flush Error: {e}")
+                # 次回の書き込みで再送する
+                self._writing = {}
+                for user_id, count in batch.items():
+                    self.add(user_id, count)
+                self.failed_flushes += 1
+                return False
+            self._writing = {}
+            self.flushes += 1
+            self.written_users += len(batch)
+            self.written_increments += sum(batch.values())
+            return True
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self) -> None:
+        if self._loop_task is None:
+            self._loop_task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """定期書き込みを止め、残りをすべて書き込みます（正常終了時にカウントを失わない）"""
+        if self._loop_task is not None:
+            self._loop_task.cancel()
+            await asyncio.gather(self._loop_task, return_exceptions=True)
+            self._loop_task = None
+        for _ in range(SHUTDOWN_FLUSH_ATTEMPTS):
+            if await self.flush():
+                return
+        print(f"Usage Flush Error: {self._pending_total} increments could not be written: {self._pending}")
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending_users": len(self._pending),
+            "pending_increments": self._pending_total,
+            "flushes": self.flushes,
+            "failed_flushes": self.failed_flushes,
+            "written_users": self.written_users,
+            "written_increments": self.written_increments,
+        }
+
+
+usage_counter = UsageCounter()
@@ -0,0 +1,226 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import entitlements
+import firestore_service
+
+# --- ★ Stripe Webhook の非同期処理キュー ---
+# Webhook は署名検証後にローカルの永続キュー (SQLite) へ積んで即座に 200 を返し、
+# 利用権限の更新はワーカーが行う。event.id を主キーにすることで Stripe の再送を重複排除する。
+QUEUE_PATH = os.getenv("WEBHOOK_QUEUE_PATH", "data/webhooks.db")
+POLL_INTERVAL = float(os.getenv("WEBHOOK_POLL_INTERVAL", "5"))
+MAX_ATTEMPTS = int(os.getenv("WEBHOOK_MAX_ATTEMPTS", "8"))
+MAX_BACKOFF = 300.0
+# ワーカー自体のエラー（SQLite の障害など）の後、次のポーリングまで待つ秒数
+ERROR_BACKOFF = float(os.getenv("WEBHOOK_ERROR_BACKOFF", "5"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS stripe_events (
+    event_id TEXT PRIMARY KEY,
+    type TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,
+    received_at REAL NOT NULL,
+    processed_at REAL,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_stripe_events_pending ON stripe_events (status, next_attempt_at);
+"""
+
+_conn: Optional[sqlite3.Connection] = None
+_lock = threading.Lock()
+_wakeup: Optional[asyncio.Event] = None
+_worker: Optional[asyncio.Task] = None
+
+
+def _connect() -> sqlite3.Connection:
+    global _conn
+    if _conn is None:
+        directory = os.path.dirname(QUEUE_PATH)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(QUEUE_PATH, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_SCHEMA)
+        _conn = conn
+    return _conn
+
+
+def _enqueue_sync(event_id: str, event_type: str, payload: str) -> bool:
+    now = time.time()
+    with _lock:
+        conn = _connect()
+        cur = conn.execute(
+            "INSERT OR IGNORE INTO stripe_events (event_id, type, payload, status, next_attempt_at, received_at) "
+            "VALUES (?, ?, ?, 'pending', ?, ?)",
+            (event_id, event_type, payload, now, now),
+        )
+        conn.commit()
+        return cur.rowcount == 1
+
+
+def _next_due_sync() -> Optional[Dict[str, Any]]:
+    with _lock:
+        row = _connect().execute(
+            "SELECT * FROM stripe_events WHERE status = 'pending' AND next_attempt_at <= ? "
+            "ORDER BY received_at LIMIT 1",
+            (time.time(),),
+        ).fetchone()
+    return dict(row) if row is not None else None
+
+
+def _mark_done_sync(event_id: str) -> None:
+    with _lock:
+        conn = _connect()
+        conn.execute(
+            "UPDATE stripe_events SET status = 'done', processed_at = ?, last_error = NULL WHERE event_id = ?",
+            (time.time(), event_id),
+        )
+        conn.commit()
+
+
+def _mark_failed_sync(event_id: str, attempts: int, error: str) -> None:
+    # 指数バックオフで再試行し、上限に達したら failed として残す（手動調査用）
+    status = "failed" if attempts >= MAX_ATTEMPTS else "pending"
+    delay = min(2 ** attempts, MAX_BACKOFF)
+    with _lock:
+        conn = _connect()
+        conn.execute(
+            "UPDATE stripe_events SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ? WHERE event_id = ?",
+            (status, attempts, time.time() + delay, error, event_id),
+        )
+        conn.commit()
+
+
+def stats() -> Dict[str, int]:
+    with _lock:
+        rows = _connect().execute(
+            "SELECT status, COUNT(*) FROM stripe_events GROUP BY status"
+        ).fetchall()
+    return {status: count for status, count in rows}
+
+
+async def enqueue(event_id: str, event_type: str, payload: str) -> bool:
+    """
+    イベントをキューに積みます。同じ event_id が既にあれば何もせず False を返します。
+    """
+    created = await asyncio.to_thread(_enqueue_sync, event_id, event_type, payload)
+    if created and _wakeup is not None:
+        _wakeup.set()
+    return created
+
+
+# --- イベントごとの処理 (何度実行しても同じ結果になるよう冪等に書く) ---
+
+async def apply_event(event_type: str, data_object: Dict[str, Any]) -> None:
+    # Case A: 決済完了 / トライアル開始
+    if event_type == "checkout.session.completed":
+        user_id = (data_object.get("metadata") or {}).get("user_id")
+        stripe_customer_id = data_object.get("customer")
+
+        if not user_id:
+            print("⚠️ User ID not found in session metadata.")
+            return
+
+        print(f"✅ Subscription started for User: {user_id}")
+        await firestore_service.set_user(
+            user_id,
+            {
+                "is_pro": True,
+                "stripe_customer_id": stripe_customer_id,
+                "updated_at": firestore_service.server_timestamp(),
+            },
+            merge=True,
+        )
+        # ★ 解約時にクエリせずに済むよう、顧客ID → ユーザーID の逆引きを保存
+        if stripe_customer_id:
+            await firestore_service.set_stripe_customer(stripe_customer_id, user_id)
+        # ★ キャッシュ済みの利用権限を破棄し、次回アクセスで Pro として読み直す
+        entitlements.invalidate(user_id)
+
+    # Case B: サブスクリプション解約 / 期限切れ
+    elif event_type == "customer.subscription.deleted":
+        stripe_customer_id = data_object.get("customer")
+        print(f"🚫 Subscription deleted for Customer: {stripe_customer_id}")
+        if not stripe_customer_id:
+            return
+
+        user_ids = await firestore_service.find_user_ids_by_stripe_customer(
+            stripe_customer_id
+        )
+        for found_user_id in user_ids:
+            print(f"Found user to downgrade: {found_user_id}")
+            await firestore_service.update_user(
+                found_user_id,
+                {"is_pro": False, "updated_at": firestore_service.server_timestamp()},
+            )
+            entitlements.invalidate(found_user_id)
+
+        if not user_ids:
+            print(f"⚠️ No user found with Stripe Customer ID: {stripe_customer_id}")
+
+    elif event_type == "invoice.payment_failed":
+        print(f"⚠️ Payment failed for Customer: {data_object.get('customer')}")
+
+
+async def _process(row: Dict[str, Any]) -> None:
+    try:
+        # 壊れた payload も失敗として記録し、同じイベントで止まり続けないようにする
+        event = json.loads(row["payload"])
+        await apply_event(row["type"], event["data"]["object"])
+    except Exception as e:
+        print(f"❌ Webhook Processing Error ({row['type']} {row['event_id']}): {e}")
+        await asyncio.to_thread(
+            _mark_failed_sync, row["event_id"], row["attempts"] + 1, str(e)
+        )
+        return
+    await asyncio.to_thread(_mark_done_sync, row["event_id"])
+
+
+async def _run() -> None:
+    while True:
+        # ポーリングの前に clear する（照会・処理の最中に積まれたイベントの通知を消さないように）
+        _wakeup.clear()
+        try:
+            row = await asyncio.to_thread(_next_due_sync)
+            if row is not None:
+                await _process(row)
+                continue
+        except Exception as e:
+            # 想定外のエラーでワーカーが終了するとキューが止まるため、記録して間を置いて続ける
+            print(f"❌ Webhook Worker Error: {e}")
+            await asyncio.sleep(ERROR_BACKOFF)
+            continue
+        # 新しいイベントが積まれるか、再試行時刻になるまで待つ
+        try:
+            await asyncio.wait_for(_wakeup.wait(), POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+def start() -> None:
+    """ワーカーを起動します。前回終了時に未処理だったイベントもここから再開されます。"""
+    global _wakeup, _worker
+    if _worker is None:
+        _wakeup = asyncio.Event()
+        _worker = asyncio.create_task(_run())
+
+
+async def stop() -> None:
+    global _worker, _conn
+    if _worker is not None:
+        _worker.cancel()
+        await asyncio.gather(_worker, return_exceptions=True)
+        _worker = None
+    with _lock:
+        if _conn is not None:
+            _conn.close()
+            _conn = None
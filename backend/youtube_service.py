@@ -1,59 +1,552 @@
 import httpx  # requests の代わりに httpx を使用
+import asyncio
 import os
-from typing import Dict, Any, Optional
+from typing import Dict, Any, AsyncIterator, Callable, List, Optional, Tuple, TypedDict, Union
 import datetime
 
+import orjson
+
+import metrics
+
+from cache import TTLCache
+from upstream_scheduler import (
+    PRIORITY_BACKGROUND,
+    PRIORITY_FREE,
+    PRIORITY_PRO,
+    RETRY,
+    RequestPriority,
+    UpstreamScheduler,
+    UpstreamUnavailableError,
+)
+
 URL = "https://www.googleapis.com/youtube/v3/"
 API_MAX_RESULTS = 100
 
+# --- ★ 共有HTTPクライアント設定 ---
+# リクエストごとに AsyncClient を作ると毎回 TCP+TLS ハンドシェイクが発生するため、
+# アプリ全体で1つのクライアント（コネクションプール）を使い回す
+HTTP2_ENABLED = os.getenv("YOUTUBE_HTTP2", "true").lower() == "true"
+MAX_CONNECTIONS = int(os.getenv("YOUTUBE_MAX_CONNECTIONS", "100"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("YOUTUBE_MAX_KEEPALIVE_CONNECTIONS", "20"))
+KEEPALIVE_EXPIRY = float(os.getenv("YOUTUBE_KEEPALIVE_EXPIRY", "30"))
+CONNECT_TIMEOUT = float(os.getenv("YOUTUBE_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("YOUTUBE_READ_TIMEOUT", "15"))
+POOL_TIMEOUT = float(os.getenv("YOUTUBE_POOL_TIMEOUT", "10"))
+
+_client: Optional[httpx.AsyncClient] = None
+_request_count = 0
+
+# --- ★ コメントページのキャッシュ設定 ---
+# 人気動画に同時アクセスが集中しても、同じページは1回だけ YouTube API に問い合わせる
+PAGE_CACHE_MAX_ENTRIES = int(os.getenv("COMMENT_CACHE_MAX_ENTRIES", "512"))
+PAGE_CACHE_TTL = float(os.getenv("COMMENT_CACHE_TTL", "120"))
+
+page_cache = TTLCache(
+    max_entries=PAGE_CACHE_MAX_ENTRIES, ttl=PAGE_CACHE_TTL, name="comment_pages"
+)
+# 読み込み中のページ (video_id, page_token) -> その読み込みの送信優先度
+# （合流した呼び出し元が、自分のレーンまで引き上げられるように）
+_page_loads: Dict[Tuple[str, Optional[str]], RequestPriority] = {}
+
+# --- ★ 先読み (read-ahead) 設定 ---
+# ページを返した直後に次の1〜2ページをバックグラウンドで取得しておき、
+# 「もっと見る」の次リクエストをキャッシュから即答する。0 で無効
+PREFETCH_DEPTH = int(os.getenv("YOUTUBE_PREFETCH_DEPTH", "1"))
+PREFETCH_CONCURRENCY = int(os.getenv("YOUTUBE_PREFETCH_CONCURRENCY", "4"))
+PREFETCH_MAX_PENDING = int(os.getenv("YOUTUBE_PREFETCH_MAX_PENDING", "64"))
+
+# --- ★ 差分取得 ---
+# 既知の最新コメントに到達するまでしか遡らない。これを超えるページ数が必要なら全件取得し直す
+DELTA_MAX_PAGES = int(os.getenv("YOUTUBE_DELTA_MAX_PAGES", "20"))
+
+# --- ★ 返信の全件展開 (opt-in) ---
+# commentThreads に埋め込まれる返信は数件だけなので、残りを comments.list (parentId) で取得する。
+# スレッドごとの取得を並列に行い、同時実行数はセマフォで制限する
+REPLY_CONCURRENCY = int(os.getenv("YOUTUBE_REPLY_CONCURRENCY", "8"))
+# 1スレッドあたりの最大ページ数 (1ページ = 100件 = 1クォータ)
+REPLY_MAX_PAGES = int(os.getenv("YOUTUBE_REPLY_MAX_PAGES", "10"))
+COMMENTS_COST = 1  # comments.list 1回あたりの消費ユニット
+
+_reply_semaphore = asyncio.Semaphore(REPLY_CONCURRENCY)
+
+# --- ★ 複数動画の一括取得 ---
+# videos.list は1回で最大50件の動画情報（タイトル・コメント数）を返す
+VIDEOS_LIST_MAX_IDS = 50
+VIDEOS_COST = 1  # videos.list 1回あたりの消費ユニット
+BATCH_MAX_VIDEOS = int(os.getenv("YOUTUBE_BATCH_MAX_VIDEOS", "50"))
+# 一括取得で同時に取りに行く動画数
+BATCH_CONCURRENCY = int(os.getenv("YOUTUBE_BATCH_CONCURRENCY", "8"))
+
+_batch_semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+_prefetch_semaphore = asyncio.Semaphore(PREFETCH_CONCURRENCY)
+_prefetch_tasks: Dict[Tuple[str, str], asyncio.Task] = {}
+
+# --- ★ クォータ・レート制御 (upstream_scheduler) ---
+# YOUTUBE_API_KEYS にカンマ区切りで複数のキーを指定すると、残量の多いキーから順に使う
+DAILY_QUOTA = int(os.getenv("YOUTUBE_DAILY_QUOTA", "10000"))  # キー1つあたり
+# 残りがこの割合を切ったら先読み (バックグラウンド) を止める
+PREFETCH_MIN_QUOTA_RATIO = float(os.getenv("YOUTUBE_PREFETCH_MIN_QUOTA_RATIO", "0.2"))
+# 残りがこの割合を切ったら無料ユーザーのリクエストを止め、Pro ユーザーに残す
+PRO_RESERVE_QUOTA_RATIO = float(os.getenv("YOUTUBE_PRO_RESERVE_QUOTA_RATIO", "0.05"))
+RATE_PER_SECOND = float(os.getenv("YOUTUBE_RATE_PER_SECOND", "50"))  # 0 で無制限
+RATE_BURST = int(os.getenv("YOUTUBE_RATE_BURST", "20"))
+# 送信権を待つ最大秒数（超えたらエラーを返す）
+SCHEDULER_MAX_WAIT = float(os.getenv("YOUTUBE_SCHEDULER_MAX_WAIT", "10"))
+# 429 / quotaExceeded を受けたときの再送回数（別のキー・バックオフ後）
+MAX_ATTEMPTS = int(os.getenv("YOUTUBE_MAX_ATTEMPTS", "3"))
+COMMENT_THREADS_COST = 1  # commentThreads.list 1回あたりの消費ユニット
+
+# --- ★ 部分レスポンス (fields=) ---
+# 整形で使う項目だけを YouTube に返させ、転送量とデコード時間を減らす
+PARTIAL_RESPONSE = os.getenv("YOUTUBE_PARTIAL_RESPONSE", "1") != "0"
+
+
+def _api_keys() -> List[Optional[str]]:
+    keys = [k.strip() for k in os.getenv("YOUTUBE_API_KEYS", "").split(",") if k.strip()]
+    return keys or [os.getenv("YOUTUBE_API_KEY")]
+
+
+scheduler = UpstreamScheduler(
+    keys_loader=_api_keys,
+    daily_quota=DAILY_QUOTA,
+    rate_per_second=RATE_PER_SECOND,
+    burst=RATE_BURST,
+    pro_reserve_ratio=PRO_RESERVE_QUOTA_RATIO,
+    background_min_ratio=PREFETCH_MIN_QUOTA_RATIO,
+    max_wait=SCHEDULER_MAX_WAIT,
+)
+
+
+def _http2_available() -> bool:
+    """HTTP/2 は h2 パッケージがある場合のみ有効化できる"""
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def create_client(
+    transport: Optional[httpx.AsyncBaseTransport] = None,
+) -> httpx.AsyncClient:
+    """
+    keep-alive プール付きの AsyncClient を生成します。
+    transport を渡すとテストやベンチマーク用のスタブに差し替えられます。
+    """
+    http2 = HTTP2_ENABLED and _http2_available()
+    if HTTP2_ENABLED and not http2:
+        print("Warning: YOUTUBE_HTTP2 is enabled but 'h2' is not installed. Falling back to HTTP/1.1.")
+
+    return httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=MAX_CONNECTIONS,
+            max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(
+            READ_TIMEOUT, connect=CONNECT_TIMEOUT, pool=POOL_TIMEOUT
+        ),
+        transport=transport,
+    )
+
+
+async def startup_client(
+    transport: Optional[httpx.AsyncBaseTransport] = None,
+) -> httpx.AsyncClient:
+    """FastAPI の lifespan から呼び出し、共有クライアントを作成します。"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = create_client(transport)
+    return _client
+
+
+async def shutdown_client() -> None:
+    """lifespan 終了時にプール内のコネクションをすべて閉じます。"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def get_client() -> httpx.AsyncClient:
+    """
+    共有クライアントを返します。
+    lifespan 外（スクリプト等）から呼ばれた場合は遅延生成します。
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = create_client()
+    return _client
+
+
+def priority_for(is_pro: bool) -> int:
+    """ユーザーのプランに対応する優先レーン"""
+    return PRIORITY_PRO if is_pro else PRIORITY_FREE
+
+
+def get_quota_stats() -> Dict[str, Any]:
+    stats = scheduler.stats()
+    stats["prefetch_enabled"] = prefetch_allowed()
+    return stats
+
+
+def prefetch_allowed() -> bool:
+    return PREFETCH_DEPTH > 0 and scheduler.lane_allowed(PRIORITY_BACKGROUND)
+
+
+async def _get(
+    path: str,
+    params: Dict[str, Any],
+    priority: Union[int, RequestPriority],
+    operation: str,
+    cost: int = 1,
+) -> httpx.Response:
+    """
+    スケジューラから送信権と API キーを受け取って GET します。
+    クォータ切れ・レート制限の応答なら、別のキー（またはバックオフ後）で再送します。
+    送信できない場合は UpstreamUnavailableError を送出します。
+    """
+    global _request_count
+    # ★ 共有クライアントを使い回す（コネクションは閉じずにプールへ戻る）
+    client = get_client()
+    for _ in range(MAX_ATTEMPTS):
+        key = await scheduler.acquire(priority, cost)
+        _request_count += 1
+        with metrics.upstream("youtube", operation):
+            response = await client.get(URL + path, params={**params, "key": key})
+        body = response.text if response.status_code in (403, 429) else ""
+        if scheduler.report(key, response.status_code, body) != RETRY:
+            break
+    return response
+
+
+def schedule_prefetch(
+    video_id: str, next_page_token: Optional[str], depth: Optional[int] = None
+) -> None:
+    """
+    次ページ以降の先読みをバックグラウンドで開始します（待たずに戻る）。
+    同じ起点の先読みが進行中の場合や、保留タスクが上限に達している場合は何もしません。
+    """
+    depth = PREFETCH_DEPTH if depth is None else depth
+    if not next_page_token or depth <= 0 or not prefetch_allowed():
+        return
+
+    key = (video_id, next_page_token)
+    if key in _prefetch_tasks or len(_prefetch_tasks) >= PREFETCH_MAX_PENDING:
+        return
+
+    task = asyncio.create_task(_prefetch_chain(video_id, next_page_token, depth))
+    _prefetch_tasks[key] = task
+    task.add_done_callback(lambda _: _prefetch_tasks.pop(key, None))
+
+
+async def _prefetch_chain(video_id: str, page_token: str, depth: int) -> None:
+    token: Optional[str] = page_token
+    for _ in range(depth):
+        if not token or not prefetch_allowed():
+            return
+        async with _prefetch_semaphore:
+            result = await fetch_comments_page(video_id, token, PRIORITY_BACKGROUND)
+        if result.get("status") != "success":
+            return
+        token = result.get("next_page_token")
+
+
+async def cancel_prefetches() -> None:
+    """シャットダウン時に進行中の先読みをすべてキャンセルします。"""
+    tasks = list(_prefetch_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    _prefetch_tasks.clear()
+
+
+def get_pool_stats() -> Dict[str, Any]:
+    """プールのサイズ調整用に、現在のコネクション状況を返します。"""
+    stats: Dict[str, Any] = {
+        "started": _client is not None and not _client.is_closed,
+        "http2_enabled": HTTP2_ENABLED and _http2_available(),
+        "max_connections": MAX_CONNECTIONS,
+        "max_keepalive_connections": MAX_KEEPALIVE_CONNECTIONS,
+        "requests_sent": _request_count,
+        "connections": 0,
+        "active": 0,
+        "idle": 0,
+        "http2_connections": 0,
+        "in_flight_requests": 0,
+        "queued_requests": 0,
+    }
+    if not stats["started"]:
+        return stats
+
+    # httpx は公開APIでプール状態を出さないため、httpcore のプールを参照する
+    pool = getattr(getattr(_client, "_transport", None), "_pool", None)
+    if pool is None:
+        return stats
+
+    connections = list(getattr(pool, "connections", []))
+    stats["connections"] = len(connections)
+    for conn in connections:
+        if conn.is_idle():
+            stats["idle"] += 1
+        else:
+            stats["active"] += 1
+        if "HTTP/2" in conn.info():
+            stats["http2_connections"] += 1
+    pool_requests = list(getattr(pool, "_requests", []))
+    stats["in_flight_requests"] = len(pool_requests)
+    stats["queued_requests"] = sum(
+        1 for req in pool_requests if getattr(req, "connection", None) is None
+    )
+    return stats
+
+
+class CommentRecord(TypedDict, total=False):
+    """整形済みコメント1件の形（API レスポンス・キャッシュ・保存で共通）"""
+
+    id: Optional[str]  # commentThread の ID（返信はコメント ID）。差分取得の目印に使う
+    author: Optional[str]
+    date: Optional[str]
+    text: Optional[str]
+    likes: int
+    totalReplies: int
+    replies: List["CommentRecord"]
+
+
+# クライアントが fields= で選べる項目
+COMMENT_FIELDS = tuple(CommentRecord.__annotations__)
+
+
+def parse_fields(value: Optional[str]) -> Optional[Tuple[str, ...]]:
+    """
+    "author,text,likes" を項目のタプルにします。空なら None（全項目）。
+    未知の項目があれば ValueError。
+    """
+    if not value:
+        return None
+    fields = tuple(dict.fromkeys(name.strip() for name in value.split(",") if name.strip()))
+    unknown = [name for name in fields if name not in COMMENT_FIELDS]
+    if unknown:
+        raise ValueError(
+            f"Unknown fields: {', '.join(unknown)} (available: {', '.join(COMMENT_FIELDS)})"
+        )
+    return fields or None
+
+
+def project_comments(
+    comments: List[Dict[str, Any]], fields: Optional[Tuple[str, ...]]
+) -> List[Dict[str, Any]]:
+    """
+    指定した項目だけを持つ新しいコメント一覧を返します（返信にも同じ項目を適用）。
+    ※ 引数の辞書（ページキャッシュと共有）は書き換えない
+    """
+    if fields is None:
+        return comments
+    reply_fields = tuple(name for name in fields if name != "replies")
+    projected = []
+    for comment in comments:
+        record = {name: comment[name] for name in fields if name in comment}
+        if "replies" in record:
+            record["replies"] = [
+                {name: reply[name] for name in reply_fields if name in reply}
+                for reply in record["replies"]
+            ]
+        projected.append(record)
+    return projected
+
+
+def format_date(pubdate_str: Any) -> Any:
+    """
+    ISO 8601 (YYYY-MM-DDTHH:MM:SSZ) を "YYYY/MM/DD HH:MM:SS" に変換します。
+    YouTube の publishedAt は常にこの固定長形式なので、strptime/strftime を使わず
+    文字列の切り出しで変換する。それ以外の形式はそのまま返す（従来と同じ挙動）。
+    """
+    if (
+        isinstance(pubdate_str, str)
+        and len(pubdate_str) == 20
+        and pubdate_str[4] == "-"
+        and pubdate_str[7] == "-"
+        and pubdate_str[10] == "T"
+        and pubdate_str[13] == ":"
+        and pubdate_str[16] == ":"
+        and pubdate_str[19] == "Z"
+    ):
+        year, month, day = pubdate_str[0:4], pubdate_str[5:7], pubdate_str[8:10]
+        hour, minute, second = pubdate_str[11:13], pubdate_str[14:16], pubdate_str[17:19]
+        digits = year + month + day + hour + minute + second
+        # 半角数字で、どの月でも有効な範囲（日は 28 日まで）なら切り出しだけで済む。
+        # それ以外（29〜31日・1000年より前・全角数字・範囲外の値など）は従来どおり strptime で判定する
+        if (
+            digits.isascii()
+            and digits.isdigit()
+            and year >= "1000"
+            and "01" <= month <= "12"
+            and "01" <= day <= "28"
+            and hour < "24"
+            and minute < "60"
+            and second < "60"
+        ):
+            return f"{year}/{month}/{day} {hour}:{minute}:{second}"
+
+    try:
+        pubdate = datetime.datetime.strptime(pubdate_str, "%Y-%m-%dT%H:%M:%SZ")
+        return pubdate.strftime("%Y/%m/%d %H:%M:%S")
+    except (ValueError, TypeError, AttributeError):
+        return pubdate_str
+
 
 def format_comment_data(
     snippet_data: Dict[str, Any], is_reply: bool = False
-) -> Dict[str, Any]:
+) -> CommentRecord:
     """コメントまたは返信のデータを整形して辞書として返します。"""
 
     if is_reply:
         target_snippet = snippet_data.get("snippet", {})
+        comment_id = snippet_data.get("id")
         reply_count = 0
     else:
         # commentThreadsのitemまたはrepliesの中のコメントかを判断
         if "topLevelComment" in snippet_data:
             target_snippet = snippet_data["topLevelComment"]["snippet"]
+            # トップレベルコメントの ID はスレッドの ID と同じ
+            comment_id = snippet_data["topLevelComment"].get("id")
         else:
             target_snippet = snippet_data["snippet"]
+            comment_id = snippet_data.get("id")
 
         reply_count = snippet_data.get("totalReplyCount", 0)
 
-    author = target_snippet.get("authorDisplayName")
-    pubdate_str = target_snippet.get("publishedAt")
-    text = target_snippet.get("textDisplay")
-    like_cnt = target_snippet.get("likeCount", 0)
-
-    try:
-        # ISO 8601形式の時刻文字列を整形
-        pubdate = datetime.datetime.strptime(pubdate_str, "%Y-%m-%dT%H:%M:%SZ")
-        pubdate_formatted = pubdate.strftime("%Y/%m/%d %H:%M:%S")
-    except (ValueError, TypeError, AttributeError):
-        pubdate_formatted = pubdate_str
-
     return {
-        "author": author,
-        "date": pubdate_formatted,
-        "text": text,
-        "likes": like_cnt,
+        "id": comment_id,
+        "author": target_snippet.get("authorDisplayName"),
+        "date": format_date(target_snippet.get("publishedAt")),
+        "text": target_snippet.get("textDisplay"),
+        "likes": target_snippet.get("likeCount", 0),
         "totalReplies": reply_count,
     }
 
 
+def format_thread(item: Dict[str, Any]) -> CommentRecord:
+    """commentThreads の item 1件を、返信を含めて整形します。"""
+    comment = format_comment_data(item["snippet"], is_reply=False)
+    replies = item.get("replies")
+    comment["replies"] = (
+        [format_comment_data(reply, is_reply=True) for reply in replies.get("comments", ())]
+        if replies
+        else []
+    )
+    return comment
+
+
+
+class _FieldRecorder:
+    """
+    整形関数に API レスポンスの代わりに渡し、読まれたキーを木として記録する。
+    配列は要素1つ分として扱う（fields= の書式では配列は透過的なため）。
+    """
+
+    def __init__(self) -> None:
+        self.children: Dict[str, "_FieldRecorder"] = {}
+
+    def _child(self, key: str) -> "_FieldRecorder":
+        return self.children.setdefault(key, _FieldRecorder())
+
+    def get(self, key: str, default: Any = None) -> "_FieldRecorder":
+        return self._child(key)
+
+    def __getitem__(self, key: str) -> "_FieldRecorder":
+        return self._child(key)
+
+    def __contains__(self, key: str) -> bool:
+        self._child(key)
+        return True
+
+    def __iter__(self):
+        yield self
+
+    def selector(self) -> str:
+        """記録したキーを fields= の書式 (a,b(c,d)) にする"""
+        return ",".join(
+            f"{key}({child.selector()})" if child.children else key
+            for key, child in self.children.items()
+        )
+
+
+def fields_selector(formatter: Callable[[Any], Any], **envelope: Any) -> str:
+    """
+    formatter が items の各要素から読む項目と、ページ自体で読む項目 (envelope) から
+    YouTube の fields= パラメータを作る。envelope は {"pageInfo": ["totalResults"]} の形。
+    """
+    page = _FieldRecorder()
+    for key, children in envelope.items():
+        node = page._child(key)
+        for child in children:
+            node._child(child)
+    formatter(page._child("items"))
+    return page.selector()
+
+
+# 整形関数が実際に読む項目から生成するため、整形側に項目を足せば自動で追従する
+COMMENT_THREADS_FIELDS = fields_selector(
+    format_thread, nextPageToken=[], pageInfo=["totalResults"]
+)
+COMMENTS_FIELDS = fields_selector(
+    lambda item: format_comment_data(item, is_reply=True), nextPageToken=[]
+)
+
+
 async def fetch_comments_page(
-    video_id: str, page_token: Optional[str] = None
+    video_id: str, page_token: Optional[str] = None, priority: int = PRIORITY_FREE
+) -> Dict[str, Any]:
+    """
+    指定されたページのコメント（最大100件）を返します。
+    (video_id, page_token) 単位でキャッシュし、同時リクエストは1回の取得にまとめます。
+    priority は upstream_scheduler の優先レーン (PRIORITY_PRO / FREE / BACKGROUND)。
+    ※ 返り値はキャッシュと共有されるため、呼び出し側で書き換えないこと
+    """
+    key = (video_id, page_token)
+    load_priority = _page_loads.get(key)
+    joined = load_priority is not None
+    if joined:
+        # 同じページを読み込み中（先読みなど）。その送信待ちをこちらのレーンまで引き上げる
+        load_priority.raise_to(priority)
+    elif page_cache.peek(key) is None:
+        # これから読み込みを始める。合流した呼び出し元が優先度を引き上げられるよう登録する
+        load_priority = RequestPriority(priority)
+        _page_loads[key] = load_priority
+
+    async def load() -> Dict[str, Any]:
+        try:
+            return await _fetch_comments_page_uncached(video_id, page_token, load_priority)
+        finally:
+            if _page_loads.get(key) is load_priority:
+                del _page_loads[key]
+
+    def should_cache(result: Dict[str, Any]) -> bool:
+        return result.get("status") == "success"
+
+    result = await page_cache.get_or_load(key, load, should_cache=should_cache)
+    if joined and result.get("message") == "YouTube API Unavailable":
+        # 合流した読み込みが低いレーンのまま断られた場合は、自分のレーンで1回だけ取り直す
+        result = await page_cache.get_or_load(
+            key,
+            lambda: _fetch_comments_page_uncached(video_id, page_token, priority),
+            should_cache=should_cache,
+        )
+    return result
+
+
+async def _fetch_comments_page_uncached(
+    video_id: str,
+    page_token: Optional[str] = None,
+    priority: Union[int, RequestPriority] = PRIORITY_FREE,
 ) -> Dict[str, Any]:
     """
     指定されたページのコメント（最大100件）のみを非同期で取得して返します。
     """
-    API_KEY = os.getenv("YOUTUBE_API_KEY")
     params = {
-        "key": API_KEY,
         "part": "replies, snippet",
         "videoId": video_id,
         "order": "time",
@@ -62,26 +555,19 @@ async def fetch_comments_page(
     }
     if page_token:
         params["pageToken"] = page_token
+    if PARTIAL_RESPONSE:
+        params["fields"] = COMMENT_THREADS_FIELDS
 
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(URL + "commentThreads", params=params)
-            response.raise_for_status()
-            resource = response.json()
-
-        comments_data = []
-        for item in resource.get("items", []):
-            # コメント整形処理（既存ロジックと同じ）
-            snippet = item["snippet"]
-            comment = format_comment_data(snippet, is_reply=False)
-
-            # 返信の処理
-            replies = []
-            if "replies" in item and "comments" in item["replies"]:
-                for reply_info in item["replies"]["comments"]:
-                    replies.append(format_comment_data(reply_info, is_reply=True))
-            comment["replies"] = replies
-            comments_data.append(comment)
+        response = await _get(
+            "commentThreads", params, priority, "commentThreads.list", COMMENT_THREADS_COST
+        )
+        response.raise_for_status()
+        # ★ orjson で本文のバイト列を直接デコード (response.json() より高速)
+        resource = orjson.loads(response.content)
+
+        with metrics.span("format"):
+            comments_data = [format_thread(item) for item in resource.get("items", [])]
 
         return {
             "status": "success",
@@ -95,11 +581,267 @@ async def fetch_comments_page(
 
     except httpx.HTTPStatusError as e:
         return {"status": "error", "message": "YouTube API Error", "detail": str(e)}
+    except UpstreamUnavailableError as e:
+        # クォータ切れ・混雑。先読みやキャッシュ済みのページは引き続き返せる
+        return {"status": "error", "message": "YouTube API Unavailable", "detail": str(e)}
     except Exception as e:
         return {"status": "error", "message": "Server Error", "detail": str(e)}
 
 
-# 互換性のための同期ラッパー（必要であれば）
-def fetch_comments_with_pagination(video_id, goal_max_results):
-    # 既存のロジックが必要な箇所があれば残すが、基本は上記async関数に移行推奨
-    pass
+class YouTubeAPIError(Exception):
+    """ページ取得失敗をジェネレータの呼び出し元へ伝えるための例外"""
+
+    def __init__(self, result: Dict[str, Any]):
+        super().__init__(result.get("detail"))
+        self.result = result
+
+
+async def iter_comment_pages(
+    video_id: str, page_token: Optional[str] = None, priority: int = PRIORITY_FREE
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    全ページを先頭から順に取得し、1ページずつ yield する非同期ジェネレータ。
+    現在のページを処理している間に次ページの取得を先行して開始します。
+    一括取得はページキャッシュを汚さないよう、キャッシュを経由しません。
+    """
+    next_fetch = asyncio.ensure_future(
+        _fetch_comments_page_uncached(video_id, page_token, priority)
+    )
+    try:
+        while next_fetch is not None:
+            page = await next_fetch
+            next_fetch = None
+            if page.get("status") != "success":
+                raise YouTubeAPIError(page)
+
+            token = page.get("next_page_token")
+            if token:
+                next_fetch = asyncio.ensure_future(
+                    _fetch_comments_page_uncached(video_id, token, priority)
+                )
+            yield page
+    finally:
+        # 途中で打ち切られた場合（クライアント切断など）は先行取得を止める
+        if next_fetch is not None:
+            next_fetch.cancel()
+
+
+def _is_known(comment: Dict[str, Any], watermark: Dict[str, Any]) -> bool:
+    """watermark（既知の最新コメント）以前のコメントか"""
+    if watermark.get("comment_id") and comment.get("id") == watermark["comment_id"]:
+        return True
+    # 目印のコメントが削除されていた場合に備え、日時でも判定する
+    # (date は "YYYY/MM/DD HH:MM:SS" 形式なので文字列比較で前後関係がわかる)
+    known_date, date = watermark.get("published_at"), comment.get("date")
+    return bool(known_date and date and date < known_date)
+
+
+async def fetch_new_comments(
+    video_id: str,
+    watermark: Dict[str, Any],
+    max_pages: Optional[int] = None,
+    priority: int = PRIORITY_FREE,
+) -> Dict[str, Any]:
+    """
+    watermark ({"comment_id", "published_at"}) より新しいコメントだけを新しい順に返します。
+    order=time で新しい順に並ぶため、既知のコメントに到達したページで打ち切ります
+    （新着が数十件なら 1 ページ = 1 クォータで済む）。
+    max_pages 以内に到達できなかった場合は complete=False を返します（全件の再取得が必要）。
+    """
+    max_pages = max_pages or DELTA_MAX_PAGES
+    new_comments: List[Dict[str, Any]] = []
+    page_token = None
+    for pages in range(1, max_pages + 1):
+        result = await _fetch_comments_page_uncached(video_id, page_token, priority)
+        if result.get("status") != "success":
+            return result
+        if page_token is None:
+            # 取得したばかりの先頭ページで /api/comments のキャッシュも更新しておく
+            page_cache.set((video_id, None), result)
+
+        for comment in result["comments"]:
+            if _is_known(comment, watermark):
+                return {"status": "success", "comments": new_comments, "pages": pages, "complete": True}
+            new_comments.append(comment)
+
+        page_token = result.get("next_page_token")
+        if not page_token:
+            # 最後まで読んだ（既知のコメントがすべて消えていた）
+            return {"status": "success", "comments": new_comments, "pages": pages, "complete": True}
+
+    return {"status": "success", "comments": new_comments, "pages": max_pages, "complete": False}
+
+
+async def fetch_replies(
+    parent_id: str, priority: int = PRIORITY_FREE
+) -> List[CommentRecord]:
+    """
+    スレッドの返信を comments.list (parentId) で全件取得します（REPLY_MAX_PAGES ページまで）。
+    失敗時は httpx / スケジューラの例外をそのまま送出します。
+    """
+    params = {
+        "part": "snippet",
+        "parentId": parent_id,
+        "textFormat": "plaintext",
+        "maxResults": API_MAX_RESULTS,
+    }
+    if PARTIAL_RESPONSE:
+        params["fields"] = COMMENTS_FIELDS
+    replies: List[CommentRecord] = []
+    for _ in range(REPLY_MAX_PAGES):
+        async with _reply_semaphore:
+            response = await _get("comments", params, priority, "comments.list", COMMENTS_COST)
+        response.raise_for_status()
+        resource = orjson.loads(response.content)
+        replies.extend(
+            format_comment_data(item, is_reply=True) for item in resource.get("items", [])
+        )
+        page_token = resource.get("nextPageToken")
+        if not page_token:
+            break
+        params["pageToken"] = page_token
+    return replies
+
+
+async def expand_replies(
+    comments: List[Dict[str, Any]], priority: int = PRIORITY_FREE
+) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+    """
+    埋め込み分より返信が多いスレッドだけ、返信を全件に差し替えた新しいコメント一覧を返します。
+    スレッドごとの取得は並列に行うため、全体の所要時間は最も遅いスレッドとほぼ同じになる。
+    取得に失敗したスレッドは埋め込みの返信のまま返します。
+    ※ 引数の辞書（ページキャッシュと共有）は書き換えない
+    """
+    targets = [
+        index
+        for index, comment in enumerate(comments)
+        if comment.get("id") and comment.get("totalReplies", 0) > len(comment.get("replies") or ())
+    ]
+    stats = {"expanded_threads": 0, "failed_threads": 0, "fetched_replies": 0}
+    if not targets:
+        return comments, stats
+
+    results = await asyncio.gather(
+        *(fetch_replies(comments[index]["id"], priority) for index in targets),
+        return_exceptions=True,
+    )
+    expanded = list(comments)
+    for index, replies in zip(targets, results):
+        if isinstance(replies, BaseException):
+            print(f"Reply expansion error ({comments[index]['id']}): {replies}")
+            stats["failed_threads"] += 1
+            continue
+        expanded[index] = {**comments[index], "replies": replies}
+        stats["expanded_threads"] += 1
+        stats["fetched_replies"] += len(replies)
+    return expanded, stats
+
+
+async def fetch_comments_page_with_replies(
+    video_id: str, page_token: Optional[str] = None, priority: int = PRIORITY_FREE
+) -> Dict[str, Any]:
+    """
+    fetch_comments_page の結果に、返信を全件展開したものを返します。
+    展開済みのページも (video_id, page_token, "replies") でキャッシュします。
+    """
+    async def load() -> Dict[str, Any]:
+        page = await fetch_comments_page(video_id, page_token, priority)
+        if page.get("status") != "success":
+            return page
+        comments, stats = await expand_replies(page["comments"], priority)
+        return {**page, "comments": comments, "reply_expansion": stats}
+
+    return await page_cache.get_or_load(
+        (video_id, page_token, "replies"),
+        load,
+        # 一部のスレッドで失敗した結果はキャッシュせず、次回取り直す
+        should_cache=lambda result: result.get("status") == "success"
+        and not result["reply_expansion"]["failed_threads"],
+    )
+
+
+def format_video(item: Dict[str, Any]) -> Dict[str, Any]:
+    """videos.list の item 1件を整形します（統計は文字列で返るため数値に直す）"""
+    snippet = item.get("snippet", {})
+    statistics = item.get("statistics", {})
+
+    def count(name: str) -> Optional[int]:
+        value = statistics.get(name)
+        return int(value) if value is not None else None
+
+    return {
+        "title": snippet.get("title"),
+        "channel_title": snippet.get("channelTitle"),
+        "published_at": format_date(snippet.get("publishedAt")),
+        "view_count": count("viewCount"),
+        "like_count": count("likeCount"),
+        # コメントが無効な動画では commentCount 自体が返らない
+        "comment_count": count("commentCount"),
+    }
+
+
+async def fetch_videos(
+    video_ids: List[str], priority: int = PRIORITY_FREE
+) -> Dict[str, Dict[str, Any]]:
+    """
+    videos.list で動画情報を取得し、{video_id: format_video の結果} を返します。
+    50件ごとに1リクエスト。存在しない・非公開の動画は結果に含まれません。
+    失敗時は httpx / スケジューラの例外をそのまま送出します。
+    """
+    videos: Dict[str, Dict[str, Any]] = {}
+    for start in range(0, len(video_ids), VIDEOS_LIST_MAX_IDS):
+        params = {
+            "part": "snippet,statistics",
+            "id": ",".join(video_ids[start:start + VIDEOS_LIST_MAX_IDS]),
+            "maxResults": VIDEOS_LIST_MAX_IDS,
+            # 使う項目だけを返させて応答を小さくする
+            "fields": "items(id,snippet(title,channelTitle,publishedAt),"
+            "statistics(viewCount,likeCount,commentCount))",
+        }
+        response = await _get("videos", params, priority, "videos.list", VIDEOS_COST)
+        response.raise_for_status()
+        for item in orjson.loads(response.content).get("items", []):
+            videos[item["id"]] = format_video(item)
+    return videos
+
+
+async def fetch_first_pages(
+    video_ids: List[str], priority: int = PRIORITY_FREE, with_replies: bool = False
+) -> List[Dict[str, Any]]:
+    """
+    複数動画の動画情報と最初のコメントページをまとめて取得します（video_ids の順）。
+    動画情報は videos.list 1回で取得し、存在しない・コメントが無効な動画には
+    commentThreads を呼ばない。各動画のページ取得は BATCH_CONCURRENCY 件ずつ並列に行い、
+    失敗はその動画の結果 (status="error") に閉じ込める。
+    """
+    try:
+        videos: Optional[Dict[str, Dict[str, Any]]] = await fetch_videos(video_ids, priority)
+    except Exception as e:
+        # 動画情報が取れなくても、コメントの取得は試みる
+        print(f"videos.list error: {e}")
+        videos = None
+
+    async def load(video_id: str) -> Dict[str, Any]:
+        video = videos.get(video_id) if videos is not None else None
+        if videos is not None and video is None:
+            return {"status": "error", "message": "Video not found", "video_id": video_id}
+        if video is not None and video["comment_count"] is None:
+            return {
+                "status": "error", "message": "Comments are disabled",
+                "video_id": video_id, "video": video,
+            }
+        async with _batch_semaphore:
+            if with_replies:
+                page = await fetch_comments_page_with_replies(video_id, None, priority)
+            else:
+                page = await fetch_comments_page(video_id, None, priority)
+        return {**page, "video_id": video_id, "video": video}
+
+    results = await asyncio.gather(*(load(video_id) for video_id in video_ids), return_exceptions=True)
+    return [
+        {"status": "error", "message": "Server Error", "detail": str(result), "video_id": video_id}
+        if isinstance(result, BaseException)
+        else result
+        for video_id, result in zip(video_ids, results)
+    ]
+
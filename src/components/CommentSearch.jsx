@@ -50,9 +50,15 @@ export const CommentSearch = ({ comments, onSearchResult }) => {
         comments: comments
       };
 
+      const headers = { 'Content-Type': 'application/json' };
+      const token = localStorage.getItem('accessToken');
+      if (token) {
+        headers['Authorization'] = `Bearer ${token}`;
+      }
+
       const response = await fetch(BACKEND_API_URL, {
         method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
+        headers: headers,
         body: JSON.stringify(payload),
         // ★ 3. signal を fetch に渡す (これでキャンセル可能になる)
         signal: newController.signal,